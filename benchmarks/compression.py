@@ -0,0 +1,135 @@
+'''
+Benchmarks compression of edge-to-cloud frames on real PM2.5 series
+
+Readings are pulled from the Urban Observatory API with data-injector's
+get_data, or read from a file of timestamp:value lines (e.g. saved with
+--save), then sent through the formats data-preprocessor can forward:
+    readings    frames of raw readings
+    aggregates  frames of hourly mean/min/max/p95 windows
+
+For each format reports bytes against JSON and the uncompressed binary
+frame, and encode/decode throughput of each compression
+
+    python benchmarks/compression.py --sensor PER_AIRMON_MONITOR1135100 --save pm25.txt
+    python benchmarks/compression.py --file pm25.txt
+'''
+import os
+import sys
+import json
+import time
+import datetime
+import argparse
+
+ROOT = os.path.join(os.path.dirname(__file__), "..")
+sys.path.insert(0, os.path.join(ROOT, "edge", "data-preprocessor", "scripts"))
+sys.path.insert(1, os.path.join(ROOT, "edge", "data-injector", "scripts"))
+import codec
+import compression
+import preprocessing
+import windowing
+
+
+def load_readings(args):
+    '''Gets list of (timestamp, value) readings of the series'''
+    if args.file is not None:
+        with open(args.file) as f:
+            lines = [x.strip() for x in f if x.strip()]
+    else:
+        import get_data
+        lines = []
+        for sensor_id in args.sensor:
+            lines += get_data.iter_api_data(sensor_id, args.start, args.end)
+        if args.save is not None:
+            with open(args.save, "w") as f:
+                f.write("\n".join(lines))
+    readings = []
+    for x in lines:
+        timestamp, value = x.split(":")
+        readings.append((int(timestamp), float(value)))
+    return readings
+
+def reading_frames(readings, frame_size):
+    '''Splits readings into binary frames as sent by data-injector'''
+    frames = []
+    for i in range(0, len(readings), frame_size):
+        chunk = readings[i:i + frame_size]
+        frames.append(codec.encode_readings("bench", [x[0] for x in chunk], [x[1] for x in chunk]))
+    return frames
+
+def aggregate_frames(readings, frame_size):
+    '''Aggregates readings into hourly windows and splits them into frames'''
+    fields = ("mean", "min", "max", "p95")
+    preprocessor = preprocessing.Preprocessor(aggregates=fields,
+                                              window=windowing.tumbling(3600),
+                                              outlier_detector="none",
+                                              structured=True)
+    windows = preprocessor.process_arrays([x[0] for x in readings], [x[1] for x in readings])
+    windows += preprocessor.flush()
+    frames = []
+    for i in range(0, len(windows), frame_size):
+        chunk = windows[i:i + frame_size]
+        columns = list(zip(*(values for _, values in chunk)))
+        frames.append(codec.encode_aggregates("bench", fields, [start for start, _ in chunk], columns))
+    return frames, windows
+
+def measure(name, frames, rows, json_bytes, repeat):
+    '''Prints size and throughput of each compression of frames'''
+    raw_bytes = sum(len(x) for x in frames)
+    print(f"{name}: {rows} rows in {len(frames)} frames, JSON {json_bytes} B, "
+          f"binary {raw_bytes} B ({json_bytes / raw_bytes:.2f}x)", flush=True)
+
+    results = {}
+    for label, encoding in (("gorilla", compression.ENCODING_GORILLA),
+                            ("zlib", compression.ENCODING_ZLIB),
+                            ("auto", None)):
+        start = time.perf_counter()
+        for _ in range(repeat):
+            compressed = [compression.compress(x, encoding) for x in frames]
+        encode_time = (time.perf_counter() - start) / repeat
+
+        start = time.perf_counter()
+        for _ in range(repeat):
+            decompressed = [compression.decompress(x) for x in compressed]
+        decode_time = (time.perf_counter() - start) / repeat
+        assert decompressed == frames
+
+        size = sum(len(x) for x in compressed)
+        results[label] = {
+            "bytes": size,
+            "ratio_vs_json": json_bytes / size,
+            "ratio_vs_binary": raw_bytes / size,
+            "encode_rows_per_s": rows / encode_time,
+            "decode_rows_per_s": rows / decode_time,
+        }
+        print(f"  {label:<8} {size:>10} B {json_bytes / size:>7.2f}x JSON {raw_bytes / size:>6.2f}x binary"
+              f" encode {rows / encode_time:>12,.0f} rows/s decode {rows / decode_time:>12,.0f} rows/s",
+              flush=True)
+    return results
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sensor", action="append", help="sensor ID to pull from the API, can be repeated")
+    parser.add_argument("--file", help="read timestamp:value lines from file instead of the API")
+    parser.add_argument("--save", help="save readings pulled from the API to file")
+    parser.add_argument("--start", type=datetime.datetime.fromisoformat, default=datetime.datetime(2023, 10, 1))
+    parser.add_argument("--end", type=datetime.datetime.fromisoformat, default=datetime.datetime(2023, 11, 1))
+    parser.add_argument("--frame-size", type=int, default=100)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+    if args.file is None and not args.sensor:
+        parser.error("give --sensor or --file")
+
+    readings = load_readings(args)
+    print(f"Loaded {len(readings)} readings", flush=True)
+
+    frames = reading_frames(readings, args.frame_size)
+    json_bytes = sum(len(json.dumps([f"{ts}:{value}" for ts, value in readings[i:i + args.frame_size]]))
+                     for i in range(0, len(readings), args.frame_size))
+    report = {"readings": measure("readings", frames, len(readings), json_bytes, args.repeat)}
+
+    frames, windows = aggregate_frames(readings, args.frame_size)
+    # Aggregates were sent as one JSON string per window
+    json_bytes = sum(len(json.dumps(f"{start}:" + ":".join(str(x) for x in values)))
+                     for start, values in windows)
+    report["aggregates"] = measure("aggregates", frames, len(windows), json_bytes, args.repeat)
+    print(json.dumps(report, indent=2), flush=True)
@@ -0,0 +1,76 @@
+'''
+Benchmarks forecasting many series with ml_engine.forecast_many
+
+Fits and predicts --series synthetic daily series (trend, weekly cycle and
+noise, like daily PM2.5 means) with 1 to --max-processes worker processes
+and reports series/s, speedup over 1 process and parallel efficiency.
+Worker start up (importing Prophet) is included, as it is in main.
+
+    python benchmarks/forecast_scaling.py --series 32 --rows 365
+'''
+import os
+import sys
+import json
+import time
+import argparse
+import numpy as np
+import pandas
+
+ROOT = os.path.join(os.path.dirname(__file__), "..")
+sys.path.insert(0, os.path.join(ROOT, "cloud", "data-processor", "scripts"))
+import log
+import ml_engine
+
+
+def make_series(count, rows, seed=0):
+    '''Gets dict of series name -> DataFrame of Timestamp and Value'''
+    rng = np.random.default_rng(seed)
+    series = {}
+    for i in range(count):
+        t = np.arange(rows)
+        values = 10 + 0.01*t*rng.uniform(-1, 1) + 3*np.sin(2*np.pi*t/7 + rng.uniform(0, 2*np.pi))\
+            + rng.normal(0, 1, rows)
+        series[f"bench-{i}"] = pandas.DataFrame({
+            "Timestamp": pandas.date_range("2022-01-01", periods=rows, freq="D"),
+            "Value": values,
+        })
+    return series
+
+def measure(series, processes, periods):
+    '''Forecasts all series with :processes: workers, returns seconds taken'''
+    start = time.perf_counter()
+    failed = 0
+    # forecast_many renames the columns of the DataFrames it is given
+    frames = {name: df.copy() for name, df in series.items()}
+    for _, _, error, _ in ml_engine.forecast_many(frames, processes=processes, periods=periods):
+        failed += error is not None
+    return time.perf_counter() - start, failed
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--series", type=int, default=32)
+    parser.add_argument("--rows", type=int, default=365)
+    parser.add_argument("--periods", type=int, default=15)
+    parser.add_argument("--max-processes", type=int, default=os.cpu_count())
+    args = parser.parse_args()
+    log.setup("benchmark", level="WARNING", fmt="text")
+
+    series = make_series(args.series, args.rows)
+    print(f"{args.series} series of {args.rows} rows, {os.cpu_count()} CPUs", flush=True)
+
+    report = {}
+    baseline = None
+    for processes in range(1, args.max_processes + 1):
+        seconds, failed = measure(series, processes, args.periods)
+        baseline = baseline or seconds
+        report[processes] = {
+            "seconds": seconds,
+            "series_per_s": args.series / seconds,
+            "speedup": baseline / seconds,
+            "efficiency": baseline / seconds / processes,
+            "failed": failed,
+        }
+        print(f"  {processes:>3} processes {seconds:>8.2f} s {args.series / seconds:>8.2f} series/s"
+              f" speedup {baseline / seconds:>5.2f}x efficiency {baseline / seconds / processes:>5.0%}",
+              flush=True)
+    print(json.dumps(report, indent=2), flush=True)
@@ -0,0 +1,437 @@
+'''
+Benchmarks the injector -> MQTT -> preprocessor -> RabbitMQ -> processor
+chain in one process, without either docker-compose stack
+
+The real code of each service is wired to in-process broker stand-ins:
+    data-injector       publisher.BatchPublisher per series
+    MQTT stand-in       queue delivered by one thread, as paho's network
+                        thread delivers to data-preprocessor's on_message
+    data-preprocessor   subscriber.Callback on its pipeline.Pipeline with a
+                        publisher.RabbitPublisher
+    AMQP stand-in       channel whose confirmed messages are delivered by
+                        one consumer thread, :amqp_rtt: seconds per wait
+                        for confirms
+    data-processor      subscriber.Callback, optionally with a store.Store
+Forecasting is not included, see forecast_scaling.py.
+
+Readings are synthetic (a daily cycle of PM2.5 with noise and spikes) or
+recorded timestamp:value lines (see compression.py --save), replayed at
+--rate readings/s across --series series, 0 for as fast as possible.
+
+Reports as JSON: readings, MQTT frames, AMQP messages and windows per
+second, p50/p99/max latency per stage in ms, CPU use and peak RSS
+    mqtt_delivery       MQTT publish to on_message of data-preprocessor
+    preprocessor_ingest on_message of data-preprocessor
+    amqp_delivery       basic_publish to on_message of data-processor
+    processor_ingest    on_message of data-processor
+    end_to_end          injection of the reading closing a window to the
+                        window arriving at data-processor
+
+    python benchmarks/pipeline.py --series 8 --readings 20000 --out result.json
+    python benchmarks/pipeline.py --rate 2000 --file pm25.txt
+'''
+import os
+import sys
+import json
+import time
+import queue
+import shutil
+import bisect
+import argparse
+import platform
+import resource
+import tempfile
+import importlib
+import threading
+import subprocess
+import numpy as np
+import pika
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+INJECTOR = os.path.join(ROOT, "edge", "data-injector", "scripts")
+PREPROCESSOR = os.path.join(ROOT, "edge", "data-preprocessor", "scripts")
+PROCESSOR = os.path.join(ROOT, "cloud", "data-processor", "scripts")
+
+TOPIC = "CSC8112"
+
+
+def load_service(directory, names):
+    '''
+    Imports modules of one service
+    Services have modules of the same names (codec, log, publisher, ...), so
+    modules imported from directory are removed from sys.modules again
+    once loaded and each service keeps its own copies
+
+    Returns: dict of name -> module
+    '''
+    sys.path.insert(0, directory)
+    try:
+        modules = {name: importlib.import_module(name) for name in names}
+    finally:
+        sys.path.remove(directory)
+    for name, module in list(sys.modules.items()):
+        if os.path.dirname(os.path.abspath(getattr(module, "__file__", None) or "")) == directory:
+            del sys.modules[name]
+    return modules
+
+
+class Latencies:
+    '''Latency samples of one stage, safe to add to from several threads'''
+    def __init__(self):
+        self.samples = []
+        self.lock = threading.Lock()
+
+    def add(self, seconds):
+        with self.lock:
+            self.samples.append(seconds)
+
+    def extend(self, seconds):
+        with self.lock:
+            self.samples.extend(seconds)
+
+    def summary(self):
+        if not self.samples:
+            return {"count": 0}
+        ms = np.array(self.samples)*1000
+        return {
+            "count": len(ms),
+            "p50_ms": round(float(np.percentile(ms, 50)), 3),
+            "p99_ms": round(float(np.percentile(ms, 99)), 3),
+            "max_ms": round(float(ms.max()), 3),
+            "mean_ms": round(float(ms.mean()), 3),
+        }
+
+
+class Message:
+    '''paho MQTTMessage stand-in'''
+    def __init__(self, topic, payload):
+        self.topic = topic
+        self.payload = payload
+
+
+class MessageInfo:
+    '''paho MQTTMessageInfo stand-in, published once queued'''
+    def wait_for_publish(self):
+        pass
+
+
+class MQTTStandIn:
+    '''
+    In-process MQTT broker and client
+    Messages published by data-injector are delivered in order by one
+    thread, as paho's network thread delivers to data-preprocessor
+    '''
+    def __init__(self, on_message, latencies):
+        self.on_message = on_message
+        self.latencies = latencies
+        self.messages = queue.Queue()
+        self.published = 0
+        self.thread = threading.Thread(target=self.run, name="mqtt", daemon=True)
+        self.thread.start()
+
+    def publish(self, topic, payload, qos=0, retain=False):
+        self.messages.put((time.perf_counter(), topic, payload))
+        self.published += 1
+        return MessageInfo()
+
+    def run(self):
+        while True:
+            sent, topic, payload = self.messages.get()
+            if topic is None:
+                return
+            start = time.perf_counter()
+            self.latencies["mqtt_delivery"].add(start - sent)
+            self.on_message(self, None, Message(topic, payload))
+            self.latencies["preprocessor_ingest"].add(time.perf_counter() - start)
+
+    def stop(self):
+        self.messages.put((0, None, None))
+        self.thread.join()
+
+
+class Properties:
+    '''pika BasicProperties as received'''
+    def __init__(self, properties):
+        self.content_type = properties.content_type
+        self.headers = properties.headers
+
+
+class AMQPStandIn:
+    '''
+    In-process RabbitMQ broker, channel and connection
+    Messages are delivered to data-processor by one consumer thread once
+    confirmed, each synchronous call (queue_declare, confirm_delivery) and
+    each wait for confirms waits :rtt:
+    '''
+    def __init__(self, rtt, latencies):
+        self.rtt = rtt
+        self.latencies = latencies
+        self.connection = self
+        self._impl = self
+        self.unconfirmed = []
+        self.on_confirm = None
+        self.delivery_tag = 0
+        self.deliveries = queue.Queue()
+        self.consumer = None
+        self.published = 0
+        self.done = threading.Event()
+
+    # Channel and connection of data-preprocessor
+    def queue_declare(self, queue):
+        time.sleep(self.rtt)
+
+    def confirm_delivery(self, ack_nack_callback, callback=None):
+        time.sleep(self.rtt)
+        self.on_confirm = ack_nack_callback
+        if callback is not None:
+            callback(None)
+
+    def _flush_output(self, *waiters):
+        if not self.unconfirmed:
+            return
+        time.sleep(self.rtt)
+        for message in self.unconfirmed:
+            self.deliveries.put(message)
+        self.unconfirmed = []
+        self.on_confirm(pika.frame.Method(1, pika.spec.Basic.Ack(self.delivery_tag, multiple=True)))
+
+    def basic_publish(self, exchange, routing_key, body, properties=None):
+        message = (time.perf_counter(), routing_key, body, Properties(properties))
+        self.published += 1
+        if self.on_confirm is not None:
+            self.delivery_tag += 1
+            self.unconfirmed.append(message)
+        else:
+            self.deliveries.put(message)
+
+    def process_data_events(self, time_limit=None):
+        pass
+
+    # Channel of data-processor
+    def basic_cancel(self, consumer_tag):
+        self.done.set()
+
+    def call_later(self, delay, callback):
+        pass
+
+    def consume(self, on_message):
+        '''Delivers messages to on_message on a consumer thread'''
+        def run():
+            while not self.done.is_set():
+                try:
+                    sent, routing_key, body, properties = self.deliveries.get(timeout=0.1)
+                except queue.Empty:
+                    continue
+                start = time.perf_counter()
+                self.latencies["amqp_delivery"].add(start - sent)
+                on_message(self, None, properties, body)
+                self.latencies["processor_ingest"].add(time.perf_counter() - start)
+        self.consumer = threading.Thread(target=run, name="amqp", daemon=True)
+        self.consumer.start()
+
+
+class WindowTracker:
+    '''
+    Measures end-to-end latency of windows arriving at data-processor
+    A window [start, start + size) is closed by the first reading at or
+    after start + size + allowed_lateness, or by the finished token
+    '''
+    def __init__(self, window_seconds, allowed_lateness):
+        self.close_after = window_seconds + allowed_lateness
+        # series -> (reading timestamps in s, perf_counter injection times)
+        self.injected = {}
+        self.finished_at = None
+        self.seen = {}
+
+    def on_injected(self, series, timestamps, injected_at):
+        self.injected[series] = (timestamps, injected_at)
+
+    def closing_time(self, series, start):
+        timestamps, injected_at = self.injected[series]
+        i = bisect.bisect_left(timestamps, start + self.close_after)
+        if i < len(timestamps) and injected_at[i] is not None:
+            return injected_at[i]
+        return self.finished_at
+
+    def on_received(self, data, latencies):
+        '''Measures windows received since the last call'''
+        now = time.perf_counter()
+        samples = []
+        for series, columns in data.items():
+            seen = self.seen.get(series, 0)
+            for start in columns.timestamps[seen:]:
+                closed = self.closing_time(series, start)
+                if closed is not None:
+                    samples.append(now - closed)
+            self.seen[series] = len(columns)
+        latencies["end_to_end"].extend(samples)
+
+
+def synthetic_readings(count, interval, seed=0):
+    '''Gets timestamp:value readings of a daily PM2.5 cycle every :interval: s'''
+    rng = np.random.default_rng(seed)
+    t = np.arange(count)
+    values = 12 + 6*np.sin(2*np.pi*t*interval/86400) + rng.normal(0, 2, count)
+    # Occasional spikes for the outlier detector
+    values[rng.random(count) < 0.002] = 80
+    start = 1696118400000
+    return [f"{start + int(i*interval*1000)}:{v:.2f}" for i, v in zip(t, values)]
+
+def file_readings(path):
+    with open(path) as f:
+        return [x.strip() for x in f if x.strip()]
+
+def rusage():
+    me = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return me.ru_utime + me.ru_stime + children.ru_utime + children.ru_stime, me.ru_maxrss, children.ru_maxrss
+
+def revision():
+    try:
+        return subprocess.run(["git", "-C", ROOT, "describe", "--always", "--dirty"],
+                              stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                              universal_newlines=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run(args):
+    injector = load_service(INJECTOR, ["publisher", "log"])
+    preprocessor = load_service(PREPROCESSOR, ["subscriber", "publisher", "sharding", "pipeline",
+                                               "windowing", "aggregates"])
+    processor = load_service(PROCESSOR, ["subscriber", "store"])
+    injector["log"].setup("benchmark", level=args.log_level, fmt="text")
+
+    latencies = {x: Latencies() for x in ("mqtt_delivery", "preprocessor_ingest", "amqp_delivery",
+                                          "processor_ingest", "end_to_end")}
+    readings = file_readings(args.file) if args.file else synthetic_readings(args.readings, args.interval)
+    window = preprocessor["windowing"].parse_window(args.window)
+    fields = preprocessor["aggregates"].parse_aggregates(args.aggregates)
+    tracker = WindowTracker(window.size, args.allowed_lateness)
+    series = [f"BENCH{i:04d}" for i in range(args.series)]
+
+    # data-processor
+    amqp = AMQPStandIn(args.amqp_rtt, latencies)
+    store_dir = tempfile.mkdtemp() if args.store else None
+    store = processor["store"].Store(os.path.join(store_dir, "aggregates.db")) if store_dir else None
+    cloud = processor["subscriber"].Callback(amqp, store)
+    def on_cloud_message(ch, method, properties, body):
+        cloud.on_message(ch, method, properties, body)
+        tracker.on_received(cloud.data, latencies)
+    amqp.consume(on_cloud_message)
+
+    # data-preprocessor, wired as its main does
+    shards = preprocessor["sharding"].ShardedPreprocessor(args.workers,
+                                                         aggregates=fields,
+                                                         allowed_lateness=args.allowed_lateness,
+                                                         window=window,
+                                                         outlier_detector=args.outlier_detector,
+                                                         structured=args.wire_format == "binary")
+    edge = preprocessor["subscriber"].Callback(shards, wire_format=args.wire_format, fields=fields,
+                                               compress=args.compression)
+    edge.rabbit_publisher = preprocessor["publisher"].RabbitPublisher(amqp, batch_size=args.rabbit_batch_size)
+    if not args.inline:
+        edge.pipeline = preprocessor["pipeline"].Pipeline(edge.process, edge.publish, poll=edge.poll,
+                                                          idle=edge.rabbit_publisher.poll)
+        edge.pipeline.start()
+    mqtt = MQTTStandIn(edge.on_message, latencies)
+
+    # data-injector, readings of every series interleaved at the rate
+    batchers = [injector["publisher"].BatchPublisher(mqtt, f"{TOPIC}/{x}", batch_size=args.batch_size,
+                                                     linger_ms=args.linger_ms,
+                                                     wire_format=args.wire_format, series=x)
+                for x in series]
+    timestamps = [int(x.split(":")[0]) // 1000 for x in readings]
+    injected = {x: [None]*len(readings) for x in series}
+    for x in series:
+        tracker.on_injected(x, timestamps, injected[x])
+
+    cpu_before, _, _ = rusage()
+    start = time.perf_counter()
+    for i, reading in enumerate(readings):
+        if args.rate:
+            delay = start + i*len(series)/args.rate - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+        for name, batcher in zip(series, batchers):
+            injected[name][i] = time.perf_counter()
+            batcher.publish(reading)
+    for batcher in batchers:
+        batcher.wait()
+    tracker.finished_at = time.perf_counter()
+    injector["publisher"].publish_to_mqtt(mqtt, TOPIC, "finished")
+    injected_seconds = time.perf_counter() - start
+
+    if not amqp.done.wait(args.timeout):
+        raise TimeoutError(f"data-processor did not receive the finished token in {args.timeout}s")
+    elapsed = time.perf_counter() - start
+    cpu_after, max_rss, children_max_rss = rusage()
+
+    mqtt.stop()
+    if edge.pipeline is not None:
+        edge.pipeline.stop()
+    shards.close()
+    windows = sum(len(x) for x in cloud.data.values())
+    if store is not None:
+        store.close()
+        shutil.rmtree(store_dir)
+
+    total = len(readings)*len(series)
+    return {
+        "revision": revision(),
+        "python": platform.python_version(),
+        "cpus": os.cpu_count(),
+        "config": {k: v for k, v in vars(args).items() if k not in ("out",)},
+        "readings": total,
+        "mqtt_messages": mqtt.published,
+        "amqp_messages": amqp.published,
+        "windows": windows,
+        "seconds": round(elapsed, 3),
+        "inject_seconds": round(injected_seconds, 3),
+        "throughput": {
+            "readings_per_s": round(total / elapsed, 1),
+            "mqtt_messages_per_s": round(mqtt.published / elapsed, 1),
+            "amqp_messages_per_s": round(amqp.published / elapsed, 1),
+            "windows_per_s": round(windows / elapsed, 1),
+        },
+        "latency": {name: x.summary() for name, x in latencies.items()},
+        "cpu": {
+            "seconds": round(cpu_after - cpu_before, 3),
+            "utilisation": round((cpu_after - cpu_before) / elapsed, 3),
+        },
+        "max_rss_mb": round(max_rss / 1024, 1),
+        "children_max_rss_mb": round(children_max_rss / 1024, 1),
+        "pipeline": edge.pipeline.stats() if edge.pipeline is not None else None,
+        "publisher": edge.rabbit_publisher.stats(),
+    }
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--file", help="replay timestamp:value lines from file instead of synthetic readings")
+    parser.add_argument("--readings", type=int, default=20000, help="synthetic readings per series")
+    parser.add_argument("--interval", type=float, default=60, help="seconds between synthetic readings")
+    parser.add_argument("--series", type=int, default=4)
+    parser.add_argument("--rate", type=float, default=0, help="readings/s across all series, 0 for unthrottled")
+    parser.add_argument("--wire-format", default="binary", choices=("binary", "json"))
+    parser.add_argument("--compression", default="auto", choices=("auto", "gorilla", "zlib", "none"))
+    parser.add_argument("--batch-size", type=int, default=100, help="readings per MQTT frame")
+    parser.add_argument("--linger-ms", type=int, default=50)
+    parser.add_argument("--window", default="1h")
+    parser.add_argument("--aggregates", default="mean,max")
+    parser.add_argument("--allowed-lateness", type=int, default=0)
+    parser.add_argument("--outlier-detector", default="static:50")
+    parser.add_argument("--workers", type=int, default=0, help="preprocessing worker processes")
+    parser.add_argument("--inline", action="store_true", help="preprocess on the MQTT thread, without the pipeline")
+    parser.add_argument("--rabbit-batch-size", type=int, default=100)
+    parser.add_argument("--amqp-rtt", type=float, default=0.0005, help="seconds per synchronous AMQP call")
+    parser.add_argument("--store", action="store_true", help="write windows to data-processor's store")
+    parser.add_argument("--timeout", type=float, default=600)
+    parser.add_argument("--log-level", default="WARNING")
+    parser.add_argument("--out", help="write the JSON report to file as well as stdout")
+    args = parser.parse_args()
+
+    report = run(args)
+    body = json.dumps(report, indent=2)
+    print(body, flush=True)
+    if args.out:
+        with open(args.out, "w") as f:
+            f.write(body + "\n")
@@ -0,0 +1,117 @@
+'''
+Benchmarks publishing aggregates from data-preprocessor to RabbitMQ
+
+Compares publisher.publish_to_rabbitmq as it was (queue_declare round-trip
+per message) with publisher.RabbitPublisher (declared once, committed in
+batches).
+
+Runs against an in-process AMQP stand-in which adds :rtt: seconds to each
+synchronous broker call, or a real broker with --host
+
+    python benchmarks/rabbit_publisher.py --messages 20000 --rtt 0.0005
+    python benchmarks/rabbit_publisher.py --host localhost
+'''
+import os
+import sys
+import json
+import time
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "edge", "data-preprocessor", "scripts"))
+import pika
+import publisher
+
+
+class StandInChannel:
+    '''
+    In-process stand-in of pika's BlockingChannel and its underlying channel
+    Synchronous methods (queue_declare, confirm_delivery) wait one
+    round-trip, as does waiting for confirms (_flush_output) however many
+    are outstanding. basic_publish is a socket write and does not wait
+    '''
+    def __init__(self, rtt):
+        self.rtt = rtt
+        self.queues = {}
+        self.unconfirmed = []
+        self.on_confirm = None
+        self.delivery_tag = 0
+        self._impl = self
+
+    def queue_declare(self, queue):
+        time.sleep(self.rtt)
+        self.queues.setdefault(queue, [])
+
+    def confirm_delivery(self, ack_nack_callback, callback=None):
+        time.sleep(self.rtt)
+        self.on_confirm = ack_nack_callback
+        if callback is not None:
+            callback(None)
+
+    def _flush_output(self, *waiters):
+        if not self.unconfirmed:
+            return
+        time.sleep(self.rtt)
+        for queue, body in self.unconfirmed:
+            self.queues[queue].append(body)
+        self.unconfirmed = []
+        self.on_confirm(pika.frame.Method(1, pika.spec.Basic.Ack(self.delivery_tag, multiple=True)))
+
+    def basic_publish(self, exchange, routing_key, body, properties=None):
+        if self.on_confirm is not None:
+            self.delivery_tag += 1
+            self.unconfirmed.append((routing_key, body))
+        else:
+            self.queues[routing_key].append(body)
+
+
+def old_publish(channel, queue_name, msg, headers=None):
+    '''publish_to_rabbitmq before queue declares were cached'''
+    channel.queue_declare(queue=queue_name)
+    channel.basic_publish(exchange='', routing_key=queue_name, body=json.dumps(msg),
+                          properties=pika.BasicProperties(headers=headers))
+
+def run(name, channel_factory, publish, messages, flush=None):
+    '''Publishes :messages: aggregates and returns messages per second'''
+    start = time.perf_counter()
+    for i in range(messages):
+        publish(channel_factory, "bench", f"{1696118400 + i * 86400}:{i % 40}.5", {"series": "bench"})
+    if flush is not None:
+        flush()
+    elapsed = time.perf_counter() - start
+    rate = messages / elapsed
+    print(f"{name:<40} {messages:>8} msgs {elapsed:>8.3f} s {rate:>12,.0f} msgs/s", flush=True)
+    return rate
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--messages", type=int, default=20000)
+    parser.add_argument("--rtt", type=float, default=0.0005, help="stand-in round-trip time in seconds")
+    parser.add_argument("--batch-size", type=int, default=100)
+    parser.add_argument("--host", help="benchmark against RabbitMQ on this host instead of the stand-in")
+    args = parser.parse_args()
+
+    def make_channel():
+        if args.host is None:
+            return StandInChannel(args.rtt)
+        connection = pika.BlockingConnection(pika.ConnectionParameters(host=args.host))
+        channel = connection.channel()
+        channel.queue_delete(queue="bench")
+        return channel
+
+    target = args.host or f"in-process stand-in, rtt={args.rtt * 1000:.2f} ms"
+    print(f"Publishing to {target}", flush=True)
+
+    channel = make_channel()
+    before = run("publish_to_rabbitmq (declare per message)", channel, old_publish, args.messages)
+
+    channel = make_channel()
+    rabbit = publisher.RabbitPublisher(channel, batch_size=args.batch_size, confirm=False)
+    run("RabbitPublisher (no confirms)", None, lambda _, q, m, h: rabbit.publish(q, m, h),
+        args.messages, rabbit.flush)
+
+    channel = make_channel()
+    rabbit = publisher.RabbitPublisher(channel, batch_size=args.batch_size, confirm=True)
+    after = run(f"RabbitPublisher (batch {args.batch_size}, confirmed)", None,
+                lambda _, q, m, h: rabbit.publish(q, m, h), args.messages, rabbit.flush)
+
+    print(f"Speed-up with confirmed batches: {after / before:.1f}x", flush=True)
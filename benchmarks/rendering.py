@@ -0,0 +1,95 @@
+'''
+Benchmarks rendering plots of long series with visualiser
+
+For series of increasing length renders the data plot:
+    pyplot      as visualiser did before, every point through pyplot's
+                global state with .tolist() columns
+    agg+lttb    visualiser.plot_data, explicit Agg figure downsampled with
+                LTTB to the figure's pixel width
+and reports render time, LTTB time alone and memory growth of the process
+
+    python benchmarks/rendering.py --lengths 1000,10000,100000,1000000
+'''
+import os
+import sys
+import json
+import time
+import argparse
+import resource
+import tempfile
+import numpy as np
+import pandas
+import matplotlib
+matplotlib.use("Agg")
+from matplotlib import pyplot as plt
+
+ROOT = os.path.join(os.path.dirname(__file__), "..")
+sys.path.insert(0, os.path.join(ROOT, "cloud", "data-processor", "scripts"))
+import log
+import visualiser
+
+
+def make_series(rows, seed=0):
+    '''Gets DataFrame of Timestamp and Value of a noisy daily cycle'''
+    rng = np.random.default_rng(seed)
+    t = np.arange(rows)
+    return pandas.DataFrame({
+        "Timestamp": pandas.to_datetime(1600000000 + 60*t, unit="s"),
+        "Value": 10 + 5*np.sin(2*np.pi*t/1440) + rng.normal(0, 1, rows),
+    })
+
+def plot_pyplot(df, out):
+    '''The data plot as drawn before, without closing the figure'''
+    plt.figure(figsize=(15, 10))
+    plt.title("AVG DAILY PM2.5")
+    plt.ylabel("AVG PM2.5 (μg/m^3)")
+    plt.plot(df["Timestamp"].tolist(), df["Value"].tolist())
+    plt.xticks(rotation=45, fontsize=8)
+    for tick in plt.gca().xaxis.get_ticklabels()[::2]:
+        tick.set_visible(False)
+    plt.savefig(out)
+
+def max_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def measure(function, df, out, repeat):
+    '''Gets mean seconds of rendering df with function'''
+    start = time.perf_counter()
+    for _ in range(repeat):
+        function(df, out)
+    return (time.perf_counter() - start) / repeat
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--lengths", default="1000,10000,100000,1000000")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--skip-pyplot-above", type=int, default=1000000,
+                        help="skip the pyplot renderer for longer series, it is slow")
+    args = parser.parse_args()
+    log.setup("benchmark", level="WARNING", fmt="text")
+
+    out = os.path.join(tempfile.mkdtemp(), "plot.png")
+    report = {}
+    for rows in (int(x) for x in args.lengths.split(",")):
+        df = make_series(rows)
+        x = df["Timestamp"].values.astype(np.int64)
+        start = time.perf_counter()
+        kept = visualiser.lttb(x, df["Value"].values, 1500)
+        lttb_s = time.perf_counter() - start
+
+        result = {"lttb_s": lttb_s, "points_plotted": len(kept)}
+        for label, function in (("pyplot", plot_pyplot), ("agg+lttb", visualiser.plot_data)):
+            if label == "pyplot" and rows > args.skip_pyplot_above:
+                continue
+            rss = max_rss_mb()
+            result[label] = {
+                "render_s": measure(function, df, out, args.repeat),
+                "max_rss_growth_mb": max_rss_mb() - rss,
+            }
+        report[rows] = result
+        line = f"{rows:>9} rows  lttb {lttb_s*1000:>8.1f} ms"
+        for label in ("pyplot", "agg+lttb"):
+            if label in result:
+                line += f"  {label} {result[label]['render_s']*1000:>9.1f} ms"
+        print(line, flush=True)
+    print(json.dumps(report, indent=2), flush=True)
@@ -0,0 +1,107 @@
+'''
+Columnar accumulator of received windows
+Values are appended to typed arrays as they arrive, so a long history is
+held as 8 bytes per value rather than one Python string per message and is
+handed to pandas without converting each row
+'''
+from array import array
+import numpy as np
+import pandas
+
+# Name of the first aggregate column in DataFrames, as used by the forecast
+VALUE_COLUMN = "Value"
+
+
+class SeriesColumns:
+    '''
+    Growable int64 timestamp column and one float64 column per aggregate
+    Missing values are NaN
+
+    Attributes:
+        fields: Names of aggregates in each window, taken from the first
+            binary frame received if not given
+    '''
+    def __init__(self, fields=None):
+        self.fields = tuple(fields) if fields is not None else None
+        self.timestamps = array("q")
+        self.columns = []
+
+    def __len__(self):
+        return len(self.timestamps)
+
+    def _ensure_fields(self, fields):
+        '''Creates columns on first use'''
+        if self.fields is None:
+            self.fields = tuple(fields)
+        while len(self.columns) < len(self.fields):
+            # Columns added late are filled with NaN for earlier rows
+            self.columns.append(array("d", [np.nan]) * len(self.timestamps))
+
+    def extend_frame(self, frame):
+        '''
+        Appends the windows of a binary frame (see codec)
+        Columns are copied as bytes, rows are never visited in Python
+        Aggregates not in this series' fields are ignored, missing ones are NaN
+        '''
+        self.extend(frame.fields, frame.timestamps, frame.columns)
+
+    def extend(self, fields, timestamps, columns):
+        '''
+        Appends windows given as an int64 timestamp column and a float64
+        column per field, any buffer (array, memoryview or numpy array)
+        '''
+        self._ensure_fields(fields)
+        count = len(timestamps)
+        self.timestamps.frombytes(memoryview(timestamps).cast("B"))
+        columns = dict(zip(fields, columns))
+        for name, column in zip(self.fields, self.columns):
+            if name in columns:
+                column.frombytes(memoryview(columns[name]).cast("B"))
+            else:
+                column.extend(array("d", [np.nan]) * count)
+
+    def append(self, msg):
+        '''Appends one timestamp:value[:value...] message'''
+        timestamp, *values = msg.split(":")
+        if self.fields is None:
+            self._ensure_fields([VALUE_COLUMN] + [f"{VALUE_COLUMN}{i}" for i in range(1, len(values))])
+        else:
+            self._ensure_fields(self.fields)
+        self.timestamps.append(int(timestamp))
+        for i, column in enumerate(self.columns):
+            value = values[i] if i < len(values) else "None"
+            column.append(np.nan if value == "None" else float(value))
+
+    def latest(self):
+        '''Gets newest timestamp, None if empty'''
+        if not self.timestamps:
+            return None
+        return int(np.frombuffer(self.timestamps, dtype=np.int64).max())
+
+    def trim(self, before):
+        '''Drops windows with timestamps before :before:, bounding memory'''
+        keep = np.frombuffer(self.timestamps, dtype=np.int64) >= before
+        if keep.all():
+            return
+        self.timestamps = array("q", np.frombuffer(self.timestamps, dtype=np.int64)[keep].tobytes())
+        self.columns = [array("d", np.frombuffer(column, dtype=np.float64)[keep].tobytes())
+                        for column in self.columns]
+
+    def to_dataframe(self, since=None):
+        '''
+        Gets DataFrame with a datetime64 Timestamp column and a column per
+        aggregate, the first aggregate is named Value
+        Columns are wrapped with np.frombuffer without converting rows, the
+        DataFrame holds its own copy so the arrays can keep growing
+
+        Attributes:
+            since: Only windows with timestamps from :since: on, None for all
+        '''
+        timestamps = np.frombuffer(self.timestamps, dtype=np.int64)
+        rows = slice(None) if since is None else timestamps >= since
+        data = {"Timestamp": pandas.to_datetime(timestamps[rows], unit="s")}
+        for i, (name, column) in enumerate(zip(self.fields or (), self.columns)):
+            data[VALUE_COLUMN if i == 0 else name] = np.frombuffer(column, dtype=np.float64)[rows]
+        if VALUE_COLUMN not in data:
+            data[VALUE_COLUMN] = np.empty(0, dtype=np.float64)
+        return pandas.DataFrame(data)
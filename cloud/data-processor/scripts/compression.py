@@ -0,0 +1,248 @@
+'''
+Compression of binary frames (see codec) sent from edge to cloud
+Shared by data-preprocessor and data-processor, keep the copies in each
+service identical
+
+Timestamps are stored as delta-of-deltas and values as the XOR of each
+value with the one before it, as in Facebook's Gorilla time series store
+http://www.vldb.org/pvldb/vol8/p1816-teller.pdf
+Regular timestamps and slowly changing values take a few bits each. Frames
+which compress better with zlib (e.g. noisy values) are sent with zlib.
+
+Compressed frame layout:
+    magic       2s b"WZ"
+    encoding    B ENCODING_GORILLA or ENCODING_ZLIB
+    header      H length, the frame up to its timestamp column as it is
+    body        gorilla: count bits of each column in order
+                zlib: deflated columns
+'''
+import zlib
+import struct
+from array import array
+import codec
+
+MAGIC = b"WZ"
+ENCODING_GORILLA = 1
+ENCODING_ZLIB = 2
+# Names sent in the AMQP content_encoding property
+ENCODINGS = {ENCODING_GORILLA: "gorilla", ENCODING_ZLIB: "zlib"}
+
+PREFIX = struct.Struct("<2sBH")
+
+# Value bits of delta-of-delta buckets
+# A delta-of-delta of 0 is the single bit 0, others use the first bucket
+# they fit in. Bucket i is written as i + 1 one bits and a zero bit followed
+# by its value, the last bucket has no zero bit
+DOD_BITS = (7, 9, 12, 32, 64)
+
+
+class BitWriter:
+    '''Appends bits most significant first, full 64-bit words are moved to a bytearray'''
+    def __init__(self):
+        self.out = bytearray()
+        self.acc = 0
+        self.nbits = 0
+
+    def write(self, value, nbits):
+        '''Appends the low nbits of value'''
+        self.acc = (self.acc << nbits) | (value & ((1 << nbits) - 1))
+        self.nbits += nbits
+        if self.nbits >= 64:
+            self.nbits -= 64
+            self.out += (self.acc >> self.nbits).to_bytes(8, "big")
+            self.acc &= (1 << self.nbits) - 1
+
+    def getvalue(self):
+        '''Gets written bits as bytes, padded with zero bits'''
+        pad = -self.nbits % 8
+        return bytes(self.out) + (self.acc << pad).to_bytes((self.nbits + pad) // 8, "big")
+
+
+class BitReader:
+    '''Reads bits written by BitWriter'''
+    def __init__(self, data, offset=0):
+        self.data = data
+        self.pos = offset * 8
+
+    def read(self, nbits):
+        '''Reads nbits as an unsigned integer'''
+        start = self.pos >> 3
+        end = (self.pos + nbits + 7) >> 3
+        if end > len(self.data):
+            raise ValueError("Compressed frame is truncated")
+        chunk = int.from_bytes(self.data[start:end], "big")
+        shift = end * 8 - self.pos - nbits
+        self.pos += nbits
+        return (chunk >> shift) & ((1 << nbits) - 1)
+
+    def bit(self):
+        '''Reads a single bit'''
+        byte = self.data[self.pos >> 3]
+        bit = (byte >> (7 - (self.pos & 7))) & 1
+        self.pos += 1
+        return bit
+
+
+def _signed(value, nbits):
+    '''Interprets low nbits of value as two's complement'''
+    return value - (1 << nbits) if value >> (nbits - 1) else value
+
+def write_timestamps(writer, timestamps):
+    '''Writes integer timestamps as delta-of-deltas'''
+    if not timestamps:
+        return
+    previous = timestamps[0]
+    writer.write(previous, 64)
+    delta = 0
+    for ts in timestamps[1:]:
+        new_delta = ts - previous
+        dod = new_delta - delta
+        previous, delta = ts, new_delta
+        if dod == 0:
+            writer.write(0, 1)
+            continue
+        for bucket, value_bits in enumerate(DOD_BITS):
+            if -(1 << (value_bits - 1)) <= dod < (1 << (value_bits - 1)):
+                break
+        if bucket == len(DOD_BITS) - 1:
+            writer.write((1 << (bucket + 1)) - 1, bucket + 1)
+        else:
+            writer.write((1 << (bucket + 2)) - 2, bucket + 2)
+        writer.write(dod, value_bits)
+
+def read_timestamps(reader, count):
+    '''Reads count timestamps written by write_timestamps'''
+    if count == 0:
+        return []
+    previous = _signed(reader.read(64), 64)
+    timestamps = [previous]
+    delta = 0
+    for _ in range(count - 1):
+        if reader.bit():
+            bucket = 0
+            while bucket < len(DOD_BITS) - 1 and reader.bit():
+                bucket += 1
+            value_bits = DOD_BITS[bucket]
+            delta += _signed(reader.read(value_bits), value_bits)
+        previous += delta
+        timestamps.append(previous)
+    return timestamps
+
+def write_floats(writer, values):
+    '''Writes float64 values as the XOR with the previous value'''
+    if not len(values):
+        return
+    if type(values) == list:
+        values = array("d", values)
+    # Bit patterns of the values, read in place
+    bits = memoryview(values).cast("B").cast("Q").tolist()
+    previous = bits[0]
+    writer.write(previous, 64)
+    leading, trailing = 65, 0
+    for value in bits[1:]:
+        xor = value ^ previous
+        previous = value
+        if xor == 0:
+            writer.write(0, 1)
+            continue
+        new_leading = min(64 - xor.bit_length(), 31)
+        new_trailing = (xor & -xor).bit_length() - 1
+        if new_leading >= leading and new_trailing >= trailing:
+            # Meaningful bits fit in the previous block
+            writer.write(0b10, 2)
+            writer.write(xor >> trailing, 64 - leading - trailing)
+        else:
+            leading, trailing = new_leading, new_trailing
+            meaningful = 64 - leading - trailing
+            writer.write(0b11, 2)
+            writer.write(leading, 5)
+            # A block of 64 bits is stored as 0
+            writer.write(meaningful & 63, 6)
+            writer.write(xor >> trailing, meaningful)
+
+def read_floats(reader, count):
+    '''Reads count float64 values written by write_floats'''
+    if count == 0:
+        return array("d")
+    previous = reader.read(64)
+    bits = [previous]
+    leading = trailing = 0
+    for _ in range(count - 1):
+        if reader.bit():
+            if reader.bit():
+                leading = reader.read(5)
+                meaningful = reader.read(6) or 64
+                trailing = 64 - leading - meaningful
+            previous ^= reader.read(64 - leading - trailing) << trailing
+        bits.append(previous)
+    return array("d", array("Q", bits).tobytes())
+
+
+def compress(frame, encoding=None):
+    '''
+    Compresses binary frame
+
+    Attributes:
+        frame: bytes of a frame encoded with codec
+        encoding: ENCODING_GORILLA, ENCODING_ZLIB, or None to use
+            whichever gives the smaller payload
+
+    Returns: bytes
+    '''
+    frame = bytes(frame)
+    decoded = codec.decode(frame)
+    # Frame header is kept as it is
+    header = frame[:codec.decode_header(frame)[-1]]
+
+    payloads = {}
+    if encoding in (None, ENCODING_GORILLA):
+        writer = BitWriter()
+        write_timestamps(writer, decoded.timestamps.tolist())
+        for column in decoded.columns:
+            write_floats(writer, column)
+        payloads[ENCODING_GORILLA] = writer.getvalue()
+    if encoding in (None, ENCODING_ZLIB):
+        payloads[ENCODING_ZLIB] = zlib.compress(frame[len(header):])
+
+    encoding = min(payloads, key=lambda x: len(payloads[x]))
+    return PREFIX.pack(MAGIC, encoding, len(header)) + header + payloads[encoding]
+
+def decompress(payload):
+    '''
+    Decompresses payload to the original binary frame
+
+    Returns: bytes, see codec.decode
+
+    Raises:
+        ValueError: if payload is not a compressed frame
+    '''
+    if not is_compressed(payload):
+        raise ValueError("Not a compressed frame")
+    _, encoding, length = PREFIX.unpack_from(payload, 0)
+    payload = bytes(payload)
+    header = payload[PREFIX.size:PREFIX.size + length]
+    offset = PREFIX.size + length
+
+    if encoding == ENCODING_ZLIB:
+        return header + zlib.decompress(payload[offset:])
+    if encoding != ENCODING_GORILLA:
+        raise ValueError(f"Unknown compression {encoding}")
+
+    _, _, _, fields, count, _ = codec.decode_header(header)
+    reader = BitReader(payload, offset)
+    timestamps = array("q", read_timestamps(reader, count))
+    parts = [header, timestamps]
+    for _ in fields:
+        parts.append(read_floats(reader, count))
+    if not codec.NATIVE:
+        for part in parts[1:]:
+            part.byteswap()
+    return b"".join(part if type(part) == bytes else part.tobytes() for part in parts)
+
+def is_compressed(payload):
+    '''Checks payload is a compressed frame'''
+    return payload[:2] == MAGIC
+
+def encoding_name(payload):
+    '''Gets name of compression of payload, sent as AMQP content_encoding'''
+    return ENCODINGS[payload[2]]
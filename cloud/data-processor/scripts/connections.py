@@ -0,0 +1,120 @@
+'''
+Connecting to brokers at startup and after outages, shared by data-injector,
+data-preprocessor and data-processor, keep the copies in each service
+identical
+
+Failed attempts are retried after exponentially growing delays with jitter,
+from tens of milliseconds up to a couple of seconds, rather than a fixed
+sleep. A broker which is already up is connected to at once and one which is
+restarting is reconnected to about as soon as it is back. Before each
+attempt the broker's port is probed with a plain TCP connect, which fails at
+once while the broker is not listening (or its name does not resolve yet)
+and costs no protocol handshake.
+
+    channel = connections.retry(open_channel, "RabbitMQ", timeout=60, probe=(ip, 5672))
+    client, channel = connections.concurrently(connect_mqtt, connect_rabbitmq)
+'''
+import time
+import random
+import socket
+from concurrent.futures import ThreadPoolExecutor
+import log
+
+logger = log.get_logger(__name__)
+
+# Seconds of the first and the longest delay between attempts
+MIN_DELAY = 0.05
+MAX_DELAY = 2.0
+
+
+class Backoff:
+    '''
+    Delays between attempts, doubling from :initial: up to :maximum: seconds
+    Each delay is drawn from the upper half of its range so services started
+    together do not retry in lockstep
+
+    Attributes:
+        initial: Seconds of the first delay
+        maximum: Seconds of the longest delay
+        factor: Growth of delay per attempt
+    '''
+    def __init__(self, initial=MIN_DELAY, maximum=MAX_DELAY, factor=2.0):
+        self.initial = initial
+        self.maximum = maximum
+        self.factor = factor
+        self.attempt = 0
+
+    def next(self):
+        '''Gets seconds to wait before the next attempt'''
+        delay = min(self.maximum, self.initial * self.factor**self.attempt)
+        # Capped so the power cannot overflow
+        self.attempt = min(self.attempt + 1, 64)
+        return delay / 2 + random.uniform(0, delay / 2)
+
+    def reset(self):
+        '''Starts from the first delay again, e.g. once connected'''
+        self.attempt = 0
+
+
+def port_open(host, port, timeout=1.0):
+    '''Checks host accepts TCP connections on port'''
+    try:
+        with socket.create_connection((host, port), timeout=timeout):
+            return True
+    except OSError:
+        return False
+
+def retry(connect, name, timeout=60, attempts=None, errors=(), probe=None, backoff=None):
+    '''
+    Calls connect until it succeeds
+
+    Attributes:
+        connect: Function opening a connection and returning it
+        name: Name of broker in logs
+        timeout: Seconds to keep trying, None for no limit
+        attempts: Maximum number of attempts, None for no limit
+        errors: Exceptions of connect to retry on besides OSError
+        probe: (host, port) which must accept TCP connections before
+            connect is called, see port_open, or None
+        backoff: Backoff of delays between attempts
+
+    Returns: return value of connect
+
+    Raises:
+        ConnectionError: if :timeout: passes or all :attempts: fail
+    '''
+    errors = (OSError,) + tuple(errors)
+    backoff = backoff or Backoff()
+    start = time.monotonic()
+    attempt = 0
+    while True:
+        attempt += 1
+        try:
+            if probe is not None and not port_open(*probe):
+                raise ConnectionRefusedError(f"{probe[0]}:{probe[1]} is not accepting connections")
+            result = connect()
+            logger.info("Connected to %s", name, extra={"fields": {
+                "attempts": attempt, "connect_s": round(time.monotonic() - start, 3)}})
+            return result
+        except errors as e:
+            error = e
+        delay = backoff.next()
+        if attempts is not None and attempt >= attempts or\
+                timeout is not None and time.monotonic() + delay - start > timeout:
+            raise ConnectionError(f"Could not connect to {name} after {attempt} attempts: {error!r}")
+        logger.warning("Could not connect to %s, trying again in %.2f seconds: %r", name, delay, error)
+        time.sleep(delay)
+
+def concurrently(*functions):
+    '''
+    Calls functions on threads at once, e.g. to connect to independent
+    brokers in parallel rather than one after the other
+
+    Returns: list of return values, in the order of functions
+
+    Raises:
+        Exception: the first of functions' exceptions, once all have returned
+    '''
+    with ThreadPoolExecutor(max_workers=len(functions), thread_name_prefix="connect") as executor:
+        futures = [executor.submit(x) for x in functions]
+        return [x.result() for x in futures]
@@ -0,0 +1,227 @@
+'''
+Continuous forecasting of series which never finish
+Each series is retrained on a sliding window of its newest windows after
+:retrain_points: new windows or :retrain_interval: seconds, on a worker
+thread so the consumer keeps receiving (and acking) messages meanwhile.
+Each fit starts from the parameters of the series' previous fit (warm
+start) and each new forecast is published to the forecast queue.
+'''
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+import pika
+from ml_engine import MLPredictor
+import subscriber
+import log
+import metrics
+
+logger = log.get_logger(__name__)
+
+PUBLISHED = metrics.counter("processor_forecasts_published_total", "Continuous forecasts published")
+FAILURES = metrics.counter("processor_forecast_failures_total", "Continuous forecasts which failed")
+TRAIN_SECONDS = metrics.histogram("processor_train_seconds",
+                                  "Time to fit and predict a series in continuous mode")
+
+DAY = 24*60*60
+
+
+class SeriesState:
+    '''Training state of one series'''
+    def __init__(self):
+        # Windows received since the last fit was started
+        self.new_points = 0
+        self.last_trained = None
+        # Fitted parameters of the last fit, see ml_engine.stan_init
+        self.params = None
+        self.training = False
+        self.fits = 0
+
+
+class ContinuousForecaster:
+    '''
+    Retrains and publishes forecasts of series as their windows arrive
+    Methods other than those run on the worker are called on the pika
+    consumer thread, which owns the channel
+
+    Attributes:
+        channel: pika channel to publish forecasts on
+        data: dict of series -> columns.SeriesColumns, shared with
+            subscriber.Callback
+        queue_name: Queue to publish forecasts to
+        train_window: Seconds of newest windows to train on, older windows
+            are dropped
+        retrain_points: New windows of a series which trigger retraining
+        retrain_interval: Seconds after which a series with any new windows
+            is retrained
+        min_points: Windows needed before a series is first trained
+        periods: Days to forecast
+        workers: Series trained at once
+        cache: model_cache.ModelCache of fitted models, or None
+        store: server.ForecastStore to serve forecasts from, or None
+        renderer: visualiser.Renderer to plot each forecast to
+            forecast-<series>.png with, or None
+    '''
+    def __init__(self, channel, data, queue_name="forecast", train_window=90*DAY,
+                 retrain_points=24, retrain_interval=3600, min_points=10,
+                 periods=15, workers=1, cache=None, store=None, renderer=None):
+        self.channel = channel
+        self.data = data
+        self.queue_name = queue_name
+        self.train_window = train_window
+        self.retrain_points = retrain_points
+        self.retrain_interval = retrain_interval
+        self.min_points = min_points
+        self.periods = periods
+        self.cache = cache
+        self.store = store
+        self.renderer = renderer
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="forecast")
+        self.states = {}
+
+        # Counters
+        self.published = 0
+        self.failures = 0
+
+    def start(self):
+        '''Checks for series due by time every second'''
+        self.channel.connection.call_later(1, self.tick)
+
+    def reattach(self, channel):
+        '''
+        Moves to channel after the connection was lost
+        Results of series in training when it was lost may never arrive, so
+        those series may be trained again
+        '''
+        self.channel = channel
+        for state in self.states.values():
+            state.training = False
+        self.start()
+
+    def tick(self):
+        for series in list(self.data):
+            self.check(series)
+        self.channel.connection.call_later(1, self.tick)
+
+    def on_data(self, series, count):
+        '''Called when :count: windows of series have been received'''
+        state = self.states.get(series)
+        if state is None:
+            state = self.states[series] = SeriesState()
+        state.new_points += count
+        self.check(series)
+
+    def check(self, series, force=False):
+        '''Starts retraining series if it is due and not already training'''
+        state = self.states.get(series)
+        if state is None or state.training or state.new_points == 0:
+            return
+        columns = self.data[series]
+        if len(columns) < self.min_points:
+            return
+        due = force or state.last_trained is None or\
+            state.new_points >= self.retrain_points or\
+            time.monotonic() - state.last_trained >= self.retrain_interval
+        if not due:
+            return
+
+        # Slide the window, the snapshot is a copy so ingest can go on
+        latest = columns.latest()
+        columns.trim(latest - self.train_window)
+        df = columns.to_dataframe()[["Timestamp", "Value"]].dropna()
+
+        state.training = True
+        state.new_points = 0
+        state.last_trained = time.monotonic()
+        self.executor.submit(self.train, series, df, state.params)
+
+    def retrain_all(self):
+        '''Retrains every series with new windows, e.g. on a finished token'''
+        for series in list(self.data):
+            self.check(series, force=True)
+
+    def train(self, series, df, init):
+        '''
+        Runs on the worker, fits series and hands the forecast to the
+        consumer thread to publish
+        '''
+        start = time.monotonic()
+        # MLPredictor renames the columns of df
+        last = df["Timestamp"].max()
+        points = len(df)
+        try:
+            model = MLPredictor(df, periods=self.periods, cache=self.cache)
+            try:
+                model.train(init=init)
+            except Exception:
+                if init is None:
+                    raise
+                # e.g. the window grew a changepoint, fit from scratch
+                logger.warning("Warm start of %s failed, fitting from scratch", series)
+                init = None
+                model = MLPredictor(df, periods=self.periods, cache=self.cache)
+                model.train()
+            forecast = model.predict()
+            params = model.fitted_params()
+            if self.renderer is not None:
+                self.renderer.plot_forecast(df, forecast, f"forecast-{series}.png")
+        except Exception:
+            logger.exception("Forecast of %s failed", series)
+            self.channel.connection.add_callback_threadsafe(lambda: self.on_failed(series))
+            return
+        elapsed = time.monotonic() - start
+        TRAIN_SECONDS.observe(elapsed)
+        logger.info("Trained %s", series, extra={"fields": {
+            "series": series, "points": points, "warm_start": init is not None,
+            "train_s": round(elapsed, 3)}})
+        # pika channels are not thread safe, publish on the consumer thread
+        self.channel.connection.add_callback_threadsafe(
+            lambda: self.on_trained(series, points, last, forecast, params))
+
+    def on_trained(self, series, points, last, forecast, params):
+        '''Publishes forecast of series, called on the consumer thread'''
+        state = self.states[series]
+        state.training = False
+        state.params = params
+        state.fits += 1
+
+        future = forecast[forecast["ds"] > last]
+        msg = {
+            "series": series,
+            "trained_on": points,
+            "last_timestamp": int(last.timestamp()),
+            "forecast": [[int(row.ds.timestamp()), row.yhat, row.yhat_lower, row.yhat_upper]
+                         for row in future[["ds", "yhat", "yhat_lower", "yhat_upper"]].itertuples()],
+        }
+        subscriber.declare_queue(self.channel, self.queue_name)
+        self.channel.basic_publish(exchange='',
+                                   routing_key=self.queue_name,
+                                   body=json.dumps(msg),
+                                   properties=pika.BasicProperties(
+                                       content_type="application/json",
+                                       headers={"series": series}))
+        self.published += 1
+        PUBLISHED.inc()
+        if self.store is not None:
+            self.store.update(series, forecast)
+        # Windows which arrived during training may already be due
+        self.check(series)
+
+    def on_failed(self, series):
+        '''Lets series be retrained after a failed fit'''
+        self.states[series].training = False
+        self.failures += 1
+        FAILURES.inc()
+
+    def stats(self):
+        stats = {
+            "series": len(self.states),
+            "fits": sum(x.fits for x in self.states.values()),
+            "published": self.published,
+            "failures": self.failures,
+        }
+        if self.cache is not None:
+            stats["cache"] = self.cache.stats()
+        return stats
+
+    def close(self):
+        self.executor.shutdown(wait=True)
@@ -0,0 +1,158 @@
+'''
+Structured logging shared by data-injector, data-preprocessor and
+data-processor, keep the copies in each service identical
+
+Records are written as JSON lines by a background thread, logging calls
+only put the record on a queue. Each line holds the time, level, service,
+logger and message plus any fields given with extra={"fields": {...}}
+
+Configured by environment:
+    LOG_LEVEL       DEBUG, INFO, WARNING or ERROR, defaults to INFO
+    LOG_FORMAT      json, or text for plain lines when debugging
+    LOG_RATE_LIMIT  Records per second of each message, later records of
+                    the message are dropped until the next second and
+                    counted in "suppressed" of the next record, 0 for no limit
+
+Per-message events are logged at DEBUG and cost a level check when DEBUG is
+off. Hot paths building fields guard them with logger.isEnabledFor.
+'''
+import os
+import sys
+import json
+import time
+import queue
+import atexit
+import logging
+import threading
+from logging.handlers import QueueHandler, QueueListener
+
+DEFAULT_LEVEL = "INFO"
+DEFAULT_RATE_LIMIT = 20
+# Distinct messages counted by the rate limit
+MAX_MESSAGES = 10000
+
+_listener = None
+
+
+class JsonFormatter(logging.Formatter):
+    '''Formats record as one JSON object per line'''
+    def __init__(self, service):
+        super().__init__()
+        self.service = service
+
+    def format(self, record):
+        line = {
+            "ts": time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(record.created))
+                  + f".{int(record.msecs):03d}Z",
+            "level": record.levelname,
+            "service": self.service,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        fields = getattr(record, "fields", None)
+        if fields:
+            line.update(fields)
+        suppressed = getattr(record, "suppressed", 0)
+        if suppressed:
+            line["suppressed"] = suppressed
+        if record.exc_info:
+            line["exc"] = self.formatException(record.exc_info)
+        return json.dumps(line, default=str)
+
+
+class TextFormatter(logging.Formatter):
+    '''Formats record as a plain line with its fields'''
+    def __init__(self, service):
+        super().__init__(f"%(asctime)s {service} %(levelname)s %(name)s: %(message)s")
+
+    def format(self, record):
+        line = super().format(record)
+        fields = getattr(record, "fields", None)
+        if fields:
+            line += " " + " ".join(f"{k}={v}" for k, v in fields.items())
+        suppressed = getattr(record, "suppressed", 0)
+        if suppressed:
+            line += f" (suppressed {suppressed})"
+        return line
+
+
+class RateLimitFilter(logging.Filter):
+    '''
+    Passes at most :rate: records of each message (logger and format string)
+    per second, the number dropped is added to the next record passed
+    '''
+    def __init__(self, rate):
+        super().__init__()
+        self.rate = rate
+        # (logger, msg) -> [second, records passed, records dropped]
+        self.counts = {}
+        self.lock = threading.Lock()
+
+    def filter(self, record):
+        key = (record.name, record.msg)
+        second = int(record.created)
+        with self.lock:
+            # Messages should be format strings, but don't grow without bound
+            # if they are not
+            if len(self.counts) > MAX_MESSAGES:
+                self.counts.clear()
+            count = self.counts.get(key)
+            if count is None or count[0] != second:
+                dropped = count[2] if count is not None else 0
+                count = self.counts[key] = [second, 0, dropped]
+            if count[1] >= self.rate:
+                count[2] += 1
+                return False
+            count[1] += 1
+            record.suppressed, count[2] = count[2], 0
+        return True
+
+
+def setup(service, level=None, fmt=None, rate_limit=None, stream=None):
+    '''
+    Configures the root logger to write through a background thread
+    Called once at start up by each service's main, settings default to the
+    environment
+
+    Attributes:
+        service: Name of service written in each record
+        level: Log level, defaults to LOG_LEVEL
+        fmt: "json" or "text", defaults to LOG_FORMAT
+        rate_limit: Records per second of each message, defaults to
+            LOG_RATE_LIMIT
+        stream: Stream to write to, defaults to stdout
+    '''
+    global _listener
+    level = level or os.environ.get("LOG_LEVEL", DEFAULT_LEVEL)
+    fmt = fmt or os.environ.get("LOG_FORMAT", "json")
+    if rate_limit is None:
+        rate_limit = int(os.environ.get("LOG_RATE_LIMIT", DEFAULT_RATE_LIMIT))
+
+    output = logging.StreamHandler(stream or sys.stdout)
+    output.setFormatter(JsonFormatter(service) if fmt == "json" else TextFormatter(service))
+
+    records = queue.Queue()
+    handler = QueueHandler(records)
+    if rate_limit > 0:
+        handler.addFilter(RateLimitFilter(rate_limit))
+
+    root = logging.getLogger()
+    root.handlers = [handler]
+    root.setLevel(level.upper())
+
+    if _listener is not None:
+        _listener.stop()
+    _listener = QueueListener(records, output)
+    _listener.start()
+    atexit.register(shutdown)
+
+def shutdown():
+    '''Writes queued records and stops the background thread'''
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+def get_logger(name):
+    '''Gets logger of module, records go to the root logger set up by setup()'''
+    return logging.getLogger(name)
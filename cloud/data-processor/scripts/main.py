@@ -1,51 +1,195 @@
-from socket import socket
-import pika
+import os
 import subscriber
 import time
+import threading
 import visualiser
 import utils
-from ml_engine import MLPredictor
+from ml_engine import MLPredictor, forecast_many
+from forecasting import ContinuousForecaster, DAY
+from model_cache import ModelCache
+import server
+from store import Store
+import log
+import metrics
+
+logger = log.get_logger("main")
 
 RABBITMQ_ALIAS = "rabbitmq-broker"
+# Series (sensor ID) to forecast, defaults to the first series received,
+# "all" forecasts every series across a pool of worker processes
+FORECAST_SERIES = os.environ.get("FORECAST_SERIES")
+# Worker processes forecasting all series, defaults to the CPU count
+FORECAST_PROCESSES = int(os.environ.get("FORECAST_PROCESSES", 0)) or None
+# Address space limit of each worker process in MB, 0 for none
+FORECAST_WORKER_MEMORY_MB = float(os.environ.get("FORECAST_WORKER_MEMORY_MB", 0))
+# batch: forecast once after the finished token, continuous: keep consuming
+# and retrain each series as its windows arrive, see forecasting
+MODE = os.environ.get("MODE", "batch")
+# Days of newest windows each continuous forecast is trained on
+TRAIN_WINDOW_DAYS = float(os.environ.get("TRAIN_WINDOW_DAYS", 90))
+# New windows of a series which trigger retraining
+RETRAIN_POINTS = int(os.environ.get("RETRAIN_POINTS", 24))
+# Seconds after which a series with new windows is retrained
+RETRAIN_INTERVAL = float(os.environ.get("RETRAIN_INTERVAL", 3600))
+# Days to forecast
+FORECAST_PERIODS = int(os.environ.get("FORECAST_PERIODS", 15))
+# Queue continuous forecasts are published to
+FORECAST_QUEUE = os.environ.get("FORECAST_QUEUE", "forecast")
+# Directory of fitted models reused across runs, empty to always fit
+MODEL_CACHE_DIR = os.environ.get("MODEL_CACHE_DIR", "model-cache")
+MODEL_CACHE_MAX_ENTRIES = int(os.environ.get("MODEL_CACHE_MAX_ENTRIES", 32))
+MODEL_CACHE_MAX_MB = float(os.environ.get("MODEL_CACHE_MAX_MB", 256))
+# Fraction of rows appended since a cached model was fitted for it to be used
+MODEL_CACHE_APPEND_TOLERANCE = float(os.environ.get("MODEL_CACHE_APPEND_TOLERANCE", 0.05))
+# Limits of the model cache, of this process and of forecast_many workers
+MODEL_CACHE_OPTIONS = {
+    "max_entries": MODEL_CACHE_MAX_ENTRIES,
+    "max_bytes": int(MODEL_CACHE_MAX_MB*1024*1024),
+    "append_tolerance": MODEL_CACHE_APPEND_TOLERANCE,
+}
+# SQLite database received windows are kept in, see store, empty to keep
+# them in memory only
+STORE_PATH = os.environ.get("STORE_PATH", "aggregates.db")
+# Windows buffered before they are written to the store
+STORE_BATCH_ROWS = int(os.environ.get("STORE_BATCH_ROWS", 1000))
+# Port forecasts are served on over HTTP, see server, 0 to not serve
+SERVE_PORT = int(os.environ.get("SERVE_PORT", 8000))
+# Port metrics are served on in the Prometheus text format, 0 to not serve
+METRICS_PORT = int(os.environ.get("METRICS_PORT", 9100))
  
+def wait(http):
+    '''
+    Keeps the container up, forever while serving forecasts, otherwise for
+    3 mins to pull images
+    '''
+    if http is not None:
+        logger.info("Finished processing... serving forecasts until stopped")
+        threading.Event().wait()
+    t = 180
+    logger.info("Finished processing... waiting for %ds before shutting down", t)
+    time.sleep(t)
+
+def instrument(renderer, cache):
+    '''Exposes plots waiting in renderer and counters of cache as gauges'''
+    pending = metrics.gauge("processor_plots_pending", "Plots waiting to be rendered")
+    pending.set_function(lambda: len(renderer.pending))
+    if cache is not None:
+        cache_stats = metrics.gauge("processor_model_cache", "Model cache counters", ["counter"])
+        for name in ("entries", "bytes", "hits", "append_hits", "misses", "evictions"):
+            cache_stats.labels(name).set_function(lambda name=name: cache.stats()[name])
+
+def forecast_all(data, forecasts, renderer):
+    '''
+    Forecasts every received series across worker processes, saving each
+    forecast to forecast-<series>.csv as it completes
+    '''
+    frames = {series: utils.parse_data(columns) for series, columns in data.items()}
+    failed = 0
+    for series, forecast, error, seconds in forecast_many(
+            frames, processes=FORECAST_PROCESSES, periods=FORECAST_PERIODS,
+            max_memory_mb=FORECAST_WORKER_MEMORY_MB,
+            cache_dir=MODEL_CACHE_DIR or None,
+            cache_options=MODEL_CACHE_OPTIONS):
+        if error is not None:
+            failed += 1
+            continue
+        out = f"forecast-{series}.csv"
+        forecast[["ds", "yhat", "yhat_lower", "yhat_upper"]].to_csv(out, index=False)
+        forecasts.update(series, forecast)
+        renderer.plot_forecast(frames[series], forecast, f"forecast-{series}.png")
+        logger.info("Forecasted %s", series, extra={"fields": {
+            "series": series, "seconds": round(seconds, 3), "out": out}})
+    logger.info("Forecasted %d series, %d failed", len(frames) - failed, failed)
+
 if __name__ == '__main__':
+    log.setup("data-processor")
+    if METRICS_PORT:
+        metrics.serve(METRICS_PORT)
+
+    cache = None
+    if MODEL_CACHE_DIR:
+        cache = ModelCache(MODEL_CACHE_DIR, **MODEL_CACHE_OPTIONS)
+
+    forecasts = server.ForecastStore()
+    windows = Store(STORE_PATH, batch_rows=STORE_BATCH_ROWS) if STORE_PATH else None
+    # Plots are rendered by a worker process, see visualiser
+    renderer = visualiser.Renderer()
+    http = server.serve(forecasts, SERVE_PORT) if SERVE_PORT else None
+    instrument(renderer, cache)
+
     # Connect to broker
-    print("Connecting to RabbitMQ broker", flush=True)
-    rabbitmq_channel = subscriber.connect_to_rabbitmq(RABBITMQ_ALIAS, socket_timeout=150)
+    logger.info("Connecting to RabbitMQ broker")
+    def connect():
+        return subscriber.connect_to_rabbitmq(RABBITMQ_ALIAS, socket_timeout=150)
+    rabbitmq_channel = connect()
 
     # Send heartbeat message
-    print("Sending Heartbeat message to data-preprocessor", flush=True)
+    logger.info("Sending Heartbeat message to data-preprocessor")
     subscriber.publish_to_rabbitmq(rabbitmq_channel, "heartbeat", "ack")
 
     # Subscribe to topic CSC8112
     queue_name = "CSC8112"
-    print(f"Subscribing to queue {queue_name}", flush=True)
-    callback_data = subscriber.rabbitmq_subscribe_to_queue(rabbitmq_channel, queue_name)
+    logger.info("Subscribing to queue %s", queue_name)
+    if MODE == "continuous":
+        def forecaster(data):
+            return ContinuousForecaster(rabbitmq_channel, data,
+                                        queue_name=FORECAST_QUEUE,
+                                        train_window=TRAIN_WINDOW_DAYS*DAY,
+                                        retrain_points=RETRAIN_POINTS,
+                                        retrain_interval=RETRAIN_INTERVAL,
+                                        periods=FORECAST_PERIODS,
+                                        cache=cache,
+                                        store=forecasts,
+                                        renderer=renderer)
+        # Consumes until the container is stopped
+        # Windows kept from before a restart are trained on at once
+        subscriber.rabbitmq_subscribe_to_queue(rabbitmq_channel, queue_name, forecaster=forecaster,
+                                               store=windows, restore_days=TRAIN_WINDOW_DAYS,
+                                               connect=connect)
+        raise SystemExit
+
+    callback_data = subscriber.rabbitmq_subscribe_to_queue(rabbitmq_channel, queue_name, store=windows,
+                                                           connect=connect)
     # Close connection once data recieved
-    rabbitmq_channel.close()
+    # (note) the channel is replaced when RabbitMQ reconnects
+    callback_data.channel.close()
+
+    if FORECAST_SERIES == "all":
+        forecast_all(callback_data.data, forecasts, renderer)
+        renderer.close()
+        wait(http)
+        raise SystemExit
     
+    # Pick series to forecast, defaults to the first series received
+    series = FORECAST_SERIES or next(iter(callback_data.data), None)
+    if series not in callback_data.data:
+        logger.error("No data received for %s before the finished token, nothing to forecast",
+                     series or "any series")
+        renderer.close()
+        raise SystemExit(1)
+    logger.info("Received %d series, forecasting %s", len(callback_data.data), series)
+
     # Parse data to dataframe and print
-    print("Parsing data for machine learning model", flush=True)
-    data = utils.parse_data(callback_data.data)
+    logger.info("Parsing data for machine learning model")
+    data = utils.parse_data(callback_data.data[series])
 
-    print("Plotting original data", flush=True)
-    visualiser.plot_data(data, out="original.png")
+    logger.info("Plotting original data")
+    renderer.plot_data(data, out="original.png")
 
     # Predict 
-    model = MLPredictor(data)
-    print("Training model", flush=True)
+    model = MLPredictor(data, periods=FORECAST_PERIODS, cache=cache)
+    logger.info("Training model")
     model.train()
-    print("Predicting from model", flush=True)
+    logger.info("Predicting from model")
     forecast = model.predict()
+    forecasts.update(series, forecast)
+    if cache is not None:
+        logger.info("Model cache", extra={"fields": cache.stats()})
 
     # Plot data
-    print("Plotting forecasted results", flush=True)
-    fig = model.plot_result(forecast)
-    print(f"Saving images to forecast.png", flush=True)
-    fig.savefig("forecast.png")
+    logger.info("Plotting forecasted results")
+    renderer.plot_forecast(data, forecast, out="forecast.png")
+    renderer.close()
 
-    # Waiting 3 mins before ending docker container to pull images
-    t = 180
-    print(f"Finished processing... waiting for {t}s before shutting down",flush=True)
-    time.sleep(t)
+    wait(http)
     
\ No newline at end of file
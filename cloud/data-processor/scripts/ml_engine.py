@@ -6,7 +6,26 @@
 
     Official guide book of Prophet: https://facebook.github.io/prophet/docs/quick_start.html#python-api
 '''
+import os
+import math
+import time
+import traceback
+import multiprocessing
 from prophet import Prophet
+import visualiser
+import log
+import metrics
+
+logger = log.get_logger(__name__)
+
+FIT_SECONDS = metrics.histogram("processor_fit_seconds", "Time to fit a model")
+PREDICT_SECONDS = metrics.histogram("processor_predict_seconds", "Time to predict from a model")
+CACHE_LOAD_SECONDS = metrics.histogram("processor_model_cache_load_seconds",
+                                       "Time to look up and load a cached model")
+FORECAST_SECONDS = metrics.histogram("processor_forecast_seconds",
+                                     "Time for a worker process to forecast a series")
+FORECASTS = metrics.counter("processor_forecasts_total", "Series forecast by worker processes, by outcome",
+                            ["outcome"])
 
 
 class MLPredictor(object):
@@ -25,19 +44,56 @@ class MLPredictor(object):
 
     '''
 
-    def __init__(self, data_df):
+    def __init__(self, data_df, changepoint_prior_scale=12, periods=15, cache=None):
         '''
         :param data_df: Dataframe type dataset
+        :param changepoint_prior_scale: Flexibility of the trend
+        :param periods: Days to forecast
+        :param cache: model_cache.ModelCache to load fitted models from and
+            save them to, or None to always fit
         '''
         self.__train_data = self.__convert_col_name(data_df)
-        self.__trainer = Prophet(changepoint_prior_scale=12)
+        self.__trainer = Prophet(changepoint_prior_scale=changepoint_prior_scale)
+        self.periods = periods
+        self.hyperparameters = {"changepoint_prior_scale": changepoint_prior_scale, "periods": periods}
+        self.cache = cache
+        # Rows the model was fitted on, fewer than the training data if a
+        # cached model of a prefix was loaded
+        self.fitted_rows = None
+
+    def train(self, init=None):
+        '''
+        Fits the model, or loads it from the cache if given
+        :param init: Parameters of a previously fitted model to start
+            optimising from (warm start), see stan_init
+        '''
+        if self.cache is not None:
+            with CACHE_LOAD_SECONDS.time():
+                cached = self.cache.load(self.__train_data, self.hyperparameters)
+            if cached is not None:
+                self.__trainer, self.fitted_rows = cached
+                return
+
+        start = time.monotonic()
+        if init is None:
+            self.__trainer.fit(self.__train_data)
+        else:
+            # Parameters whose shape no longer matches are reset by Prophet
+            self.__trainer.fit(self.__train_data, init=init)
+        self.fitted_rows = len(self.__train_data)
+        FIT_SECONDS.observe(time.monotonic() - start)
+
+        if self.cache is not None:
+            self.cache.store(self.__train_data, self.hyperparameters, self.__trainer,
+                             time.monotonic() - start)
 
-    def train(self):
-        self.__trainer.fit(self.__train_data)
+    def fitted_params(self):
+        '''Gets fitted parameters to warm start the next fit with'''
+        return stan_init(self.__trainer)
 
     def __convert_col_name(self, data_df):
         data_df.rename(columns={"Timestamp": "ds", "Value": "y"}, inplace=True)
-        print(f"After rename columns \n{data_df.columns}")
+        logger.debug("After rename columns %s", list(data_df.columns))
         return data_df
 
     def __make_future(self, periods=15):
@@ -45,10 +101,119 @@ class MLPredictor(object):
         return future
 
     def predict(self):
-        future = self.__make_future()
-        forecast = self.__trainer.predict(future)
+        periods = self.periods
+        # A cached model of a prefix forecasts from the end of the prefix,
+        # extend it to cover the days appended since
+        appended = self.__train_data["ds"].max() - self.__trainer.history_dates.max()
+        if appended.total_seconds() > 0:
+            periods += math.ceil(appended.total_seconds() / (24*60*60))
+        with PREDICT_SECONDS.time():
+            future = self.__make_future(periods)
+            forecast = self.__trainer.predict(future)
         return forecast
 
     def plot_result(self, forecast):
-        fig = self.__trainer.plot(forecast, figsize=(15, 6))
+        '''Draws forecast with the training data, see visualiser.forecast_figure'''
+        fig = visualiser.forecast_figure(
+            self.__train_data["ds"].values, self.__train_data["y"].values,
+            *(forecast[x].values for x in ("ds", "yhat", "yhat_lower", "yhat_upper")))
         return fig
+
+
+def stan_init(model):
+    '''
+    Gets fitted parameters of a Prophet model in the form fit(init=...) takes
+    https://facebook.github.io/prophet/docs/additional_topics.html#updating-fitted-models
+    '''
+    res = {}
+    for pname in ['k', 'm', 'sigma_obs']:
+        res[pname] = model.params[pname][0][0]
+    for pname in ['delta', 'beta']:
+        res[pname] = model.params[pname][0]
+    return res
+
+
+# Settings of forecast_many workers, set by _init_worker
+_worker = {}
+
+
+def _init_worker(max_memory, cache_dir, cache_options, log_level):
+    '''
+    Sets up a forecast_many worker process
+    Limits its address space so a series which needs too much memory fails
+    with MemoryError rather than exhausting the host
+    '''
+    log.setup("data-processor-worker", level=log_level)
+    if max_memory:
+        import resource
+        resource.setrlimit(resource.RLIMIT_AS, (max_memory, max_memory))
+    cache = None
+    if cache_dir:
+        from model_cache import ModelCache
+        cache = ModelCache(cache_dir, **cache_options)
+    _worker["cache"] = cache
+
+def _forecast_one(task):
+    '''
+    Fits and predicts one series in a worker
+
+    Returns: tuple of series, forecast DataFrame or None, error or None and
+        seconds taken
+    '''
+    series, data_df, changepoint_prior_scale, periods = task
+    start = time.monotonic()
+    try:
+        model = MLPredictor(data_df, changepoint_prior_scale=changepoint_prior_scale,
+                            periods=periods, cache=_worker.get("cache"))
+        model.train()
+        forecast = model.predict()
+    except Exception as e:
+        # MemoryError included, the worker is replaced after maxtasksperchild
+        return series, None, f"{e!r}\n{traceback.format_exc()}", time.monotonic() - start
+    return series, forecast, None, time.monotonic() - start
+
+def forecast_many(series, processes=None, changepoint_prior_scale=12, periods=15,
+                  max_memory_mb=None, maxtasksperchild=10, cache_dir=None, cache_options=None,
+                  log_level="WARNING"):
+    '''
+    Fits and predicts many series across a pool of worker processes
+    Results are yielded as each series completes, in completion order. A
+    series which fails (e.g. too little data or too much memory) yields its
+    error and does not affect the others
+
+    Attributes:
+        series: dict of series name -> DataFrame of Timestamp and Value
+            columns, or iterable of (name, DataFrame)
+        processes: Number of worker processes, defaults to the CPU count
+        changepoint_prior_scale: Flexibility of the trend
+        periods: Days to forecast
+        max_memory_mb: Limit of each worker's address space, None for none
+        maxtasksperchild: Series fitted by a worker before it is replaced,
+            returning memory Prophet and Stan keep hold of
+        cache_dir: Directory of a model_cache.ModelCache shared by the
+            workers, or None
+        cache_options: dict of keyword arguments of the workers'
+            ModelCache, e.g. max_entries and max_bytes
+        log_level: Log level of workers
+
+    Returns: generator of tuples of series name, forecast DataFrame or None,
+        error string or None, and seconds the series took
+    '''
+    if hasattr(series, "items"):
+        series = series.items()
+    tasks = ((name, df, changepoint_prior_scale, periods) for name, df in series)
+    processes = processes or os.cpu_count() or 1
+    max_memory = int(max_memory_mb*1024*1024) if max_memory_mb else None
+
+    # Spawned workers do not inherit the parent's threads (e.g. the log
+    # listener) or locks
+    context = multiprocessing.get_context("spawn")
+    with context.Pool(processes, initializer=_init_worker,
+                      initargs=(max_memory, cache_dir, cache_options or {}, log_level),
+                      maxtasksperchild=maxtasksperchild) as pool:
+        for result in pool.imap_unordered(_forecast_one, tasks):
+            FORECASTS.labels("failed" if result[2] is not None else "ok").inc()
+            FORECAST_SECONDS.observe(result[3])
+            if result[2] is not None:
+                logger.warning("Forecast of %s failed: %s", result[0], result[2].splitlines()[0])
+            yield result
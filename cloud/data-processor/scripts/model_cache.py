@@ -0,0 +1,251 @@
+'''
+Cache of fitted Prophet models on local disk
+Fitting is the most expensive step of data-processor, a model fitted on the
+same data with the same hyperparameters is loaded instead, also after a
+restart. A model fitted on a prefix of the data, missing at most
+:append_tolerance: of its newest rows, is used too.
+
+Models are keyed by a fingerprint of the training data (sha256 of the ds and
+y columns) and the hyperparameters. Least recently used models are evicted
+once the cache holds more than :max_entries: models or :max_bytes: bytes.
+
+Directory layout:
+    <key>.model     model serialised by prophet.serialize.model_to_json
+    <key>.meta      JSON of hyperparameters, rows, data fingerprint and fit
+                    time, its mtime is the time the model was last used
+Files are replaced atomically so a crash never leaves a partial model.
+'''
+import os
+import json
+import time
+import hashlib
+import tempfile
+import threading
+import numpy as np
+from prophet.serialize import model_to_json, model_from_json
+import log
+
+logger = log.get_logger(__name__)
+
+MODEL_SUFFIX = ".model"
+META_SUFFIX = ".meta"
+
+
+def data_fingerprint(df, rows=None):
+    '''
+    Gets sha256 of the ds and y columns of the first :rows: rows of df, all
+    rows if None
+    '''
+    rows = len(df) if rows is None else rows
+    digest = hashlib.sha256()
+    ds = df["ds"].values[:rows].astype("datetime64[ns]").view(np.int64)
+    digest.update(np.ascontiguousarray(ds).tobytes())
+    digest.update(np.ascontiguousarray(df["y"].values[:rows], dtype=np.float64).tobytes())
+    return digest.hexdigest()
+
+
+def params_key(params):
+    '''Gets canonical string of hyperparameters'''
+    return json.dumps(params, sort_keys=True)
+
+
+def cache_key(fingerprint, params):
+    return hashlib.sha256((params_key(params) + fingerprint).encode()).hexdigest()[:32]
+
+
+class ModelCache:
+    '''
+    Fitted models on disk keyed by training data and hyperparameters
+    Safe to use from several threads
+
+    Attributes:
+        directory: Directory to keep models in, created if needed
+        max_entries: Maximum number of models kept
+        max_bytes: Maximum total size of models kept
+        append_tolerance: Fraction of rows which may have been appended to
+            the data a model was fitted on for it to be used, 0 for exact
+            matches only
+    '''
+    def __init__(self, directory, max_entries=32, max_bytes=256*1024*1024, append_tolerance=0.05):
+        self.directory = directory
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.append_tolerance = append_tolerance
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        # key -> metadata, "used" is the time the model was last used
+        self.entries = self._scan()
+
+        # Counters
+        self.hits = 0
+        self.append_hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+        self.errors = 0
+        self.fit_seconds_saved = 0.0
+
+    def _path(self, key, suffix):
+        return os.path.join(self.directory, key + suffix)
+
+    def _scan(self):
+        '''Reads metadata of models already in the directory'''
+        entries = {}
+        for name in os.listdir(self.directory):
+            if not name.endswith(META_SUFFIX):
+                continue
+            key = name[:-len(META_SUFFIX)]
+            path = self._path(key, META_SUFFIX)
+            try:
+                with open(path) as f:
+                    meta = json.load(f)
+                meta["used"] = os.path.getmtime(path)
+                if not os.path.exists(self._path(key, MODEL_SUFFIX)):
+                    raise ValueError("missing model")
+            except (OSError, ValueError) as e:
+                logger.warning("Dropping cached model %s: %r", key, e)
+                self._remove_files(key)
+                continue
+            entries[key] = meta
+        return entries
+
+    def load(self, df, params):
+        '''
+        Gets model fitted on df, or on a prefix of df within the append
+        tolerance, with hyperparameters params
+
+        Attributes:
+            df: Training data with ds and y columns
+            params: dict of hyperparameters
+
+        Returns: tuple of Prophet model and the number of rows it was fitted
+            on, or None if no model is cached
+        '''
+        rows = len(df)
+        fingerprint = data_fingerprint(df)
+        key = cache_key(fingerprint, params)
+        with self.lock:
+            if key in self.entries:
+                candidates = [key]
+            else:
+                # Models of a prefix of df, newest first
+                pkey = params_key(params)
+                candidates = sorted(
+                    (k for k, meta in self.entries.items()
+                     if meta["params"] == pkey and meta["rows"] < rows
+                     and rows - meta["rows"] <= self.append_tolerance*rows),
+                    key=lambda k: -self.entries[k]["rows"])
+            candidates = [(k, dict(self.entries[k])) for k in candidates]
+
+        for candidate, meta in candidates:
+            if candidate != key and data_fingerprint(df, meta["rows"]) != meta["fingerprint"]:
+                continue
+            try:
+                with open(self._path(candidate, MODEL_SUFFIX)) as f:
+                    model = model_from_json(f.read())
+            except Exception as e:
+                logger.warning("Could not load cached model %s: %r", candidate, e)
+                with self.lock:
+                    self.errors += 1
+                    self._evict(candidate)
+                continue
+            with self.lock:
+                if candidate == key:
+                    self.hits += 1
+                else:
+                    self.append_hits += 1
+                self.fit_seconds_saved += meta["fit_s"]
+                self._touch(candidate)
+            logger.info("Loaded cached model %s", candidate, extra={"fields": {
+                "rows": meta["rows"], "appended": rows - meta["rows"]}})
+            return model, meta["rows"]
+
+        with self.lock:
+            self.misses += 1
+        return None
+
+    def store(self, df, params, model, fit_seconds):
+        '''
+        Saves model fitted on df with hyperparameters params, evicting least
+        recently used models if the cache is full
+        '''
+        fingerprint = data_fingerprint(df)
+        key = cache_key(fingerprint, params)
+        try:
+            body = model_to_json(model)
+        except Exception as e:
+            logger.warning("Could not serialise model: %r", e)
+            with self.lock:
+                self.errors += 1
+            return
+        meta = {
+            "params": params_key(params),
+            "rows": len(df),
+            "fingerprint": fingerprint,
+            "fit_s": round(fit_seconds, 3),
+            "bytes": len(body),
+        }
+        self._write(self._path(key, MODEL_SUFFIX), body)
+        self._write(self._path(key, META_SUFFIX), json.dumps(meta))
+        with self.lock:
+            meta["used"] = time.time()
+            self.entries[key] = meta
+            self.stores += 1
+            while len(self.entries) > 1 and (
+                    len(self.entries) > self.max_entries or self._bytes() > self.max_bytes):
+                self._evict(min((k for k in self.entries if k != key),
+                                key=lambda k: self.entries[k]["used"]))
+
+    def _write(self, path, body):
+        '''
+        Writes file, replaced atomically
+        The temporary file is unique so processes sharing the directory
+        (e.g. forecast_many workers) never write to the same one
+        '''
+        fd, tmp = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w") as f:
+                f.write(body)
+            os.replace(tmp, path)
+        except BaseException:
+            os.remove(tmp)
+            raise
+
+    def _touch(self, key):
+        '''Marks model as used now, kept in the mtime of its metadata'''
+        self.entries[key]["used"] = time.time()
+        try:
+            os.utime(self._path(key, META_SUFFIX))
+        except OSError:
+            pass
+
+    def _evict(self, key):
+        self.entries.pop(key, None)
+        self._remove_files(key)
+        self.evictions += 1
+
+    def _remove_files(self, key):
+        for suffix in (META_SUFFIX, MODEL_SUFFIX):
+            try:
+                os.remove(self._path(key, suffix))
+            except OSError:
+                pass
+
+    def _bytes(self):
+        return sum(meta["bytes"] for meta in self.entries.values())
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.append_hits + self.misses
+            return {
+                "entries": len(self.entries),
+                "bytes": self._bytes(),
+                "hits": self.hits,
+                "append_hits": self.append_hits,
+                "misses": self.misses,
+                "hit_rate": round((self.hits + self.append_hits) / lookups, 3) if lookups else 0.0,
+                "stores": self.stores,
+                "evictions": self.evictions,
+                "errors": self.errors,
+                "fit_s_saved": round(self.fit_seconds_saved, 3),
+            }
@@ -0,0 +1,182 @@
+'''
+HTTP/JSON serving of the latest forecasts of data-processor
+Forecasts are held in memory and their JSON is built once when a forecast
+is produced, so a request is a lookup and never triggers model work.
+
+    GET /health                     200 once the server is up
+    GET /forecasts                  series with a forecast and their ETags
+    GET /forecasts/<series>         latest forecast of series
+        ?start=<unix s>&end=<unix s>    only rows with start <= ds < end
+
+A forecast is returned as columns of ds (unix seconds), yhat, yhat_lower
+and yhat_upper. Responses carry an ETag which changes with each new
+forecast, requests with a matching If-None-Match get 304 Not Modified.
+'''
+import json
+import time
+import hashlib
+import threading
+from urllib.parse import urlsplit, parse_qs, unquote
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import numpy as np
+import log
+
+logger = log.get_logger(__name__)
+
+COLUMNS = ("yhat", "yhat_lower", "yhat_upper")
+# Range responses kept per forecast
+MAX_RANGES = 256
+
+
+class Forecast:
+    '''
+    Latest forecast of a series with its precomputed JSON
+
+    Attributes:
+        series: Name of series
+        ds: int64 array of forecast timestamps in unix seconds, ascending
+        columns: dict of column name -> float64 array, see COLUMNS
+        trained_at: Unix time the forecast was produced
+    '''
+    def __init__(self, series, ds, columns, trained_at):
+        self.series = series
+        self.ds = ds
+        self.columns = columns
+        self.trained_at = trained_at
+        self.body = self._encode(slice(None))
+        self.etag = '"' + hashlib.sha1(self.body).hexdigest()[:20] + '"'
+        # (start, end) -> (body, etag)
+        self.ranges = {}
+        self.lock = threading.Lock()
+
+    def _encode(self, rows):
+        msg = {
+            "series": self.series,
+            "trained_at": self.trained_at,
+            "ds": self.ds[rows].tolist(),
+        }
+        for name in COLUMNS:
+            msg[name] = [None if np.isnan(x) else x for x in self.columns[name][rows].tolist()]
+        return json.dumps(msg, separators=(",", ":")).encode()
+
+    def get(self, start=None, end=None):
+        '''
+        Gets JSON body and ETag of rows with start <= ds < end
+        Rows are found by binary search, bodies of ranges are cached until
+        the forecast is replaced
+        '''
+        if start is None and end is None:
+            return self.body, self.etag
+        key = (start, end)
+        with self.lock:
+            cached = self.ranges.get(key)
+        if cached is not None:
+            return cached
+        lo = 0 if start is None else int(np.searchsorted(self.ds, start, "left"))
+        hi = len(self.ds) if end is None else int(np.searchsorted(self.ds, end, "left"))
+        body = self._encode(slice(lo, hi))
+        cached = body, f'{self.etag[:-1]}-{lo}-{hi}"'
+        with self.lock:
+            if len(self.ranges) >= MAX_RANGES:
+                self.ranges.clear()
+            self.ranges[key] = cached
+        return cached
+
+
+class ForecastStore:
+    '''Latest forecast of each series, safe to use from several threads'''
+    def __init__(self):
+        self.forecasts = {}
+        self.lock = threading.Lock()
+        self.index_body = b"{}"
+        self.index_etag = '"0"'
+
+    def update(self, series, forecast, trained_at=None):
+        '''
+        Replaces forecast of series, building its JSON once
+
+        Attributes:
+            series: Name of series
+            forecast: Prophet forecast DataFrame with ds and COLUMNS
+            trained_at: Unix time the forecast was produced, defaults to now
+        '''
+        ds = forecast["ds"].values.astype("datetime64[s]").astype(np.int64)
+        order = np.argsort(ds, kind="stable")
+        columns = {name: forecast[name].values.astype(np.float64)[order] for name in COLUMNS}
+        entry = Forecast(series, ds[order], columns, trained_at or time.time())
+        with self.lock:
+            self.forecasts[series] = entry
+            self.index_body = json.dumps({
+                name: {"etag": x.etag, "trained_at": x.trained_at, "rows": len(x.ds)}
+                for name, x in self.forecasts.items()}).encode()
+            self.index_etag = '"' + hashlib.sha1(self.index_body).hexdigest()[:20] + '"'
+
+    def get(self, series):
+        '''Gets Forecast of series, None if there is none'''
+        return self.forecasts.get(series)
+
+    def index(self):
+        '''Gets JSON body and ETag of the list of series'''
+        with self.lock:
+            return self.index_body, self.index_etag
+
+
+class Handler(BaseHTTPRequestHandler):
+    '''Handles GET requests with the ForecastStore of the server'''
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        parts = [unquote(x) for x in url.path.split("/") if x]
+        store = self.server.store
+        if parts == ["health"]:
+            return self.reply(200, b'{"status":"ok"}')
+        if parts == ["forecasts"]:
+            return self.reply(200, *store.index())
+        if len(parts) == 2 and parts[0] == "forecasts":
+            forecast = store.get(parts[1])
+            if forecast is None:
+                return self.reply(404, b'{"error":"no forecast of series"}')
+            query = parse_qs(url.query)
+            try:
+                start, end = (int(query[x][0]) if x in query else None for x in ("start", "end"))
+            except ValueError:
+                return self.reply(400, b'{"error":"start and end must be unix seconds"}')
+            return self.reply(200, *forecast.get(start, end))
+        return self.reply(404, b'{"error":"not found"}')
+
+    def reply(self, status, body, etag=None):
+        if etag is not None and self.headers.get("If-None-Match") == etag:
+            status, body = 304, b""
+        self.send_response(status)
+        if etag is not None:
+            self.send_header("ETag", etag)
+            self.send_header("Cache-Control", "no-cache")
+        if status != 304:
+            self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug("%s " + format, self.address_string(), *args)
+
+
+def serve(store, port=8000, host="0.0.0.0"):
+    '''
+    Serves forecasts of store over HTTP on a background thread
+
+    Attributes:
+        store: ForecastStore to serve
+        port: Port to listen on
+        host: Address to listen on
+
+    Returns: ThreadingHTTPServer, shutdown() stops it
+    '''
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    server.store = store
+    thread = threading.Thread(target=server.serve_forever, name="http", daemon=True)
+    thread.start()
+    logger.info("Serving forecasts on port %d", server.server_address[1])
+    return server
@@ -0,0 +1,229 @@
+'''
+On-disk store of received aggregates, so a restart does not need a replay
+from the edge
+
+Windows are kept in SQLite in columnar chunks partitioned by series and day:
+
+    chunks(series, day, seq, fields, count, timestamps, columns)
+        PRIMARY KEY (series, day, seq) WITHOUT ROWID
+
+Each chunk holds the windows of one series and day written in one batch,
+timestamps as int64 bytes and the aggregates as float64 bytes, one column
+after another. Writes are append-only and buffered, a batch is written in
+one transaction. A range query reads only the chunks of the days in range
+through the primary key and hands the columns to numpy without visiting
+rows. Windows written more than once (e.g. replayed by the edge) are
+returned once, the last written wins.
+'''
+import time
+import sqlite3
+import threading
+import numpy as np
+import pandas
+import log
+import metrics
+
+logger = log.get_logger(__name__)
+
+WRITE_SECONDS = metrics.histogram("processor_store_write_seconds", "Time to write a batch of windows")
+
+DAY = 24*60*60
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS chunks (
+    series TEXT NOT NULL,
+    day INTEGER NOT NULL,
+    seq INTEGER NOT NULL,
+    fields TEXT NOT NULL,
+    count INTEGER NOT NULL,
+    timestamps BLOB NOT NULL,
+    columns BLOB NOT NULL,
+    PRIMARY KEY (series, day, seq)
+) WITHOUT ROWID
+'''
+
+
+class Store:
+    '''
+    Append-only store of the windows of many series
+    Safe to use from several threads
+
+    Attributes:
+        path: Path of SQLite database, created if needed
+        batch_rows: Buffered windows which trigger a write
+        flush_interval: Seconds after which buffered windows are written on
+            the next append
+    '''
+    def __init__(self, path, batch_rows=1000, flush_interval=1.0):
+        self.path = path
+        self.batch_rows = batch_rows
+        self.flush_interval = flush_interval
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        # Appends are durable once written, without a sync per transaction
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute(SCHEMA)
+        self.seq = self.db.execute("SELECT COALESCE(MAX(seq), 0) FROM chunks").fetchone()[0]
+
+        # (series, fields) -> list of (timestamps, columns) arrays
+        self.buffer = {}
+        self.buffered = 0
+        self.buffered_since = None
+
+        # Counters
+        self.rows_written = 0
+        self.chunks_written = 0
+        self.writes = 0
+
+    def append(self, series, fields, timestamps, columns):
+        '''
+        Buffers windows of series, writing the buffer if full or old
+
+        Attributes:
+            series: Name of series
+            fields: Names of aggregates
+            timestamps: int64 window start times in unix seconds
+            columns: float64 column per field, NaN for missing values
+        '''
+        timestamps = np.array(timestamps, dtype=np.int64)
+        columns = np.array(columns, dtype=np.float64).reshape(len(fields), len(timestamps))
+        with self.lock:
+            self.buffer.setdefault((series, tuple(fields)), []).append((timestamps, columns))
+            self.buffered += len(timestamps)
+            if self.buffered_since is None:
+                self.buffered_since = time.monotonic()
+            if self.buffered >= self.batch_rows or\
+                    time.monotonic() - self.buffered_since >= self.flush_interval:
+                self._flush()
+
+    def append_frame(self, series, frame):
+        '''Buffers the windows of a binary frame, see codec'''
+        self.append(series, frame.fields, np.frombuffer(frame.timestamps, dtype=np.int64),
+                    [np.frombuffer(x, dtype=np.float64) for x in frame.columns])
+
+    def flush(self):
+        '''Writes buffered windows'''
+        with self.lock:
+            self._flush()
+
+    def _flush(self):
+        if not self.buffered:
+            return
+        start = time.perf_counter()
+        rows = []
+        for (series, fields), batches in self.buffer.items():
+            timestamps = np.concatenate([x for x, _ in batches])
+            columns = np.concatenate([x for _, x in batches], axis=1)
+            # One chunk per day
+            days = timestamps // DAY
+            order = np.argsort(days, kind="stable")
+            days, timestamps, columns = days[order], timestamps[order], columns[:, order]
+            edges = np.flatnonzero(np.diff(days)) + 1
+            for lo, hi in zip(np.r_[0, edges], np.r_[edges, len(days)]):
+                self.seq += 1
+                rows.append((series, int(days[lo]), self.seq, ",".join(fields), int(hi - lo),
+                             timestamps[lo:hi].tobytes(),
+                             np.ascontiguousarray(columns[:, lo:hi]).tobytes()))
+        with self.db:
+            self.db.executemany("INSERT INTO chunks VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+        WRITE_SECONDS.observe(time.perf_counter() - start)
+        self.rows_written += self.buffered
+        self.chunks_written += len(rows)
+        self.writes += 1
+        self.buffer = {}
+        self.buffered = 0
+        self.buffered_since = None
+
+    def series(self):
+        '''Gets names of stored series'''
+        self.flush()
+        with self.lock:
+            return [x for x, in self.db.execute("SELECT DISTINCT series FROM chunks")]
+
+    def latest(self, series):
+        '''Gets newest window start of series, None if it has none'''
+        self.flush()
+        with self.lock:
+            day = self.db.execute("SELECT MAX(day) FROM chunks WHERE series = ?", (series,)).fetchone()[0]
+            if day is None:
+                return None
+            # Chunks of the newest day may have been written in any order
+            rows = self.db.execute(
+                "SELECT timestamps FROM chunks WHERE series = ? AND day = ?", (series, day)).fetchall()
+        return max(int(np.frombuffer(x, dtype=np.int64).max()) for x, in rows)
+
+    def load(self, series, start=None, end=None, fields=None):
+        '''
+        Gets windows of series with start <= timestamp < end, ascending
+        Only the chunks of the days in range are read
+
+        Attributes:
+            series: Name of series
+            start: Unix seconds, None for the oldest
+            end: Unix seconds, None for the newest
+            fields: Names of aggregates to get, None for those of the newest
+                chunk, aggregates a chunk lacks are NaN
+
+        Returns: tuple of fields, int64 timestamps array and list of float64
+            arrays, one per field
+        '''
+        self.flush()
+        first = -2**62 if start is None else start // DAY
+        last = 2**62 if end is None else end // DAY
+        with self.lock:
+            rows = self.db.execute(
+                "SELECT fields, count, timestamps, columns FROM chunks "
+                "WHERE series = ? AND day BETWEEN ? AND ? ORDER BY seq",
+                (series, first, last)).fetchall()
+        if fields is None:
+            fields = tuple(rows[-1][0].split(",")) if rows else ()
+        fields = tuple(fields)
+
+        timestamps = [np.empty(0, dtype=np.int64)]
+        columns = [[np.empty(0, dtype=np.float64)] for _ in fields]
+        for chunk_fields, count, ts, values in rows:
+            chunk_fields = chunk_fields.split(",")
+            values = np.frombuffer(values, dtype=np.float64).reshape(len(chunk_fields), count)
+            timestamps.append(np.frombuffer(ts, dtype=np.int64))
+            for name, column in zip(fields, columns):
+                column.append(values[chunk_fields.index(name)] if name in chunk_fields
+                              else np.full(count, np.nan))
+        timestamps = np.concatenate(timestamps)
+        columns = [np.concatenate(x) for x in columns]
+
+        keep = np.ones(len(timestamps), dtype=bool)
+        if start is not None:
+            keep &= timestamps >= start
+        if end is not None:
+            keep &= timestamps < end
+        # Ascending, and the last written copy of a repeated window
+        rows = np.flatnonzero(keep)[::-1]
+        _, first_seen = np.unique(timestamps[rows], return_index=True)
+        rows = rows[first_seen]
+        return fields, timestamps[rows], [x[rows] for x in columns]
+
+    def load_dataframe(self, series, start=None, end=None):
+        '''
+        Gets windows of series with start <= timestamp < end as a DataFrame
+        of a datetime64 Timestamp column and the first aggregate as Value
+        '''
+        fields, timestamps, columns = self.load(series, start, end)
+        return pandas.DataFrame({
+            "Timestamp": pandas.to_datetime(timestamps, unit="s"),
+            "Value": columns[0] if columns else np.empty(0, dtype=np.float64),
+        })
+
+    def stats(self):
+        with self.lock:
+            return {
+                "buffered": self.buffered,
+                "rows_written": self.rows_written,
+                "chunks_written": self.chunks_written,
+                "writes": self.writes,
+            }
+
+    def close(self):
+        self.flush()
+        with self.lock:
+            self.db.close()
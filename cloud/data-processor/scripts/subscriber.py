@@ -1,77 +1,117 @@
 import pika
 import time
 import json
+import weakref
+import numpy as np
+import codec
+import compression
+import connections
+from columns import SeriesColumns
+import log
+import metrics
 
-def connect_to_rabbitmq(ip, port=5672, attempts=10, socket_timeout=60):
+logger = log.get_logger(__name__)
+
+MESSAGES = metrics.counter("processor_messages_total", "RabbitMQ messages received, by format", ["format"])
+WINDOWS = metrics.counter("processor_windows_total", "Windows received")
+PARSE_SECONDS = metrics.histogram("processor_parse_seconds", "Time to decompress and decode a message")
+END_TO_END = metrics.histogram("processor_end_to_end_latency_seconds",
+                               "Time from data-injector encoding the readings of a frame to "
+                               "receiving their aggregates")
+
+# Errors of a lost or unusable connection to the broker
+BROKER_ERRORS = (pika.exceptions.AMQPError, OSError)
+
+# Series of messages sent without a series header
+DEFAULT_SERIES = "CSC8112"
+
+# Channel -> names of queues already declared on it
+DECLARED_QUEUES = weakref.WeakKeyDictionary()
+
+def connect_to_rabbitmq(ip, port=5672, attempts=None, timeout=60, socket_timeout=60):
     '''
     Connects to RabbitMQ MQTT message broker
     https://www.rabbitmq.com/
-    Connects with pika.BlockingConnection
+    Connects with pika.BlockingConnection, retrying with backoff (see
+    connections)
 
     Attributes:
         ip: IP of message broker
         port: Port of message broker
-        attempts: Number of attempts to connect
+        attempts: Maximum number of attempts, None for no limit
+        timeout: Seconds to keep trying
         socket_timeout: Timeout with for connections to broker
 
-    Returns: pika.BlockingConnection
+    Returns: pika.BlockingConnection channel
 
     Raises:
-        ConnectionError: if all :attempts: fail
+        ConnectionError: if no attempt succeeds
     '''
-    connected = False    
-    # Make connection attempts
-    for i in range(attempts):
-        try:    
-            # Connect to RabbitMQ service
-            connection = pika.BlockingConnection(
-                pika.ConnectionParameters(host=ip,
-                                        port=port,
-                                        socket_timeout=socket_timeout)
-                                        )
-
-            # If successful
-            print(f"({ip}) Connected to broker", flush=True)
-            # Save channel to global
-            channel = connection.channel()
-            connected = True
-            break
-        except pika.exceptions.AMQPConnectionError:
-            # Sleep for 5 seconds before trying again
-            print(f"({ip}) Could not connect, trying again in 5 seconds", flush=True)
-            time.sleep(5)
-    
-    # If connection attempts fail
-    if not connected:
-        raise ConnectionError(f"Could not connect to {ip}")
-    return channel
+    def connect():
+        connection = pika.BlockingConnection(
+            pika.ConnectionParameters(host=ip,
+                                    port=port,
+                                    socket_timeout=socket_timeout)
+                                    )
+        return connection.channel()
+    return connections.retry(connect, f"RabbitMQ broker ({ip})", timeout=timeout, attempts=attempts,
+                             errors=(pika.exceptions.AMQPConnectionError,), probe=(ip, port))
 
 
-def rabbitmq_subscribe_to_queue(channel, queue):
+def declare_queue(channel, queue_name):
+    '''
+    Declares queue on channel once
+    Declaring is a blocking round-trip to the broker so it is skipped for
+    queues already declared on the channel
+    '''
+    declared = DECLARED_QUEUES.setdefault(channel, set())
+    if queue_name not in declared:
+        channel.queue_declare(queue=queue_name)
+        declared.add(queue_name)
+
+
+def rabbitmq_subscribe_to_queue(channel, queue, forecaster=None, store=None, restore_days=None,
+                                connect=None):
     '''
     Subscribes to queue on RabbitMQ broker
+    With :connect: a lost connection is replaced and the queue consumed
+    again, received windows and forecaster state are kept
     Attributes:
         Channel: pika.BlockingConnection to broker
         queue: Name of queue
+        forecaster: Function creating a forecasting.ContinuousForecaster of
+            the received series, consumes until stopped rather than until
+            the finished token if given
+        store: store.Store to write received windows to, or None
+        restore_days: Days of newest windows of each series to load from
+            store before consuming, None to not restore
+        connect: Function returning a new channel, see connect_to_rabbitmq,
+            or None to raise broker errors
 
     Returns: 
         Callback object to access received messages      
     '''
-    # Initialise queue
-    channel.queue_declare(queue=queue)
-    # Subscribe to content
     # Call on_message on recieving message
-    cback = Callback(channel)
-    consumer_tag = channel.basic_consume(
-        queue=queue,
-        auto_ack=True,
-        on_message_callback = cback.on_message
-    )
-    # Save consumer tag
-    cback.consumer_tag = consumer_tag
+    cback = Callback(channel, store)
+    if forecaster is not None:
+        cback.forecaster = forecaster(cback.data)
+        cback.forecaster.start()
+    if store is not None:
+        if restore_days is not None:
+            cback.restore(restore_days)
+        cback.flush_store()
+    cback.consume(queue)
     # Start loop to comsume messages
-    channel.start_consuming()
-    return cback
+    while True:
+        try:
+            cback.channel.start_consuming()
+            return cback
+        except BROKER_ERRORS as e:
+            if connect is None:
+                raise
+            logger.warning("Lost connection to RabbitMQ, reconnecting: %r", e)
+        cback.reattach(connect())
+        cback.consume(queue)
 
 ## CALLBACK FOR MESSAGE RECIEVING
 class Callback:
@@ -80,30 +120,165 @@ class Callback:
     This is required since a callback function is required with pika
     This doesn't allow custom parameters to extract information from callback function
     '''
-    def __init__(self, channel):
+    def __init__(self, channel, store=None):
         '''
         Initialises variables
-        Takes channel to close waiting loop
+        Takes channel to close waiting loop, and optionally a store.Store
+        received windows are written to
         '''
-        self.data = []
+        # Series -> columns.SeriesColumns of received windows
+        self.data = {}
         self.channel = channel
         self.consumer_tag = None
+        # Retrains series as windows arrive, see forecasting
+        self.forecaster = None
+        self.store = store
+        # Series -> newest timestamp restored from the store, windows up to
+        # it which arrive again (e.g. replayed by the edge) are dropped
+        self.restored = {}
         
     def on_message(self, ch, method, properties, body):
         '''
         Function called when message is received from subscription
+        Messages are grouped by their "series" header, messages without
+        one belong to the CSC8112 series
+        Binary frames (see codec) hold the aggregates of many windows, their
+        columns are appended to the series' columns as they are
+        Compressed frames (see compression) are decompressed first
         '''
+        if is_frame(properties, body):
+            start = time.perf_counter()
+            if compression.is_compressed(body):
+                body = compression.decompress(body)
+            frame = codec.decode(body)
+            PARSE_SECONDS.observe(time.perf_counter() - start)
+            MESSAGES.labels("binary").inc()
+            WINDOWS.inc(len(frame))
+            # sent_at is carried from the readings by data-preprocessor
+            END_TO_END.observe(metrics.since(frame.sent_at))
+            series = frame.series or series_of(properties)
+            logger.debug("Frame recieved from data-preprocessor for %s: %d windows", series, len(frame))
+            if series in self.restored:
+                self.extend_unrestored(series, frame)
+                return
+            self.series(series).extend_frame(frame)
+            if self.store is not None:
+                self.store.append_frame(series, frame)
+            if self.forecaster is not None:
+                self.forecaster.on_data(series, len(frame))
+            return
+
         str_msg = str(json.loads(body))
-        print(f"Message recieved from data-preprocessor: {str_msg}", flush=True)
+        MESSAGES.labels("json").inc()
+        series = series_of(properties)
+        logger.debug("Message recieved from data-preprocessor for %s: %s", series, str_msg)
 
         # Check for finished msg
         if str_msg == "finished":
+            if self.store is not None:
+                self.store.flush()
+            if self.forecaster is not None:
+                # Keep consuming, forecast what has arrived so far
+                logger.info("Recieved finished token... Retraining all series")
+                self.forecaster.retrain_all()
+                return
             # Stop consuming messages
             self.channel.basic_cancel(self.consumer_tag)
-            print("Recieved finished token... Stopping consuming", flush=True)
+            logger.info("Recieved finished token... Stopping consuming")
             
+        elif series in self.restored and int(str_msg.split(":")[0]) <= self.restored[series]:
+            logger.debug("Dropped window of %s already restored: %s", series, str_msg)
         else:
-            self.data.append(str_msg)
+            columns = self.series(series)
+            columns.append(str_msg)
+            WINDOWS.inc()
+            if self.store is not None:
+                self.store.append(series, columns.fields, [columns.timestamps[-1]],
+                                  [[x[-1]] for x in columns.columns])
+            if self.forecaster is not None:
+                self.forecaster.on_data(series, 1)
+
+    def extend_unrestored(self, series, frame):
+        '''Appends the windows of a frame newer than those restored of series'''
+        timestamps = np.frombuffer(frame.timestamps, dtype=np.int64)
+        keep = timestamps > self.restored[series]
+        if not keep.any():
+            logger.debug("Dropped %d windows of %s already restored", len(frame), series)
+            return
+        timestamps = timestamps[keep]
+        columns = [np.frombuffer(x, dtype=np.float64)[keep] for x in frame.columns]
+        self.series(series).extend(frame.fields, timestamps, columns)
+        if self.store is not None:
+            self.store.append(series, frame.fields, timestamps, columns)
+        if self.forecaster is not None:
+            self.forecaster.on_data(series, len(timestamps))
+
+    def consume(self, queue):
+        '''Subscribes on_message to queue on the channel'''
+        # Initialise queue
+        declare_queue(self.channel, queue)
+        # Save consumer tag
+        self.consumer_tag = self.channel.basic_consume(
+            queue=queue,
+            auto_ack=True,
+            on_message_callback = self.on_message
+        )
+
+    def reattach(self, channel):
+        '''
+        Moves to channel after the connection was lost, timers of the old
+        connection are started again on the new one
+        '''
+        self.channel = channel
+        if self.forecaster is not None:
+            self.forecaster.reattach(channel)
+        if self.store is not None:
+            self.flush_store()
+
+    def series(self, series):
+        '''Gets columns of series, creating them if needed'''
+        columns = self.data.get(series)
+        if columns is None:
+            columns = self.data[series] = SeriesColumns()
+        return columns
+
+    def flush_store(self):
+        '''Writes windows buffered by the store every second, also while idle'''
+        self.store.flush()
+        self.channel.connection.call_later(1, self.flush_store)
+
+    def restore(self, days):
+        '''
+        Loads the newest :days: days of windows of each series in the store,
+        e.g. after a restart, rather than waiting for a replay from the edge
+        '''
+        for series in self.store.series():
+            latest = self.store.latest(series)
+            fields, timestamps, columns = self.store.load(series, start=latest - int(days*24*60*60))
+            self.data[series] = SeriesColumns(fields)
+            self.data[series].extend(fields, timestamps, columns)
+            self.restored[series] = latest
+            logger.info("Restored %d windows of %s", len(timestamps), series)
+            if self.forecaster is not None:
+                self.forecaster.on_data(series, len(timestamps))
+
+def is_frame(properties, body):
+    '''
+    Checks message is a binary frame, compressed or not, by its content type
+    or magic bytes
+    '''
+    if properties is not None and properties.content_type == codec.CONTENT_TYPE:
+        return True
+    return codec.is_binary(body) or compression.is_compressed(body)
+
+def series_of(properties):
+    '''Gets series of message from its headers'''
+    headers = properties.headers if properties is not None else None
+    if headers and "series" in headers:
+        series = headers["series"]
+        # Header strings may be received as bytes
+        return series.decode() if type(series) == bytes else series
+    return DEFAULT_SERIES
             
 
 
@@ -133,7 +308,7 @@ def publish_to_rabbitmq(channel, queue_name, msg):
             type(msg) == bytearray
 
     msg = json.dumps(msg)
-    channel.queue_declare(queue=queue_name)
+    declare_queue(channel, queue_name)
     channel.basic_publish(exchange='',
                         routing_key=queue_name,
                         body=msg,
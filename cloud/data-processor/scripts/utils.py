@@ -1,13 +1,43 @@
 import datetime
 import pandas
+from columns import SeriesColumns
+import log
+
+logger = log.get_logger(__name__)
 
 def parse_data(data):
-    '''Parses raw data into dataframe with columns [Timestamp, Value]'''
-    data = [x.split(":") for x in data]    
-    df = read_to_df(data)
-    df["Value"] = df["Value"].apply(lambda x:float(x))
-    df["Timestamp"] = df["Timestamp"].apply(convert_timestamp)
-    return df
+    '''
+    Parses received data into dataframe with columns [Timestamp, Value]
+    Timestamp is datetime64, only the first aggregate of each window is kept
+
+    Attributes:
+        data: columns.SeriesColumns, or list of timestamp:value[:value...]
+            messages
+    '''
+    if not isinstance(data, SeriesColumns):
+        columns = SeriesColumns()
+        for x in data:
+            columns.append(x)
+        data = columns
+    return data.to_dataframe()[["Timestamp", "Value"]]
+
+def load_data(store, series, days=None, end=None):
+    '''
+    Loads training window of series from the on-disk store into a dataframe
+    with columns [Timestamp, Value], reading only the days in the window
+
+    Attributes:
+        store: store.Store of received aggregates
+        series: Series (sensor ID) to load
+        days: Days of newest windows to load, None for all
+        end: Unix seconds the window ends before, defaults to after the
+            newest window
+    '''
+    if end is None:
+        latest = store.latest(series)
+        end = latest + 1 if latest is not None else None
+    start = end - int(days*24*60*60) if days is not None and end is not None else None
+    return store.load_dataframe(series, start, end)
 
 def read_to_df(raw_data):
     '''Reads list into dataframe with columns [Timestamp, Value]'''
@@ -18,7 +48,7 @@ def convert_timestamp(timestamp):
     '''Converts UNIX timestamp to [Year/Month/Second Hour/Minute/Second] format'''
     format = "%Y/%m/%d %H:%M:%S"
     converted = datetime.datetime.fromtimestamp(int(timestamp)).strftime(format)
-    print(f"Converted timestamp [{timestamp}] -> [{converted}]", flush=True)
+    logger.debug("Converted timestamp [%s] -> [%s]", timestamp, converted)
     return converted
 
 
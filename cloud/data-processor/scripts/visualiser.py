@@ -1,29 +1,246 @@
-from matplotlib import pyplot as plt
+'''
+Headless rendering of received data and forecasts
+Figures are drawn with the Agg backend on explicit Figure objects, never
+pyplot's global state, so nothing is kept once a figure is saved. Series
+are downsampled with Largest-Triangle-Three-Buckets to about one point per
+pixel of the figure's width before plotting, which keeps its shape (peaks
+included) at a fraction of the drawing time.
 
-def plot_data(df, out="out.png"):
+Renderer draws in a background worker process so rendering never blocks
+ingestion or training.
+'''
+import time
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+import log
+import metrics
+
+logger = log.get_logger(__name__)
+
+PLOT_SECONDS = metrics.histogram("processor_plot_seconds",
+                                 "Time from requesting a plot to it being saved by the renderer")
+PLOTS = metrics.counter("processor_plots_total", "Plots requested from the renderer, by outcome", ["outcome"])
+
+DPI = 100
+
+
+def lttb(x, y, threshold):
     '''
-    Plots dataframe data into lineplot
+    Downsamples series with Largest-Triangle-Three-Buckets
+    https://skemman.is/bitstream/1946/15343/3/SS_MSthesis.pdf
+    Keeps the first and last point and from each of threshold - 2 buckets
+    the point forming the largest triangle with the point kept from the
+    bucket before and the mean of the bucket after
 
     Attributes:
-        df: pandas DataFrame
-        out: Saves plot to specified path, defaults to "out.png"
+        x: Ascending numeric array
+        y: Numeric array, NaN points are dropped
+        threshold: Number of points to keep
+
+    Returns: int array of indices of kept points
     '''
-    x = df["Timestamp"].tolist()
-    y = df["Value"].tolist()
+    y = np.asarray(y, dtype=np.float64)
+    index = np.flatnonzero(~np.isnan(y))
+    n = len(index)
+    if threshold >= n or threshold < 3:
+        return index
+    x = np.asarray(x, dtype=np.float64)[index]
+    y = y[index]
+
+    # Bucket edges of the points between the first and last
+    edges = np.linspace(1, n - 1, threshold - 1).astype(np.int64)
+    kept = np.empty(threshold, dtype=np.int64)
+    kept[0], kept[-1] = 0, n - 1
+    a = 0
+    for i in range(threshold - 2):
+        lo, hi = edges[i], edges[i + 1]
+        # Mean of the next bucket, the last point for the last bucket
+        next_lo, next_hi = hi, edges[i + 2] if i + 2 < len(edges) else n
+        cx = x[next_lo:next_hi].mean()
+        cy = y[next_lo:next_hi].mean()
+        area = np.abs((x[a] - cx)*(y[lo:hi] - y[a]) - (x[a] - x[lo:hi])*(cy - y[a]))
+        a = lo + int(area.argmax())
+        kept[i + 1] = a
+    return index[kept]
+
+def _downsample(x, *ys, width):
+    '''Downsamples x and ys to about one point per pixel by the first of ys'''
+    kept = lttb(x.astype(np.int64) if x.dtype.kind == "M" else x, ys[0], width)
+    return (x[kept],) + tuple(y[kept] for y in ys)
+
+def _figure(figsize):
+    fig = Figure(figsize=figsize, dpi=DPI)
+    FigureCanvasAgg(fig)
+    return fig
+
+def _columns(df, *names):
+    '''Gets first present column of each pair of names as an array'''
+    return tuple(df[a].values if a in df else df[b].values for a, b in names)
+
+def data_figure(x, y):
+    '''
+    Draws line plot of daily averages
+
+    Attributes:
+        x: datetime64 array of timestamps
+        y: float array of values
+
+    Returns: matplotlib Figure
+    '''
+    fig = _figure((15, 10))
+    x, y = _downsample(x, y, width=int(fig.get_figwidth()*DPI))
+    ax = fig.add_subplot()
+    ax.set_title("AVG DAILY PM2.5")
+    ax.set_ylabel("AVG PM2.5 (μg/m^3)")
+    ax.plot(x, y)
 
-    plt.figure(figsize=(15,10))
-    plt.title("AVG DAILY PM2.5")
-    plt.ylabel("AVG PM2.5 (μg/m^3)")
-    plt.plot(x, y)
-    
     # Rotate x ticks and change font size
-    plt.xticks(rotation = 45, fontsize=8)
+    ax.tick_params(axis="x", labelrotation=45, labelsize=8)
     # Hide every nth label
     n = 2
-    ax = plt.gca()
-    xtik = ax.xaxis.get_ticklabels()
-    for tick in xtik[::n]:
+    for tick in ax.xaxis.get_ticklabels()[::n]:
         tick.set_visible(False)
+    return fig
+
+def forecast_figure(hx, hy, fx, yhat, lower, upper):
+    '''
+    Draws forecast like Prophet's plot, observed values as points, the
+    forecast as a line and its uncertainty interval as a band
+
+    Attributes:
+        hx, hy: Arrays of observed timestamps (datetime64) and values
+        fx, yhat, lower, upper: Arrays of forecast timestamps (datetime64),
+            values and bounds
+
+    Returns: matplotlib Figure
+    '''
+    fig = _figure((15, 6))
+    width = int(fig.get_figwidth()*DPI)
+    hx, hy = _downsample(hx, hy, width=width)
+    fx, yhat, lower, upper = _downsample(fx, yhat, lower, upper, width=width)
+    ax = fig.add_subplot()
+    ax.plot(hx, hy, "k.")
+    ax.plot(fx, yhat, ls="-", c="#0072B2")
+    ax.fill_between(fx, lower, upper, color="#0072B2", alpha=0.2)
+    ax.grid(True, which="major", c="gray", ls="-", lw=1, alpha=0.2)
+    ax.set_xlabel("ds")
+    ax.set_ylabel("y")
+    fig.tight_layout()
+    return fig
+
+def plot_data(df, out="out.png"):
+    '''
+    Plots dataframe data into lineplot
+
+    Attributes:
+        df: pandas DataFrame of Timestamp and Value (or ds and y) columns
+        out: Saves plot to specified path, defaults to "out.png"
+    '''
+    x, y = _columns(df, ("Timestamp", "ds"), ("Value", "y"))
+    fig = data_figure(x, y)
+    logger.info("Saving images to %s", out)
+    fig.savefig(out)
+
+def plot_forecast(history, forecast, out="forecast.png"):
+    '''
+    Plots forecast with the observed data it was trained on
+
+    Attributes:
+        history: pandas DataFrame of Timestamp and Value (or ds and y) columns
+        forecast: Prophet forecast DataFrame
+        out: Saves plot to specified path, defaults to "forecast.png"
+    '''
+    hx, hy = _columns(history, ("ds", "Timestamp"), ("y", "Value"))
+    fig = forecast_figure(hx, hy, *(forecast[x].values for x in ("ds", "yhat", "yhat_lower", "yhat_upper")))
+    logger.info("Saving images to %s", out)
+    fig.savefig(out)
+
+
+def _init_worker(log_level):
+    log.setup("data-processor-renderer", level=log_level)
+
+
+class Renderer:
+    '''
+    Renders plots in a background worker process
+    Plot methods return at once, a plot is dropped with a warning if
+    :max_pending: plots are already waiting, so callers are never blocked
+    Only the plotted columns are sent to the worker
+
+    Attributes:
+        max_pending: Maximum plots waiting to be rendered
+        log_level: Log level of the worker
+    '''
+    def __init__(self, max_pending=16, log_level="WARNING"):
+        self.max_pending = max_pending
+        # Spawned so the worker does not inherit the parent's threads
+        self.executor = ProcessPoolExecutor(max_workers=1,
+                                            mp_context=multiprocessing.get_context("spawn"),
+                                            initializer=_init_worker,
+                                            initargs=(log_level,))
+        self.pending = set()
+
+        # Counters
+        self.rendered = 0
+        self.dropped = 0
+        self.errors = 0
+
+    def plot_data(self, df, out="out.png"):
+        '''Renders plot_data of df in the background'''
+        x, y = _columns(df, ("Timestamp", "ds"), ("Value", "y"))
+        return self._submit(_save, "data", out, x, y)
+
+    def plot_forecast(self, history, forecast, out="forecast.png"):
+        '''Renders plot_forecast of history and forecast in the background'''
+        hx, hy = _columns(history, ("ds", "Timestamp"), ("y", "Value"))
+        return self._submit(_save, "forecast", out, hx, hy,
+                            *(forecast[x].values for x in ("ds", "yhat", "yhat_lower", "yhat_upper")))
+
+    def _submit(self, function, *args):
+        '''
+        Returns: concurrent.futures.Future of the plot's path, or None if
+            dropped
+        '''
+        if len(self.pending) >= self.max_pending:
+            self.dropped += 1
+            PLOTS.labels("dropped").inc()
+            logger.warning("Renderer busy, dropping plot %s", args[1])
+            return None
+        future = self.executor.submit(function, *args)
+        future.submitted = time.perf_counter()
+        self.pending.add(future)
+        future.add_done_callback(self._done)
+        return future
+
+    def _done(self, future):
+        self.pending.discard(future)
+        PLOT_SECONDS.observe(time.perf_counter() - future.submitted)
+        if future.exception() is not None:
+            self.errors += 1
+            PLOTS.labels("failed").inc()
+            logger.error("Rendering failed: %r", future.exception())
+        else:
+            self.rendered += 1
+            PLOTS.labels("rendered").inc()
+
+    def stats(self):
+        return {
+            "pending": len(self.pending),
+            "rendered": self.rendered,
+            "dropped": self.dropped,
+            "errors": self.errors,
+        }
+
+    def close(self, wait=True):
+        '''Stops the worker, after rendering pending plots if :wait:'''
+        self.executor.shutdown(wait=wait)
 
-    print(f"Saving images to {out}", flush=True)
-    plt.savefig(f"{out}")
+def _save(kind, out, *columns):
+    '''Draws and saves a plot in the worker'''
+    fig = data_figure(*columns) if kind == "data" else forecast_figure(*columns)
+    fig.savefig(out)
+    logger.info("Saved images to %s", out)
+    return out
@@ -0,0 +1,78 @@
+import json
+import os
+import numpy as np
+import pandas as pd
+import pytest
+import model_cache
+from model_cache import ModelCache, cache_key, data_fingerprint, params_key
+
+
+@pytest.fixture(autouse=True)
+def plain_models(monkeypatch):
+    '''Models are dicts serialised as JSON rather than fitted Prophet models'''
+    monkeypatch.setattr(model_cache, "model_to_json", json.dumps)
+    monkeypatch.setattr(model_cache, "model_from_json", json.loads)
+
+def frame(rows, seed=0):
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame({"ds": pd.date_range("2023-01-01", periods=rows, freq="D"),
+                         "y": rng.random(rows)})
+
+
+def test_key_depends_on_data_and_params():
+    df = frame(30)
+    key = cache_key(data_fingerprint(df), {"a": 1, "b": 2})
+    assert key == cache_key(data_fingerprint(frame(30)), {"b": 2, "a": 1})
+    assert key != cache_key(data_fingerprint(frame(30, seed=1)), {"a": 1, "b": 2})
+    assert key != cache_key(data_fingerprint(df), {"a": 1, "b": 3})
+    assert params_key({"b": 2, "a": 1}) == params_key({"a": 1, "b": 2})
+
+def test_fingerprint_of_prefix():
+    df = frame(30)
+    assert data_fingerprint(df, 20) == data_fingerprint(df.iloc[:20])
+
+def test_stored_model_is_loaded(tmp_path):
+    cache = ModelCache(str(tmp_path))
+    df = frame(30)
+    assert cache.load(df, {"a": 1}) is None
+    cache.store(df, {"a": 1}, {"model": 1}, fit_seconds=2.0)
+    assert cache.load(df, {"a": 1}) == ({"model": 1}, 30)
+    assert cache.load(df, {"a": 2}) is None
+    stats = cache.stats()
+    assert (stats["hits"], stats["misses"], stats["fit_s_saved"]) == (1, 2, 2.0)
+
+def test_model_of_prefix_within_tolerance_is_used(tmp_path):
+    cache = ModelCache(str(tmp_path), append_tolerance=0.1)
+    df = frame(100)
+    cache.store(df.iloc[:95], {"a": 1}, {"model": 1}, fit_seconds=1.0)
+    assert cache.load(df, {"a": 1}) == ({"model": 1}, 95)
+    assert cache.stats()["append_hits"] == 1
+    cache.store(df.iloc[:80], {"a": 2}, {"model": 2}, fit_seconds=1.0)
+    assert cache.load(df, {"a": 2}) is None
+    # Same length prefix of different data
+    cache.store(frame(95, seed=1), {"a": 3}, {"model": 3}, fit_seconds=1.0)
+    assert cache.load(df, {"a": 3}) is None
+
+def test_least_recently_used_model_is_evicted(tmp_path):
+    cache = ModelCache(str(tmp_path), max_entries=2)
+    frames = [frame(30, seed=i) for i in range(3)]
+    cache.store(frames[0], {}, {"model": 0}, fit_seconds=1.0)
+    cache.store(frames[1], {}, {"model": 1}, fit_seconds=1.0)
+    assert cache.load(frames[0], {}) is not None
+    cache.store(frames[2], {}, {"model": 2}, fit_seconds=1.0)
+    assert cache.load(frames[1], {}) is None
+    assert cache.load(frames[0], {}) is not None
+    assert cache.stats()["evictions"] == 1
+    assert len([x for x in os.listdir(str(tmp_path)) if x.endswith(".model")]) == 2
+
+def test_models_survive_restart_and_partial_files_are_dropped(tmp_path):
+    cache = ModelCache(str(tmp_path))
+    df = frame(30)
+    cache.store(df, {}, {"model": 1}, fit_seconds=1.0)
+    # Metadata without its model, e.g. removed by hand
+    with open(os.path.join(str(tmp_path), "orphan.meta"), "w") as f:
+        f.write("{}")
+    cache = ModelCache(str(tmp_path))
+    assert cache.load(df, {}) == ({"model": 1}, 30)
+    assert not os.path.exists(os.path.join(str(tmp_path), "orphan.meta"))
+    assert not [x for x in os.listdir(str(tmp_path)) if x.endswith(".tmp")]
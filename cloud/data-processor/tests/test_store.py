@@ -0,0 +1,75 @@
+import json
+import math
+import numpy as np
+import codec
+import subscriber
+from store import Store, DAY
+
+
+class Properties:
+    def __init__(self, content_type, series):
+        self.content_type = content_type
+        self.content_encoding = None
+        self.headers = {"series": series}
+
+
+def test_windows_round_trip(tmp_path):
+    store = Store(str(tmp_path / "a.db"))
+    store.append("s", ("mean", "max"), [0, DAY, 2 * DAY], [[1.0, 2.0, 3.0], [4.0, 5.0, math.nan]])
+    fields, timestamps, columns = store.load("s")
+    assert fields == ("mean", "max")
+    assert timestamps.tolist() == [0, DAY, 2 * DAY]
+    assert columns[0].tolist() == [1.0, 2.0, 3.0]
+    assert np.isnan(columns[1][2])
+    assert store.series() == ["s"]
+    assert store.latest("s") == 2 * DAY
+    assert store.latest("other") is None
+
+def test_range_query_reads_days_in_range(tmp_path):
+    store = Store(str(tmp_path / "a.db"))
+    hours = list(range(0, 5 * DAY, 3600))
+    store.append("s", ("mean",), hours, [[float(x) for x in hours]])
+    _, timestamps, columns = store.load("s", start=DAY, end=2 * DAY)
+    assert timestamps.tolist() == list(range(DAY, 2 * DAY, 3600))
+    assert columns[0].tolist() == [float(x) for x in timestamps]
+
+def test_repeated_windows_are_returned_once(tmp_path):
+    store = Store(str(tmp_path / "a.db"), batch_rows=1)
+    store.append("s", ("mean",), [0, DAY], [[1.0, 2.0]])
+    # Replayed by the edge, the last written copy wins
+    store.append("s", ("mean",), [DAY, 2 * DAY], [[20.0, 3.0]])
+    _, timestamps, columns = store.load("s")
+    assert timestamps.tolist() == [0, DAY, 2 * DAY]
+    assert columns[0].tolist() == [1.0, 20.0, 3.0]
+
+def test_missing_fields_are_nan(tmp_path):
+    store = Store(str(tmp_path / "a.db"), batch_rows=1)
+    store.append("s", ("mean",), [0], [[1.0]])
+    store.append("s", ("mean", "max"), [DAY], [[2.0], [5.0]])
+    fields, _, columns = store.load("s")
+    assert fields == ("mean", "max")
+    assert np.isnan(columns[1][0]) and columns[1][1] == 5.0
+
+def test_windows_survive_reopening(tmp_path):
+    path = str(tmp_path / "a.db")
+    store = Store(path, batch_rows=1000)
+    store.append("s", ("mean",), [0, DAY], [[1.0, 2.0]])
+    store.close()
+    store = Store(path)
+    assert store.load("s")[1].tolist() == [0, DAY]
+    store.append("s", ("mean",), [2 * DAY], [[3.0]])
+    assert store.load("s")[1].tolist() == [0, DAY, 2 * DAY]
+
+def test_replayed_windows_are_dropped_after_restore(tmp_path):
+    store = Store(str(tmp_path / "a.db"))
+    store.append("s", ("mean",), [100, 200, 300], [[1.0, 2.0, 3.0]])
+    callback = subscriber.Callback(None, store)
+    callback.restore(7)
+
+    # Replay of 200..400, only 400 is new
+    body = codec.encode_aggregates("s", ("mean",), [200, 300, 400], [[2.0, 3.0, 4.0]])
+    callback.on_message(None, None, Properties(codec.CONTENT_TYPE, "s"), body)
+    callback.on_message(None, None, Properties("application/json", "s"), json.dumps("300:3.0"))
+    callback.on_message(None, None, Properties("application/json", "s"), json.dumps("500:5.0"))
+    assert list(callback.data["s"].timestamps) == [100, 200, 300, 400, 500]
+    assert store.load("s")[1].tolist() == [100, 200, 300, 400, 500]
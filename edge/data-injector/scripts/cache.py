@@ -0,0 +1,142 @@
+import os
+import re
+import json
+import datetime
+import threading
+
+TIME_FORMAT = "%Y%m%d%H%M%S"
+
+class ResponseCache:
+    '''
+    On-disk cache of scrubbed sensor readings
+    Each entry holds the readings of one sensor for one time window, stored as
+    a JSON list of timestamp:value strings so cached and fresh windows yield
+    identical readings.
+    Least recently used entries are removed once the cache is over :max_bytes:
+
+    Attributes:
+        directory: Directory to store cache entries in
+        max_bytes: Maximum total size of cache entries
+        settle: timedelta a window must be in the past before it is cached,
+            upstream data for recent windows may still be arriving
+    '''
+    def __init__(self, directory, max_bytes=256 * 1024 * 1024,
+                 settle=datetime.timedelta(hours=1)):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.settle = settle
+        self.hits = 0
+        self.misses = 0
+
+        self._lock = threading.Lock()
+        # path -> [size, last access time]
+        self._entries = {}
+        self._size = 0
+
+        os.makedirs(directory, exist_ok=True)
+        self._load_index()
+
+    def _load_index(self):
+        '''Reads sizes and access times of existing entries'''
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                path = os.path.join(root, name)
+                if name.endswith(".tmp"):
+                    # Left over from an interrupted write
+                    os.remove(path)
+                    continue
+                stat = os.stat(path)
+                self._entries[path] = [stat.st_size, stat.st_mtime]
+                self._size += stat.st_size
+
+    def _path(self, sensor_id, start, end):
+        '''Gets file path of entry'''
+        sensor_dir = re.sub(r"[^A-Za-z0-9_.-]", "_", sensor_id)
+        name = f"{start.strftime(TIME_FORMAT)}_{end.strftime(TIME_FORMAT)}.json"
+        return os.path.join(self.directory, sensor_dir, name)
+
+    def is_cacheable(self, end):
+        '''Checks window has ended long enough ago for its data to be final'''
+        return end + self.settle <= datetime.datetime.utcnow()
+
+    def get(self, sensor_id, start, end):
+        '''
+        Gets cached readings for window
+
+        Returns:
+            None: if window is not cached
+            (list): readings in timestamp:value format
+        '''
+        path = self._path(sensor_id, start, end)
+        with self._lock:
+            entry = self._entries.get(path)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            # Mark as recently used
+            entry[1] = datetime.datetime.now().timestamp()
+
+        try:
+            with open(path) as f:
+                readings = json.load(f)
+            os.utime(path)
+        except (OSError, ValueError):
+            # Entry removed or corrupted outside of the cache
+            self._remove(path)
+            return None
+        return readings
+
+    def put(self, sensor_id, start, end, readings):
+        '''Stores readings for window if the window is complete'''
+        if not self.is_cacheable(end):
+            return
+
+        path = self._path(sensor_id, start, end)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        # Write to temporary file first so readers never see partial entries
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(readings, f, separators=(",", ":"))
+        size = os.path.getsize(tmp_path)
+        os.replace(tmp_path, path)
+
+        with self._lock:
+            old = self._entries.pop(path, None)
+            if old is not None:
+                self._size -= old[0]
+            self._entries[path] = [size, datetime.datetime.now().timestamp()]
+            self._size += size
+        self._evict()
+
+    def _remove(self, path):
+        '''Removes entry from cache'''
+        with self._lock:
+            entry = self._entries.pop(path, None)
+            if entry is not None:
+                self._size -= entry[0]
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    def _evict(self):
+        '''Removes least recently used entries until cache fits in max_bytes'''
+        with self._lock:
+            if self._size <= self.max_bytes:
+                return
+            by_age = sorted(self._entries.items(), key=lambda x: x[1][1])
+            evicted = []
+            for path, (size, _) in by_age:
+                if self._size <= self.max_bytes:
+                    break
+                del self._entries[path]
+                self._size -= size
+                evicted.append(path)
+
+        for path in evicted:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
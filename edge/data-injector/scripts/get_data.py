@@ -1,7 +1,21 @@
+import datetime
+from concurrent.futures import ThreadPoolExecutor
 import requests
+from requests.adapters import HTTPAdapter
+import log
+import metrics
+
+logger = log.get_logger(__name__)
+
+FETCH_SECONDS = metrics.histogram("injector_fetch_seconds", "Time to fetch and scrub a window from the API")
+WINDOWS = metrics.counter("injector_windows_total", "Windows of readings loaded, by source", ["source"])
+
+API_URL = "http://uoweb3.ncl.ac.uk/api/v1.1"
+API_TIME_FORMAT = "%Y%m%d%H%M%S"
+EPOCH = datetime.datetime(1970, 1, 1)
 
 def get_api_data(url):
-    print(f"Pulling data from {url}", flush=True)
+    logger.info("Pulling data from %s", url)
     data = requests.get(url)
     
     # Convert to JSON format
@@ -10,4 +24,157 @@ def get_api_data(url):
 def scrub_data(data):
     pm_dict = data["sensors"][0]["data"]["PM2.5"]
     relevant_data = [f"{x['Timestamp']}:{x['Value']}" for x in pm_dict]
-    return relevant_data
\ No newline at end of file
+    return relevant_data
+
+def sensor_url(sensor_id, starttime, endtime, base_url=API_URL):
+    '''Builds API url for sensor data between two datetimes'''
+    return f"{base_url}/sensors/{sensor_id}/data/json/"\
+           f"?endtime={endtime.strftime(API_TIME_FORMAT)}"\
+           f"&starttime={starttime.strftime(API_TIME_FORMAT)}"
+
+def split_windows(starttime, endtime, window):
+    '''
+    Splits time range into consecutive windows
+    Window boundaries are aligned to multiples of :window: so the same
+    windows are produced for overlapping ranges, only the first and last
+    windows are cut to fit the range
+
+    Attributes:
+        starttime: datetime of start of range
+        endtime: datetime of end of range
+        window: timedelta size of each window
+
+    Returns: list of (start, end) datetime tuples
+    '''
+    windows = []
+    start = starttime
+    while start < endtime:
+        # Next multiple of window after start
+        end = EPOCH + ((start - EPOCH) // window + 1) * window
+        end = min(end, endtime)
+        windows.append((start, end))
+        start = end
+    return windows
+
+def make_session(pool_size):
+    '''Creates HTTP session which keeps :pool_size: connections alive'''
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+def fetch_window(session, sensor_id, start, end, base_url=API_URL, timeout=60):
+    '''
+    Fetches and scrubs readings for one window
+
+    Returns: list of readings in timestamp:value format
+    '''
+    with FETCH_SECONDS.time():
+        url = sensor_url(sensor_id, start, end, base_url)
+        response = session.get(url, timeout=timeout)
+        response.raise_for_status()
+        data = response.json()
+
+        # Windows with no readings have no sensor entry
+        if not data.get("sensors") or "PM2.5" not in data["sensors"][0]["data"]:
+            return []
+        return scrub_data(data)
+
+def load_window(session, cache, sensor_id, start, end, base_url=API_URL):
+    '''
+    Gets readings for one window from :cache: or the API
+    Windows fetched from the API are added to the cache
+
+    Returns: list of readings in timestamp:value format
+    '''
+    if cache is not None:
+        readings = cache.get(sensor_id, start, end)
+        if readings is not None:
+            WINDOWS.labels("cache").inc()
+            return readings
+
+    WINDOWS.labels("api").inc()
+    readings = fetch_window(session, sensor_id, start, end, base_url)
+    if cache is not None:
+        cache.put(sensor_id, start, end, readings)
+    return readings
+
+def drop_overlap(readings, last_timestamp):
+    '''
+    Removes readings already yielded by the previous window
+    Window end times are inclusive in the API so a reading on a boundary is
+    returned by both windows
+    '''
+    if last_timestamp is None:
+        return readings
+    return [x for x in readings if int(x.split(":", 1)[0]) > last_timestamp]
+
+def iter_api_data(sensor_id, starttime, endtime, window=datetime.timedelta(days=1),
+                  workers=4, base_url=API_URL, session=None, cache=None,
+                  executor=None):
+    '''
+    Streams sensor readings between two datetimes
+    The range is split into windows which are fetched concurrently by
+    :workers: threads over a shared connection pool. Windows are yielded in
+    chronological order as soon as they are available, with at most
+    :workers: windows fetched ahead of the consumer
+
+    Attributes:
+        sensor_id: ID of sensor in API
+        starttime: datetime of first reading
+        endtime: datetime of last reading
+        window: timedelta size of each request
+        workers: Maximum number of requests in flight for this sensor
+        base_url: API url, can be changed to point at a stub server
+        session: requests.Session to use, defaults to a new pooled session
+        cache: cache.ResponseCache to serve windows from, windows missing from
+            the cache are fetched from the API and added to it
+        executor: ThreadPoolExecutor to fetch on, sharing one executor between
+            several sensors limits the total number of requests in flight
+
+    Returns: generator of readings in timestamp:value format
+    '''
+    windows = split_windows(starttime, endtime, window)
+    logger.info("Pulling data for %s in %d windows", sensor_id, len(windows))
+
+    own_session = session is None
+    if own_session:
+        session = make_session(workers)
+
+    own_executor = executor is None
+    if own_executor:
+        executor = ThreadPoolExecutor(max_workers=workers)
+
+    pending = []
+    windows = iter(windows)
+    last_timestamp = None
+    try:
+        # Fill pipeline with first requests
+        for start, end in windows:
+            pending.append(executor.submit(load_window, session, cache, sensor_id,
+                                           start, end, base_url))
+            if len(pending) >= workers:
+                break
+
+        while pending:
+            readings = pending.pop(0).result()
+            # Request next window before handing readings to consumer
+            for start, end in windows:
+                pending.append(executor.submit(load_window, session, cache, sensor_id,
+                                               start, end, base_url))
+                break
+
+            readings = drop_overlap(readings, last_timestamp)
+            if readings:
+                last_timestamp = int(readings[-1].split(":", 1)[0])
+            for reading in readings:
+                yield reading
+    finally:
+        # Stop outstanding requests if consumer stops early
+        for future in pending:
+            future.cancel()
+        if own_executor:
+            executor.shutdown(wait=True)
+        if own_session:
+            session.close()
@@ -1,15 +1,107 @@
+import os
+import datetime
+from concurrent.futures import ThreadPoolExecutor
 import get_data
+import cache
 import publisher
+import connections
+import log
+import metrics
 
-# Get Data
-url = "http://uoweb3.ncl.ac.uk/api/v1.1/sensors/PER_AIRMON_MONITOR1135100/data/json/?endtime=20231009140308&starttime=20231001080000"
-data = get_data.get_api_data(url)
+logger = log.get_logger("main")
 
-# Connect to MQTT broker
-MQTT_BROKER_ALIAS = "emqx-broker"
-client = publisher.connect_to_mqtt(MQTT_BROKER_ALIAS)
+# Sensors to pull from the API, given as a comma separated list
+# Each sensor is published on its own topic, TOPIC/<sensor_id>
+SENSOR_IDS = os.environ.get("SENSOR_IDS", "PER_AIRMON_MONITOR1135100").split(",")
+TOPIC = "CSC8112"
+API_URL = os.environ.get("API_URL", get_data.API_URL)
+STARTTIME = datetime.datetime(2023, 10, 1, 8, 0, 0)
+ENDTIME = datetime.datetime(2023, 10, 9, 14, 3, 8)
 
-# Publish data
-print("Publishing data", flush=True)
-for valuepair in data:
-    publisher.publish_to_mqtt(client, "CSC8112", valuepair)   
\ No newline at end of file
+# Size of each API request, requests in flight per sensor and across all sensors
+FETCH_WINDOW_HOURS = int(os.environ.get("FETCH_WINDOW_HOURS", 24))
+FETCH_WORKERS = int(os.environ.get("FETCH_WORKERS", 4))
+MAX_IN_FLIGHT = int(os.environ.get("MAX_IN_FLIGHT", 16))
+# Number of sensors fetched and published at once
+SENSOR_WORKERS = int(os.environ.get("SENSOR_WORKERS", 8))
+
+# Directory and max size (MB) of on-disk cache of fetched windows
+CACHE_DIR = os.environ.get("CACHE_DIR", "cache")
+CACHE_MAX_MB = int(os.environ.get("CACHE_MAX_MB", 256))
+
+# Readings per MQTT frame and max time (ms) a reading waits for its frame
+BATCH_SIZE = int(os.environ.get("BATCH_SIZE", 100))
+BATCH_LINGER_MS = int(os.environ.get("BATCH_LINGER_MS", 50))
+# Format of frames, binary (see codec) or json lists of timestamp:value strings
+WIRE_FORMAT = os.environ.get("WIRE_FORMAT", "binary")
+# MQTT QoS of frames, 1 resends frames in flight when the broker reconnects
+MQTT_QOS = int(os.environ.get("MQTT_QOS", 1))
+# Port metrics are served on in the Prometheus text format, 0 to not serve
+METRICS_PORT = int(os.environ.get("METRICS_PORT", 9100))
+
+def inject_sensor(client, sensor_id, fetch_executor, session, response_cache):
+    '''
+    Streams readings of one sensor from the API to its MQTT topic
+
+    Attributes:
+        client: MQTT client shared by all sensors
+        sensor_id: ID of sensor in API
+        fetch_executor: ThreadPoolExecutor shared by all sensors for requests
+        session: requests.Session shared by all sensors
+        response_cache: cache.ResponseCache shared by all sensors
+
+    Returns: Number of readings published
+    '''
+    # Get Data
+    # Readings are streamed so publishing starts once the first window arrives
+    # Windows already fetched on a previous run are read from the cache
+    data = get_data.iter_api_data(sensor_id, STARTTIME, ENDTIME,
+                                  window=datetime.timedelta(hours=FETCH_WINDOW_HOURS),
+                                  workers=FETCH_WORKERS,
+                                  base_url=API_URL,
+                                  session=session,
+                                  cache=response_cache,
+                                  executor=fetch_executor)
+
+    # Publish data
+    batcher = publisher.BatchPublisher(client, f"{TOPIC}/{sensor_id}",
+                                       batch_size=BATCH_SIZE,
+                                       linger_ms=BATCH_LINGER_MS,
+                                       wire_format=WIRE_FORMAT,
+                                       series=sensor_id,
+                                       qos=MQTT_QOS)
+    count = 0
+    for valuepair in data:
+        batcher.publish(valuepair)
+        count += 1
+    batcher.wait()
+    return count
+
+if __name__ == '__main__':
+    log.setup("data-injector")
+    if METRICS_PORT:
+        metrics.serve(METRICS_PORT)
+
+    # Connect to MQTT broker while the response cache is opened
+    # One connection is shared by all sensors, network traffic (and
+    # reconnecting) is handled on paho's background thread
+    MQTT_BROKER_ALIAS = "emqx-broker"
+    client, response_cache = connections.concurrently(
+        lambda: publisher.connect_to_mqtt(MQTT_BROKER_ALIAS),
+        lambda: cache.ResponseCache(CACHE_DIR, max_bytes=CACHE_MAX_MB * 1024 * 1024))
+    client.loop_start()
+
+    session = get_data.make_session(MAX_IN_FLIGHT)
+
+    logger.info("Publishing data for %d sensors", len(SENSOR_IDS))
+    with ThreadPoolExecutor(max_workers=MAX_IN_FLIGHT) as fetch_executor,\
+         ThreadPoolExecutor(max_workers=SENSOR_WORKERS) as sensor_executor:
+        futures = {sensor_executor.submit(inject_sensor, client, sensor_id,
+                                          fetch_executor, session, response_cache): sensor_id
+                   for sensor_id in SENSOR_IDS}
+        for future, sensor_id in futures.items():
+            logger.info("Published %d readings for %s", future.result(), sensor_id,
+                        extra={"fields": {"sensor": sensor_id}})
+
+    session.close()
+    client.loop_stop()
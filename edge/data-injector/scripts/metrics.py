@@ -0,0 +1,252 @@
+'''
+Counters, gauges and histograms shared by data-injector, data-preprocessor
+and data-processor, keep the copies in each service identical
+
+Metrics are registered once at import of the module using them and kept in
+the process' registry, serve() exposes them in the Prometheus text format
+https://prometheus.io/docs/instrumenting/exposition_formats/
+
+    READINGS = metrics.counter("injector_readings_total", "Readings published")
+    READINGS.inc(len(frame))
+    FRAMES = metrics.counter("processor_messages_total", "Messages", ["format"])
+    FRAMES.labels("binary").inc()
+
+Recording is a lock and an add (a bisect too for histograms), cheap enough
+to sit on every message. Metrics of worker processes are not collected.
+'''
+import time
+import bisect
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Seconds, from 100 us up to 5 min
+DEFAULT_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                   0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+class Counter:
+    '''Value which only goes up'''
+    def __init__(self):
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def samples(self, name, labels):
+        return [(name, labels, self.value)]
+
+
+class Gauge:
+    '''Value which goes up and down, or is read from a function when exposed'''
+    def __init__(self):
+        self.value = 0
+        self.function = None
+        self.lock = threading.Lock()
+
+    def set(self, value):
+        self.value = value
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def dec(self, amount=1):
+        self.inc(-amount)
+
+    def set_function(self, function):
+        '''Reads the value from function when exposed, e.g. a queue's length'''
+        self.function = function
+
+    def samples(self, name, labels):
+        value = self.value
+        if self.function is not None:
+            try:
+                value = self.function()
+            except Exception:
+                value = float("nan")
+        return [(name, labels, value)]
+
+
+class Histogram:
+    '''
+    Counts of observed values in fixed buckets, with their sum and count
+
+    Attributes:
+        buckets: Ascending upper bounds of buckets, +Inf is added
+    '''
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0]*(len(self.buckets) + 1)
+        self.sum = 0.0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        i = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[i] += 1
+            self.sum += value
+
+    def time(self):
+        '''Context manager observing the seconds its block takes'''
+        return Timer(self)
+
+    def samples(self, name, labels):
+        with self.lock:
+            counts, total = list(self.counts), self.sum
+        samples = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float("inf"),), counts):
+            cumulative += count
+            samples.append((name + "_bucket", labels + (("le", _format(bound)),), cumulative))
+        samples.append((name + "_sum", labels, total))
+        samples.append((name + "_count", labels, cumulative))
+        return samples
+
+
+class Timer:
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.start)
+
+
+class Family:
+    '''
+    Metric with labels, each combination of label values is its own child
+
+    Attributes:
+        kind: "counter", "gauge" or "histogram"
+        name: Name of metric
+        help: Description of metric
+        labelnames: Names of labels
+        make: Function creating a child
+    '''
+    def __init__(self, kind, name, help, labelnames, make):
+        self.kind = kind
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.make = make
+        self.children = {}
+        self.lock = threading.Lock()
+
+    def labels(self, *values):
+        '''Gets child of label values, in the order of labelnames'''
+        child = self.children.get(values)
+        if child is None:
+            if len(values) != len(self.labelnames):
+                raise ValueError(f"{self.name} has labels {self.labelnames}, got {values}")
+            with self.lock:
+                child = self.children.setdefault(tuple(str(x) for x in values), self.make())
+                self.children[values] = child
+        return child
+
+    def samples(self):
+        samples = []
+        seen = set()
+        for values, child in list(self.children.items()):
+            if id(child) in seen:
+                continue
+            seen.add(id(child))
+            samples += child.samples(self.name, tuple(zip(self.labelnames, (str(x) for x in values))))
+        return samples
+
+
+class Registry:
+    '''Metrics of a process by name'''
+    def __init__(self):
+        self.families = {}
+        self.lock = threading.Lock()
+
+    def register(self, kind, name, help, labelnames, make):
+        '''
+        Gets metric of name, creating it if needed
+        Without labels the metric's only child is returned
+
+        Raises:
+            ValueError: if name is registered as another kind of metric
+        '''
+        with self.lock:
+            family = self.families.get(name)
+            if family is None:
+                family = self.families[name] = Family(kind, name, help, labelnames, make)
+            elif family.kind != kind or family.labelnames != tuple(labelnames):
+                raise ValueError(f"Metric {name} is already registered as a {family.kind}")
+        return family if labelnames else family.labels()
+
+    def exposition(self):
+        '''Gets metrics in the Prometheus text format'''
+        lines = []
+        for family in list(self.families.values()):
+            lines.append(f"# HELP {family.name} {family.help}")
+            lines.append(f"# TYPE {family.name} {family.kind}")
+            for name, labels, value in family.samples():
+                if labels:
+                    name += "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in labels) + "}"
+                lines.append(f"{name} {_format(value)}")
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+def counter(name, help, labelnames=()):
+    return REGISTRY.register("counter", name, help, labelnames, Counter)
+
+def gauge(name, help, labelnames=()):
+    return REGISTRY.register("gauge", name, help, labelnames, Gauge)
+
+def histogram(name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+    return REGISTRY.register("histogram", name, help, labelnames, lambda: Histogram(buckets))
+
+def since(sent_at_ms):
+    '''Gets seconds since a source timestamp in ms since epoch, see codec'''
+    return max(time.time() - sent_at_ms / 1000, 0.0)
+
+def _format(value):
+    if value == float("inf"):
+        return "+Inf"
+    if value == float("-inf"):
+        return "-Inf"
+    if value != value:
+        return "NaN"
+    return repr(float(value)) if type(value) == float else str(value)
+
+def _escape(value):
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+class Handler(BaseHTTPRequestHandler):
+    '''Serves the registry on GET /metrics'''
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = REGISTRY.exposition().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def serve(port, host="0.0.0.0"):
+    '''
+    Serves metrics on http://<host>:<port>/metrics on a background thread
+
+    Returns: ThreadingHTTPServer, shutdown() stops it
+    '''
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    return server
@@ -1,47 +1,163 @@
 from paho.mqtt import client as mqtt_client
+import threading
 import time
 import json
+import codec
+import connections
+import log
+import metrics
 
-def connect_to_mqtt(ip, port=1883, attempts=10):
+logger = log.get_logger(__name__)
+
+READINGS = metrics.counter("injector_readings_total", "Readings published")
+FRAMES = metrics.counter("injector_frames_total", "MQTT messages published")
+PUBLISH_SECONDS = metrics.histogram("injector_publish_seconds", "Time to encode and publish a frame")
+
+def connect_to_mqtt(ip, port=1883, attempts=None, timeout=60):
+    '''
+    Connects to MQTT broker, retrying with backoff (see connections)
+    Once connected the client reconnects by itself whenever the connection
+    is lost, while its network loop runs (loop_start)
+
+    Attributes:
+        ip: IP of message broker
+        port: Port of message broker
+        attempts: Maximum number of attempts, None for no limit
+        timeout: Seconds to keep trying
+
+    Returns: paho MQTT client
+
+    Raises:
+        ConnectionError: if no attempt succeeds
+    '''
     # Create a mqtt client object
     client = mqtt_client.Client()
     client.on_message = on_message
+    client.on_connect = on_connect
     client.on_disconnect = on_disconnect
-    
-    connected = False
-    for _ in range(attempts):
-        try:
-            # Attempt connection to MQTT service
-            client.connect(ip, port)
-             
-            # If successful
-            print(f"Connected to {ip}", flush=True)
-            connected = True
-            break
-        except:
-            # Sleep for 5 seconds before trying again
-            print(f"({ip}) could not connect, trying again in 5 seconds", flush=True)
-            time.sleep(5)
-        
-    if not connected:
-        raise ConnectionError(f"Could not connect to {ip}")
-    else:
-        return client
+    client.reconnect_delay_set(connections.MIN_DELAY, connections.MAX_DELAY)
+
+    connections.retry(lambda: client.connect(ip, port), f"MQTT broker ({ip})",
+                      timeout=timeout, attempts=attempts, probe=(ip, port))
+    return client
 
-def publish_to_mqtt(client, topic, msg, retain=False):
+def publish_to_mqtt(client, topic, msg, retain=False, qos=0):
     assert type(topic) == str
     assert type(msg) == str or\
             type(msg) == int or\
             type(msg) == float or\
             type(msg) == None or\
-            type(msg) == bytearray
+            type(msg) == bytearray or\
+            type(msg) == list or\
+            type(msg) == bytes
     
     # Publish message to MQTT
-    msg = json.dumps(msg)
-    return client.publish(topic, msg, retain=retain)
+    # bytes are binary frames and are sent as they are
+    if type(msg) != bytes:
+        msg = json.dumps(msg)
+    return client.publish(topic, msg, qos=qos, retain=retain)
+
+
+class BatchPublisher:
+    '''
+    Groups readings into framed batches before publishing to MQTT
+    A frame is a binary frame of timestamp and value columns (see codec) or a
+    JSON list of "timestamp:value" strings and is sent as one MQTT packet
+    once :batch_size: readings are buffered or the oldest buffered reading
+    has waited :linger_ms: milliseconds, whichever comes first
+
+    Attributes:
+        client: MQTT client connection to broker
+        topic: Topic to publish frames to
+        batch_size: Maximum number of readings in a frame
+            (note) a batch_size of 1 publishes single-reading messages
+        linger_ms: Maximum time a reading is held before its frame is sent
+        wire_format: "binary" or "json"
+        series: Series (sensor ID) written in binary frames
+        qos: MQTT QoS of frames, with 1 frames not yet acknowledged when
+            the connection is lost are sent again once reconnected
+    '''
+    def __init__(self, client, topic, batch_size=100, linger_ms=50,
+                 wire_format="json", series="", qos=0):
+        assert type(topic) == str
+        assert batch_size >= 1
+
+        self.client = client
+        self.topic = topic
+        self.batch_size = batch_size
+        self.linger_ms = linger_ms
+        self.wire_format = wire_format
+        self.series = series
+        self.qos = qos
+
+        # MQTTMessageInfo of last sent frame
+        self.last_info = None
+
+        self._buffer = []
+        self._lock = threading.Lock()
+        self._timer = None
+
+    def publish(self, msg):
+        '''
+        Adds reading to current frame
+        Sends frame if it is full
+        '''
+        with self._lock:
+            self._buffer.append(msg)
+            if len(self._buffer) >= self.batch_size:
+                self._send_locked()
+            elif self._timer is None:
+                # First reading in frame, start linger timer
+                self._timer = threading.Timer(self.linger_ms / 1000, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+
+    def flush(self):
+        '''Sends any buffered readings'''
+        with self._lock:
+            self._send_locked()
+
+    def wait(self):
+        '''Sends any buffered readings and blocks until they are published'''
+        self.flush()
+        if self.last_info is not None:
+            self.last_info.wait_for_publish()
+
+    def _send_locked(self):
+        '''Sends buffered readings, lock must be held by caller'''
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if not self._buffer:
+            return
+
+        start = time.perf_counter()
+        if self.wire_format == "binary":
+            pairs = [x.split(":") for x in self._buffer]
+            frame = codec.encode_readings(self.series,
+                                          [int(timestamp) for timestamp, _ in pairs],
+                                          [float(value) for _, value in pairs])
+            self.last_info = publish_to_mqtt(self.client, self.topic, frame, qos=self.qos)
+        # Send single readings in the original unframed format
+        elif len(self._buffer) == 1:
+            self.last_info = publish_to_mqtt(self.client, self.topic, self._buffer[0], qos=self.qos)
+        else:
+            self.last_info = publish_to_mqtt(self.client, self.topic, self._buffer, qos=self.qos)
+        PUBLISH_SECONDS.observe(time.perf_counter() - start)
+        FRAMES.inc()
+        READINGS.inc(len(self._buffer))
+        self._buffer = []
     
-def on_message():
+def on_message(client, userdata, msg):
     pass
 
-def on_disconnect():
-    pass
+def on_connect(client, userdata, flags, rc):
+    if rc == 0:
+        logger.info("MQTT session established")
+    else:
+        logger.warning("MQTT broker refused connection: %s", mqtt_client.connack_string(rc))
+
+def on_disconnect(client, userdata, rc):
+    '''Called when the connection is lost or closed, paho reconnects by itself'''
+    if rc != 0:
+        logger.warning("Lost connection to MQTT broker, reconnecting: %s", mqtt_client.error_string(rc))
@@ -0,0 +1,10 @@
+'''
+Makes data-injector's scripts importable as they are in its container,
+run each service's tests on their own as services share module names
+
+    python -m pytest edge/data-injector/tests
+'''
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "scripts"))
@@ -0,0 +1,112 @@
+import json
+import datetime
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+import pytest
+import requests
+import get_data
+
+HOUR = datetime.timedelta(hours=1)
+START = datetime.datetime(2023, 1, 1)
+# Hours the stub sensor has no readings for
+GAP = (datetime.datetime(2023, 1, 2, 6), datetime.datetime(2023, 1, 2, 18))
+
+
+def ms(when):
+    return int((when - get_data.EPOCH).total_seconds() * 1000)
+
+
+class StubAPI(BaseHTTPRequestHandler):
+    '''
+    Urban Observatory API with a reading every hour on the hour, start and
+    end times are inclusive as in the real API
+    '''
+    requests = []
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        start = datetime.datetime.strptime(query["starttime"][0], get_data.API_TIME_FORMAT)
+        end = datetime.datetime.strptime(query["endtime"][0], get_data.API_TIME_FORMAT)
+        self.requests.append((url.path, start, end))
+        if url.path.startswith("/sensors/broken/"):
+            self.send_response(500)
+            self.end_headers()
+            return
+
+        readings = []
+        when = START + (max(start, START) - START) // HOUR * HOUR
+        if when < start:
+            when += HOUR
+        while when <= end:
+            if not GAP[0] <= when < GAP[1]:
+                readings.append({"Timestamp": ms(when), "Value": when.hour})
+            when += HOUR
+        body = {"sensors": [{"data": {"PM2.5": readings}}]} if readings else {"sensors": []}
+        payload = json.dumps(body).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def api():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubAPI)
+    thread = threading.Thread(target=server.serve_forever, kwargs={"poll_interval": 0.01}, daemon=True)
+    thread.start()
+    StubAPI.requests = []
+    yield f"http://127.0.0.1:{server.server_address[1]}"
+    server.shutdown()
+    server.server_close()
+
+
+def expected(start, end):
+    readings = []
+    when = start
+    while when <= end:
+        if not GAP[0] <= when < GAP[1]:
+            readings.append(f"{ms(when)}:{when.hour}")
+        when += HOUR
+    return readings
+
+
+def test_split_windows_are_aligned():
+    start = datetime.datetime(2023, 1, 1, 13)
+    end = datetime.datetime(2023, 1, 3, 2)
+    windows = get_data.split_windows(start, end, datetime.timedelta(days=1))
+    assert windows == [(start, datetime.datetime(2023, 1, 2)),
+                       (datetime.datetime(2023, 1, 2), datetime.datetime(2023, 1, 3)),
+                       (datetime.datetime(2023, 1, 3), end)]
+
+@pytest.mark.parametrize("workers", [1, 4])
+def test_readings_are_streamed_in_order_without_duplicates(api, workers):
+    end = START + datetime.timedelta(days=5)
+    readings = list(get_data.iter_api_data("sensor", START, end, workers=workers, base_url=api))
+    assert readings == expected(START, end)
+    assert len(StubAPI.requests) == 5
+    assert all(path == "/sensors/sensor/data/json/" for path, _, _ in StubAPI.requests)
+
+def test_windows_without_readings_are_skipped(api):
+    start = datetime.datetime(2023, 1, 2, 6)
+    end = datetime.datetime(2023, 1, 2, 18)
+    readings = list(get_data.iter_api_data("sensor", start, end, window=datetime.timedelta(hours=6),
+                                           base_url=api))
+    assert readings == [f"{ms(end)}:18"]
+
+def test_http_errors_are_raised(api):
+    with pytest.raises(requests.HTTPError):
+        list(get_data.iter_api_data("broken", START, START + datetime.timedelta(days=2), base_url=api))
+
+def test_stopping_early_cancels_outstanding_windows(api):
+    stream = get_data.iter_api_data("sensor", START, START + datetime.timedelta(days=60),
+                                    workers=2, base_url=api)
+    first = next(stream)
+    stream.close()
+    assert first == expected(START, START)[0]
+    assert len(StubAPI.requests) <= 4
@@ -0,0 +1,251 @@
+import math
+
+class Count:
+    '''Number of values'''
+    def __init__(self):
+        self.n = 0
+
+    def add(self, x):
+        self.n += 1
+
+    def merge(self, other):
+        self.n += other.n
+
+    def result(self):
+        return self.n
+
+
+class Mean:
+    '''Mean of values from running sum'''
+    def __init__(self):
+        self.n = 0
+        self.total = 0.0
+
+    def add(self, x):
+        self.n += 1
+        self.total += x
+
+    def merge(self, other):
+        self.n += other.n
+        self.total += other.total
+
+    def result(self):
+        return self.total / self.n if self.n > 0 else None
+
+
+class Min:
+    '''Smallest value'''
+    def __init__(self):
+        self.value = None
+
+    def add(self, x):
+        if self.value is None or x < self.value:
+            self.value = x
+
+    def merge(self, other):
+        if other.value is not None:
+            self.add(other.value)
+
+    def result(self):
+        return self.value
+
+
+class Max:
+    '''Largest value'''
+    def __init__(self):
+        self.value = None
+
+    def add(self, x):
+        if self.value is None or x > self.value:
+            self.value = x
+
+    def merge(self, other):
+        if other.value is not None:
+            self.add(other.value)
+
+    def result(self):
+        return self.value
+
+
+class Variance:
+    '''
+    Sample variance of values with Welford's online algorithm
+    https://en.wikipedia.org/wiki/Algorithms_for_calculating_variance
+    '''
+    def __init__(self):
+        self.n = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+
+    def add(self, x):
+        self.n += 1
+        delta = x - self.mean
+        self.mean += delta / self.n
+        self.m2 += delta * (x - self.mean)
+
+    def merge(self, other):
+        # Chan et al. parallel combination
+        n = self.n + other.n
+        if n == 0:
+            return
+        delta = other.mean - self.mean
+        self.mean += delta * other.n / n
+        self.m2 += other.m2 + delta * delta * self.n * other.n / n
+        self.n = n
+
+    def result(self):
+        return self.m2 / (self.n - 1) if self.n > 1 else None
+
+
+class QuantileSketch:
+    '''
+    Mergeable sketch for approximate quantiles
+    Values are counted in logarithmically sized buckets so any quantile is
+    returned within :relative_accuracy: of the true value (DDSketch)
+    https://arxiv.org/abs/1908.10693
+    Memory is bounded by :max_buckets:, when exceeded the lowest buckets are
+    collapsed together which only reduces accuracy of low quantiles
+
+    Attributes:
+        relative_accuracy: Maximum relative error of returned quantiles
+        max_buckets: Maximum number of buckets kept for each sign
+    '''
+    def __init__(self, relative_accuracy=0.01, max_buckets=2048):
+        self.relative_accuracy = relative_accuracy
+        self.max_buckets = max_buckets
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self._log_gamma = math.log(self.gamma)
+        self.positive = {}
+        self.negative = {}
+        self.zero = 0
+        self.n = 0
+
+    def _key(self, x):
+        '''Bucket index of absolute value x'''
+        return math.ceil(math.log(x) / self._log_gamma)
+
+    def _value(self, key):
+        '''Representative value of bucket'''
+        return 2 * self.gamma ** key / (self.gamma + 1)
+
+    def add(self, x):
+        self.n += 1
+        if x > 0:
+            key = self._key(x)
+            self.positive[key] = self.positive.get(key, 0) + 1
+            if len(self.positive) > self.max_buckets:
+                self._collapse(self.positive)
+        elif x < 0:
+            key = self._key(-x)
+            self.negative[key] = self.negative.get(key, 0) + 1
+            if len(self.negative) > self.max_buckets:
+                self._collapse(self.negative)
+        else:
+            self.zero += 1
+
+    def _collapse(self, buckets):
+        '''Merges lowest buckets until max_buckets remain'''
+        keys = sorted(buckets)
+        excess = len(keys) - self.max_buckets
+        merged = sum(buckets.pop(key) for key in keys[:excess])
+        buckets[keys[excess]] += merged
+
+    def merge(self, other):
+        for key, count in other.positive.items():
+            self.positive[key] = self.positive.get(key, 0) + count
+        for key, count in other.negative.items():
+            self.negative[key] = self.negative.get(key, 0) + count
+        self.zero += other.zero
+        self.n += other.n
+        if len(self.positive) > self.max_buckets:
+            self._collapse(self.positive)
+        if len(self.negative) > self.max_buckets:
+            self._collapse(self.negative)
+
+    def quantile(self, q):
+        '''Gets approximate q-quantile, 0 <= q <= 1'''
+        if self.n == 0:
+            return None
+        rank = q * (self.n - 1)
+
+        # Walk buckets from most negative to most positive value
+        seen = 0
+        for key in sorted(self.negative, reverse=True):
+            seen += self.negative[key]
+            if seen > rank:
+                return -self._value(key)
+        seen += self.zero
+        if seen > rank:
+            return 0.0
+        for key in sorted(self.positive):
+            seen += self.positive[key]
+            if seen > rank:
+                return self._value(key)
+        return self._value(max(self.positive))
+
+
+# Aggregates which can be emitted by name
+# Quantiles are given by q and read from a sketch shared by the window
+AGGREGATES = {
+    "count": Count,
+    "mean": Mean,
+    "min": Min,
+    "max": Max,
+    "variance": Variance,
+    "p50": 0.50,
+    "p95": 0.95,
+}
+
+def parse_aggregates(names):
+    '''
+    Parses comma separated list of aggregate names
+
+    Returns: tuple of aggregate names
+
+    Raises:
+        ValueError: if a name is not in AGGREGATES
+    '''
+    names = tuple(x.strip() for x in names.split(",") if x.strip())
+    for name in names:
+        if name not in AGGREGATES:
+            raise ValueError(f"Unknown aggregate {name}, expected one of {', '.join(AGGREGATES)}")
+    return names
+
+
+class AggregateState:
+    '''
+    Constant memory running state of a window
+    Keeps one instance of each configured aggregate, values are never stored
+    All quantiles are read from a single QuantileSketch
+
+    Attributes:
+        names: Names of aggregates to keep, see AGGREGATES
+    '''
+    def __init__(self, names=("mean",)):
+        self.names = names
+        self.count = 0
+        # Aggregate objects, or q for quantiles
+        self.aggregates = [AGGREGATES[name] for name in names]
+        self.aggregates = [x if isinstance(x, float) else x() for x in self.aggregates]
+        self._updated = [x for x in self.aggregates if not isinstance(x, float)]
+        self.sketch = None
+        if len(self._updated) < len(self.aggregates):
+            self.sketch = QuantileSketch()
+            self._updated.append(self.sketch)
+
+    def add(self, x):
+        '''Adds value to window'''
+        self.count += 1
+        for aggregate in self._updated:
+            aggregate.add(x)
+
+    def merge(self, other):
+        '''Combines state of another window with the same aggregates'''
+        self.count += other.count
+        for aggregate, other_aggregate in zip(self._updated, other._updated):
+            aggregate.merge(other_aggregate)
+
+    def result(self):
+        '''Gets list of aggregate values in order of names'''
+        return [self.sketch.quantile(x) if isinstance(x, float) else x.result()
+                for x in self.aggregates]
@@ -0,0 +1,209 @@
+'''
+Binary wire format for readings and aggregates
+Shared by data-injector, data-preprocessor and data-processor, keep the
+copies in each service identical
+
+Frame layout, little-endian:
+    header      2s magic b"WS", B version, B kind, I count, q sent_at (ms)
+    series      H length, utf-8 bytes
+    fields      H length, utf-8 comma separated field names (aggregates only)
+    padding     zero bytes up to a multiple of 8
+    timestamps  count x q
+    values      count x d per field, readings have the single field "value"
+
+Columns are 8-byte aligned so they can be read in place with
+memoryview.cast without copying the payload.
+Payloads which do not start with the magic bytes are the original JSON
+encoded "timestamp:value" format.
+'''
+import sys
+import json
+import math
+import time
+import struct
+from array import array
+
+MAGIC = b"WS"
+VERSION = 1
+CONTENT_TYPE = "application/x-weathersense"
+JSON_CONTENT_TYPE = "application/json"
+
+KIND_READINGS = 1
+KIND_AGGREGATES = 2
+
+HEADER = struct.Struct("<2sBBIq")
+LENGTH = struct.Struct("<H")
+
+# Columns can be cast in place on little-endian hosts
+NATIVE = sys.byteorder == "little"
+
+
+class Frame:
+    '''
+    Decoded frame
+    timestamps and columns are memoryviews into the payload on
+    little-endian hosts, arrays otherwise
+
+    Attributes:
+        kind: KIND_READINGS or KIND_AGGREGATES
+        series: Series (sensor ID) of frame, "" if not set
+        sent_at: Time frame was encoded in ms since epoch
+        fields: Names of value columns
+        timestamps: int64 timestamps
+        columns: float64 column per field, None values are NaN
+    '''
+    def __init__(self, kind, series, sent_at, fields, timestamps, columns):
+        self.kind = kind
+        self.series = series
+        self.sent_at = sent_at
+        self.fields = fields
+        self.timestamps = timestamps
+        self.columns = columns
+
+    def __len__(self):
+        return len(self.timestamps)
+
+    @property
+    def values(self):
+        '''First value column'''
+        return self.columns[0]
+
+    def to_strings(self):
+        '''Converts frame to the original timestamp:value[:value...] strings'''
+        if len(self.columns) == 1:
+            return [f"{ts}:{value}" for ts, value in zip(self.timestamps, self.columns[0])]
+        return [f"{ts}:" + ":".join(str(nan_to_none(x)) for x in row)
+                for ts, row in zip(self.timestamps, zip(*self.columns))]
+
+
+def is_binary(payload):
+    '''Checks payload is a binary frame rather than JSON'''
+    return payload[:2] == MAGIC
+
+def _encode(kind, series, fields, timestamps, columns, sent_at):
+    '''Packs frame, see module docstring for layout'''
+    if sent_at is None:
+        sent_at = int(time.time() * 1000)
+    series = series.encode()
+    fields = ",".join(fields).encode() if kind == KIND_AGGREGATES else b""
+
+    head = HEADER.pack(MAGIC, VERSION, kind, len(timestamps), sent_at)\
+        + LENGTH.pack(len(series)) + series\
+        + LENGTH.pack(len(fields)) + fields
+    head += b"\0" * (-len(head) % 8)
+
+    body = array("q", timestamps)
+    parts = [head, body]
+    for column in columns:
+        parts.append(array("d", column))
+    if not NATIVE:
+        for part in parts[1:]:
+            part.byteswap()
+    return b"".join(part if type(part) == bytes else part.tobytes() for part in parts)
+
+def encode_readings(series, timestamps, values, sent_at=None):
+    '''
+    Encodes readings as binary frame
+
+    Attributes:
+        series: Series (sensor ID) of readings
+        timestamps: Sequence of integer timestamps
+        values: Sequence of float values
+        sent_at: Time in ms since epoch, defaults to now
+
+    Returns: bytes
+    '''
+    return _encode(KIND_READINGS, series, ("value",), timestamps, [values], sent_at)
+
+def encode_aggregates(series, fields, starts, columns, sent_at=None):
+    '''
+    Encodes window aggregates as binary frame
+
+    Attributes:
+        series: Series (sensor ID) of windows
+        fields: Names of aggregates in each window
+        starts: Sequence of integer window start timestamps
+        columns: Sequence of values for each field, None values are sent as NaN
+        sent_at: Time in ms since epoch, defaults to now
+
+    Returns: bytes
+    '''
+    columns = [[math.nan if x is None else x for x in column] for column in columns]
+    return _encode(KIND_AGGREGATES, series, fields, starts, columns, sent_at)
+
+def decode_header(payload):
+    '''
+    Decodes everything before the columns of a binary frame
+
+    Returns: tuple of kind, series, sent_at, fields, count and the offset
+        of the timestamp column
+
+    Raises:
+        ValueError: if payload is not a frame of a supported version
+    '''
+    view = memoryview(payload)
+    if len(view) < HEADER.size:
+        raise ValueError("Frame too short")
+    magic, version, kind, count, sent_at = HEADER.unpack_from(view, 0)
+    if magic != MAGIC:
+        raise ValueError("Not a binary frame")
+    if version != VERSION:
+        raise ValueError(f"Unsupported frame version {version}")
+
+    offset = HEADER.size
+    (length,) = LENGTH.unpack_from(view, offset)
+    series = bytes(view[offset + 2:offset + 2 + length]).decode()
+    offset += 2 + length
+    (length,) = LENGTH.unpack_from(view, offset)
+    fields = bytes(view[offset + 2:offset + 2 + length]).decode()
+    offset += 2 + length
+    offset += -offset % 8
+
+    fields = tuple(fields.split(",")) if kind == KIND_AGGREGATES else ("value",)
+    return kind, series, sent_at, fields, count, offset
+
+def decode(payload):
+    '''
+    Decodes binary frame without copying its columns
+
+    Returns: Frame
+
+    Raises:
+        ValueError: if payload is not a frame of a supported version
+    '''
+    kind, series, sent_at, fields, count, offset = decode_header(payload)
+    view = memoryview(payload)
+    if len(view) != offset + 8 * count * (1 + len(fields)):
+        raise ValueError("Frame length does not match header")
+
+    timestamps = _column(view, offset, count, "q")
+    offset += 8 * count
+    columns = []
+    for _ in fields:
+        columns.append(_column(view, offset, count, "d"))
+        offset += 8 * count
+    return Frame(kind, series, sent_at, fields, timestamps, columns)
+
+def _column(view, offset, count, typecode):
+    '''Reads column of count 8-byte values in place'''
+    column = view[offset:offset + 8 * count]
+    if NATIVE:
+        return column.cast(typecode)
+    column = array(typecode, column)
+    column.byteswap()
+    return column
+
+def nan_to_none(x):
+    '''Converts NaN back to None'''
+    return None if x != x else x
+
+def decode_json(payload):
+    '''
+    Decodes original JSON payload, a single string or a list of strings
+
+    Returns: list of timestamp:value strings or tokens such as finished
+    '''
+    payload = json.loads(payload)
+    if type(payload) == list:
+        return [str(x) for x in payload]
+    return [str(payload)]
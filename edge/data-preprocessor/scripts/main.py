@@ -1,32 +1,145 @@
+import os
 import subscriber
 import publisher
+import aggregates
+import windowing
+import sharding
+import spool
+import pipeline
+import connections
+import log
+import metrics
+
+logger = log.get_logger("main")
 
 MQTT_BROKER_ALIAS = "emqx-broker"
 RABBIT_IP = "192.168.0.100"
+# Comma separated aggregates sent for each window, the first is forecasted by
+# data-processor (count, mean, min, max, variance, p50, p95)
+AGGREGATES = aggregates.parse_aggregates(os.environ.get("AGGREGATES", "mean"))
+# Seconds a reading may arrive behind the newest reading and still be counted
+ALLOWED_LATENESS = int(os.environ.get("ALLOWED_LATENESS", 3600))
+# Windows to aggregate over, e.g. 1d, 1h, hopping:1d/1h or sliding:1h/5m
+# aligned to midnight in WINDOW_TZ (UTC, local or UTC offset in seconds)
+WINDOW = windowing.parse_window(os.environ.get("WINDOW", "1d"),
+                                tz=windowing.parse_tz(os.environ.get("WINDOW_TZ", "UTC")))
+# Worker processes to spread series over, 0 processes in the main process
+PREPROCESS_WORKERS = int(os.environ.get("PREPROCESS_WORKERS", os.cpu_count() or 1))
+# Outlier detector of each series, e.g. static:50, static:0:50, zscore:96:3,
+# hampel:25:3 or none
+OUTLIER_DETECTOR = os.environ.get("OUTLIER_DETECTOR", "static:50")
+# Rejected readings are published to OUTLIER_TOPIC/<sensor_id> when set
+OUTLIER_TOPIC = os.environ.get("OUTLIER_TOPIC")
+# Format aggregates are forwarded in, binary frames (see codec) or json
+# strings. Readings are accepted in either format
+WIRE_FORMAT = os.environ.get("WIRE_FORMAT", "binary")
+# Compression of binary frames sent to data-processor, gorilla, zlib, auto
+# (whichever is smaller) or none
+COMPRESSION = os.environ.get("COMPRESSION", "auto")
+# Aggregates per batch acknowledged by RabbitMQ
+RABBIT_BATCH_SIZE = int(os.environ.get("RABBIT_BATCH_SIZE", 100))
+# Aggregates are kept in a spool on disk while RabbitMQ is unreachable
+# Disk use is bounded by SPOOL_MAX_MB, spooled aggregates older than
+# SPOOL_RETENTION_HOURS are dropped (0 keeps them until sent)
+SPOOL_DIR = os.environ.get("SPOOL_DIR", "spool")
+SPOOL_SEGMENT_MB = int(os.environ.get("SPOOL_SEGMENT_MB", 16))
+SPOOL_MAX_MB = int(os.environ.get("SPOOL_MAX_MB", 1024))
+SPOOL_RETENTION_HOURS = float(os.environ.get("SPOOL_RETENTION_HOURS", 0))
+# MQTT messages waiting to be preprocessed and results waiting to be sent
+# When the ingest queue is full BACKPRESSURE decides what happens to new
+# messages: block, drop_newest or drop_oldest
+INGEST_QUEUE_SIZE = int(os.environ.get("INGEST_QUEUE_SIZE", 10000))
+EGRESS_QUEUE_SIZE = int(os.environ.get("EGRESS_QUEUE_SIZE", 10000))
+BACKPRESSURE = os.environ.get("BACKPRESSURE", "block")
+# Longest delay (s) between reconnection attempts during an outage, attempts
+# start tens of ms apart and back off to it
+RABBIT_RETRY_INTERVAL = float(os.environ.get("RABBIT_RETRY_INTERVAL", 5))
+# Port metrics are served on in the Prometheus text format, 0 to not serve
+METRICS_PORT = int(os.environ.get("METRICS_PORT", 9100))
+
+def instrument(callback):
+     '''Exposes queue depths and publisher counters of callback as gauges'''
+     depth = metrics.gauge("preprocessor_queue_depth", "Items waiting in a pipeline queue", ["queue"])
+     for name, queue in (("ingest", callback.pipeline.ingest), ("egress", callback.pipeline.egress)):
+          depth.labels(name).set_function(queue.__len__)
+     dropped = metrics.gauge("preprocessor_dropped", "Messages dropped by backpressure")
+     dropped.set_function(lambda: callback.pipeline.ingest.dropped)
+     publisher_stats = metrics.gauge("preprocessor_rabbit", "RabbitMQ publisher counters", ["counter"])
+     for name in ("published", "batches", "spooled", "outages"):
+          publisher_stats.labels(name).set_function(
+               lambda name=name: getattr(callback.rabbit_publisher, name))
+     spooled = metrics.gauge("preprocessor_spool_pending_bytes", "Bytes of spooled messages not yet sent")
+     spooled.set_function(lambda: callback.rabbit_publisher.spool.pending())
 
 if __name__ == '__main__':
-     # Connect to broker
-     print("Connecting to EMQX Broker", flush=True)
-     emqx_client, callback_obj  = subscriber.connect_to_mqtt(MQTT_BROKER_ALIAS)
-     
-     # Connecting to RabbitMQ broker
-     print("Connecting to RabbitMQ", flush=True)
-     rabbitmq_client= publisher.connect_to_rabbitmq(RABBIT_IP)
+     log.setup("data-preprocessor")
+     if METRICS_PORT:
+          metrics.serve(METRICS_PORT)
 
-     # Pass through client information to callback object to enable message forwarding
-     callback_obj.rabbit_channel = rabbitmq_client
+     # Start preprocessing workers, each series has its own window state
+     logger.info("Starting %d preprocessing workers", PREPROCESS_WORKERS)
+     shards = sharding.ShardedPreprocessor(PREPROCESS_WORKERS,
+                                           aggregates=AGGREGATES,
+                                           allowed_lateness=ALLOWED_LATENESS,
+                                           window=WINDOW,
+                                           outlier_detector=OUTLIER_DETECTOR,
+                                           keep_rejected=OUTLIER_TOPIC is not None,
+                                           structured=WIRE_FORMAT == "binary")
+
+     # Connect to EMQX and RabbitMQ brokers at once, they are independent
+     logger.info("Connecting to EMQX and RabbitMQ brokers")
+     (emqx_client, callback_obj), rabbitmq_client = connections.concurrently(
+          lambda: subscriber.connect_to_mqtt(MQTT_BROKER_ALIAS, shards=shards,
+                                             outlier_topic=OUTLIER_TOPIC,
+                                             wire_format=WIRE_FORMAT,
+                                             fields=AGGREGATES,
+                                             compress=COMPRESSION),
+          lambda: publisher.connect_to_rabbitmq(RABBIT_IP))
 
      # Wait for heartbeat from cloud subscriber
-     print("Waiting for heartbeat message from data-processor", flush=True)
+     logger.info("Waiting for heartbeat message from data-processor")
      publisher.rabbitmq_subscribe_to_queue(rabbitmq_client, "heartbeat")
 
+     # Pass through client information to callback object to enable message forwarding
+     # Aggregates spooled by an earlier run are sent first
+     outbox = spool.Spool(SPOOL_DIR,
+                          segment_bytes=SPOOL_SEGMENT_MB * 1024 * 1024,
+                          max_bytes=SPOOL_MAX_MB * 1024 * 1024,
+                          retention=SPOOL_RETENTION_HOURS * 3600 or None)
+     callback_obj.rabbit_publisher = publisher.RabbitPublisher(
+         rabbitmq_client,
+         batch_size=RABBIT_BATCH_SIZE,
+         spool=outbox,
+         connect=lambda: publisher.connect_to_rabbitmq(RABBIT_IP, attempts=1),
+         retry_interval=RABBIT_RETRY_INTERVAL)
+
+     # Receive, preprocess and publish on separate threads so a slow broker
+     # does not stall MQTT
+     # (note) the RabbitMQ connection is only used by the egress thread from here
+     callback_obj.pipeline = pipeline.Pipeline(callback_obj.process,
+                                               callback_obj.publish,
+                                               poll=callback_obj.poll,
+                                               idle=callback_obj.rabbit_publisher.poll,
+                                               ingest_size=INGEST_QUEUE_SIZE,
+                                               egress_size=EGRESS_QUEUE_SIZE,
+                                               policy=BACKPRESSURE)
+     callback_obj.pipeline.start()
+     instrument(callback_obj)
+
      # Send heartbeat message to producer to show I am alive
-     print("Sending heartbeat message to data-injector", flush=True) 
+     logger.info("Sending heartbeat message to data-injector") 
      subscriber.publish_to_mqtt(emqx_client, "heartbeat", "ack", retain=True)
 
-     # Subscribe to CSC8112 topic
-     subscriber.subscribe(emqx_client, "CSC8112")
+     # Subscribe to per-sensor CSC8112/<sensor_id> topics, the filter also
+     # matches the CSC8112 topic of single-sensor injectors, so a second
+     # subscription to it would deliver every reading twice
+     subscriber.subscribe(emqx_client, ["CSC8112/#"])
 
      # When message transmission has finished disconnect from clients
-     rabbitmq_client.close()
-     emqx_client.disconnect()
\ No newline at end of file
+     callback_obj.pipeline.stop()
+     # (note) the channel is replaced when RabbitMQ reconnects
+     if callback_obj.rabbit_publisher.channel is not None:
+         callback_obj.rabbit_publisher.channel.close()
+     emqx_client.disconnect()
+     shards.close()
+     outbox.close()
\ No newline at end of file
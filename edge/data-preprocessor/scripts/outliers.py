@@ -0,0 +1,208 @@
+import math
+from bisect import bisect_left, insort
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+# Scale factor making MAD a consistent estimator of standard deviation
+MAD_SCALE = 1.4826
+
+class RingBuffer:
+    '''
+    Fixed-size buffer of the most recent values
+    Appending to a full buffer overwrites the oldest value
+    '''
+    def __init__(self, size):
+        self.size = size
+        self.buffer = [0.0] * size
+        self.pos = 0
+        self.count = 0
+
+    def append(self, x):
+        '''
+        Adds value to buffer
+
+        Returns: overwritten value, or None if the buffer was not full
+        '''
+        evicted = self.buffer[self.pos] if self.count == self.size else None
+        self.buffer[self.pos] = x
+        self.pos = (self.pos + 1) % self.size
+        self.count = min(self.count + 1, self.size)
+        return evicted
+
+    def values(self):
+        '''Gets values from oldest to newest'''
+        if self.count < self.size:
+            return self.buffer[:self.count]
+        return self.buffer[self.pos:] + self.buffer[:self.pos]
+
+    def __len__(self):
+        return self.count
+
+
+class StaticBound:
+    '''
+    Rejects values outside of [lower, upper]
+
+    Attributes:
+        lower: Smallest accepted value, None for no bound
+        upper: Largest accepted value, None for no bound
+    '''
+    def __init__(self, lower=None, upper=50):
+        self.lower = -math.inf if lower is None else lower
+        self.upper = math.inf if upper is None else upper
+
+    def check(self, x):
+        '''Returns True if x is an outlier'''
+        return x < self.lower or x > self.upper
+
+    def check_batch(self, values):
+        '''Returns boolean numpy array, True for each outlier in values'''
+        values = np.asarray(values, dtype=np.float64)
+        return (values < self.lower) | (values > self.upper)
+
+
+class RollingDetector:
+    '''
+    Base class of detectors comparing each value to the :window: values
+    before it, accepted or not
+    Values are not rejected until :min_periods: values have been seen
+
+    Subclasses implement:
+        is_outlier(x): check x against current buffer
+        batch_outliers(x, windows): check numpy array x where row i of
+            windows holds the values before x[i]
+    '''
+    def __init__(self, window, threshold, min_periods=None, min_scale=1.0):
+        self.window = window
+        self.threshold = threshold
+        self.min_periods = window if min_periods is None else min(min_periods, window)
+        self.min_scale = min_scale
+        self.ring = RingBuffer(window)
+
+    def check(self, x):
+        '''Returns True if x is an outlier'''
+        outlier = len(self.ring) >= self.min_periods and self.is_outlier(x)
+        self.add(x)
+        return outlier
+
+    def check_batch(self, values):
+        '''
+        Returns boolean numpy array, True for each outlier in values
+        Gives the same result as calling check on each value
+        '''
+        values = np.asarray(values, dtype=np.float64)
+        mask = np.zeros(len(values), dtype=bool)
+
+        # Fill buffer one value at a time until it is full
+        start = 0
+        while start < len(values) and len(self.ring) < self.window:
+            mask[start] = self.check(values[start])
+            start += 1
+        if start == len(values):
+            return mask
+
+        # Row i of windows holds the window values before values[start + i]
+        history = np.asarray(self.ring.values(), dtype=np.float64)
+        data = np.concatenate((history, values[start:]))
+        windows = sliding_window_view(data, self.window)[:len(values) - start]
+        mask[start:] = self.batch_outliers(values[start:], windows)
+
+        for x in values[max(start, len(values) - self.window):]:
+            self.add(float(x))
+        return mask
+
+
+class RollingZScore(RollingDetector):
+    '''
+    Rejects values more than :threshold: standard deviations from the mean
+    of the previous :window: values
+    Mean and variance are kept as running sums so each check is O(1)
+    '''
+    def __init__(self, window=96, threshold=3.0, min_periods=None, min_scale=1.0):
+        super().__init__(window, threshold, min_periods, min_scale)
+        self.total = 0.0
+        self.total_sq = 0.0
+
+    def add(self, x):
+        evicted = self.ring.append(x)
+        self.total += x
+        self.total_sq += x * x
+        if evicted is not None:
+            self.total -= evicted
+            self.total_sq -= evicted * evicted
+
+    def is_outlier(self, x):
+        n = len(self.ring)
+        mean = self.total / n
+        std = math.sqrt(max(self.total_sq / n - mean * mean, 0.0))
+        return abs(x - mean) > self.threshold * max(std, self.min_scale)
+
+    def batch_outliers(self, x, windows):
+        mean = windows.mean(axis=1)
+        std = windows.std(axis=1)
+        return np.abs(x - mean) > self.threshold * np.maximum(std, self.min_scale)
+
+
+class HampelFilter(RollingDetector):
+    '''
+    Rejects values more than :threshold: scaled median absolute deviations
+    from the median of the previous :window: values
+    A sorted copy of the buffer gives the median without sorting per value
+    '''
+    def __init__(self, window=25, threshold=3.0, min_periods=None, min_scale=1.0):
+        super().__init__(window, threshold, min_periods, min_scale)
+        self.sorted = []
+
+    def add(self, x):
+        evicted = self.ring.append(x)
+        if evicted is not None:
+            del self.sorted[bisect_left(self.sorted, evicted)]
+        insort(self.sorted, x)
+
+    def is_outlier(self, x):
+        values = self.sorted
+        n = len(values)
+        median = (values[(n - 1) // 2] + values[n // 2]) / 2
+        deviations = sorted(abs(v - median) for v in values)
+        mad = (deviations[(n - 1) // 2] + deviations[n // 2]) / 2
+        return abs(x - median) > self.threshold * max(MAD_SCALE * mad, self.min_scale)
+
+    def batch_outliers(self, x, windows):
+        median = np.median(windows, axis=1)
+        mad = np.median(np.abs(windows - median[:, None]), axis=1)
+        return np.abs(x - median) > self.threshold * np.maximum(MAD_SCALE * mad, self.min_scale)
+
+
+# Detectors which can be configured by name with their arguments in order
+DETECTORS = {
+    "static": StaticBound,
+    "zscore": RollingZScore,
+    "hampel": HampelFilter,
+}
+
+def parse_detector(spec):
+    '''
+    Creates detector from configuration
+
+        static:50           reject values above 50
+        static:0:50         reject values outside [0, 50]
+        zscore:96:3         reject values 3 std devs from mean of last 96
+        hampel:25:3         reject values 3 scaled MADs from median of last 25
+        none                reject nothing
+
+    Returns: detector object, or None for none
+
+    Raises:
+        ValueError: if :spec: is invalid
+    '''
+    name, *args = spec.split(":")
+    if name == "none":
+        return None
+    if name not in DETECTORS:
+        raise ValueError(f"Unknown outlier detector {name}, expected one of {', '.join(DETECTORS)} or none")
+    args = [float(x) for x in args]
+    if name == "static":
+        return StaticBound(None, *args) if len(args) == 1 else StaticBound(*args)
+    if args:
+        args[0] = int(args[0])
+    return DETECTORS[name](*args)
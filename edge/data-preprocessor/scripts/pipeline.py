@@ -0,0 +1,285 @@
+'''
+Pipelined stages connected by bounded queues
+
+    paho network thread -> ingest queue -> preprocess thread
+                        -> egress queue -> egress thread (owns pika)
+
+Receiving MQTT messages never waits on RabbitMQ, a slow broker only fills
+the egress queue. Once a queue is full its backpressure policy decides
+what happens to new items:
+    block           wait for space, slowing the stage before it
+    drop_newest     drop the new item
+    drop_oldest     drop the oldest queued item to make space
+Control items (e.g. finished) always wait for space and are never dropped.
+'''
+import time
+import queue
+import threading
+from collections import deque
+import log
+import metrics
+
+logger = log.get_logger(__name__)
+
+QUEUE_WAIT = metrics.histogram("preprocessor_queue_wait_seconds",
+                               "Time items wait in the queue of a pipeline stage", ["stage"])
+
+POLICIES = ("block", "drop_newest", "drop_oldest")
+
+# Stops a stage once the items before it are handled
+STOP = object()
+
+
+class BoundedQueue:
+    '''
+    Queue of at most :maxsize: items with a backpressure policy
+    Items are queued with the time they were put to measure waiting time,
+    and whether they are control items so drop_oldest can pass over them
+
+    Attributes:
+        name: Name in stats
+        maxsize: Maximum number of queued items
+        policy: Backpressure policy once full, see POLICIES
+    '''
+    def __init__(self, name, maxsize, policy="block"):
+        if policy not in POLICIES:
+            raise ValueError(f"Unknown backpressure policy {policy}, expected one of {', '.join(POLICIES)}")
+        self.name = name
+        self.maxsize = maxsize
+        self.policy = policy
+        self.items = deque()
+        self.lock = threading.Lock()
+        self.not_empty = threading.Condition(self.lock)
+        self.not_full = threading.Condition(self.lock)
+
+        # Counters
+        self.put_count = 0
+        self.dropped = 0
+        self.max_depth = 0
+        self.blocked_seconds = 0.0
+
+    def put(self, item, control=False):
+        '''
+        Queues item, applying the backpressure policy if full
+
+        Returns: False if an item was dropped
+        '''
+        with self.lock:
+            kept = True
+            if len(self.items) >= self.maxsize:
+                # Oldest item which may be dropped, control items never are
+                oldest = None
+                if not control and self.policy == "drop_oldest":
+                    oldest = next((i for i, x in enumerate(self.items) if not x[1]), None)
+                if not control and self.policy == "drop_newest":
+                    self.dropped += 1
+                    return False
+                elif oldest is not None:
+                    del self.items[oldest]
+                    self.dropped += 1
+                    kept = False
+                else:
+                    start = time.monotonic()
+                    while len(self.items) >= self.maxsize:
+                        self.not_full.wait()
+                    self.blocked_seconds += time.monotonic() - start
+            self.items.append((time.monotonic(), control, item))
+            self.put_count += 1
+            self.max_depth = max(self.max_depth, len(self.items))
+            self.not_empty.notify()
+            return kept
+
+    def get_many(self, limit):
+        '''Gets up to :limit: queued items without waiting, see get'''
+        items = []
+        with self.lock:
+            now = time.monotonic()
+            while self.items and len(items) < limit:
+                queued_at, _, item = self.items.popleft()
+                items.append((now - queued_at, item))
+            self.not_full.notify(len(items))
+        return items
+
+    def get(self, timeout=None):
+        '''
+        Gets oldest item
+
+        Returns: tuple of seconds the item waited and the item
+
+        Raises:
+            queue.Empty: if no item arrives within :timeout: seconds
+        '''
+        with self.lock:
+            if not self.items:
+                self.not_empty.wait(timeout)
+                if not self.items:
+                    raise queue.Empty
+            queued_at, _, item = self.items.popleft()
+            self.not_full.notify()
+        return time.monotonic() - queued_at, item
+
+    def __len__(self):
+        return len(self.items)
+
+    def stats(self):
+        return {
+            "depth": len(self.items),
+            "max_depth": self.max_depth,
+            "put": self.put_count,
+            "dropped": self.dropped,
+            "blocked_s": round(self.blocked_seconds, 3),
+        }
+
+
+class Stage(threading.Thread):
+    '''
+    Thread handling the items of a queue in order
+    :idle: is called when no item has arrived for :idle_interval: seconds,
+    e.g. to poll for results or keep a connection alive
+    An item which raises is counted and logged, the stage keeps running
+    With :max_batch: above 1, items already queued are handled together
+    and :handle: is called with a list of up to max_batch items
+
+    Attributes:
+        name: Name of stage in stats
+        in_queue: BoundedQueue to take items from
+        handle: Function called with each item
+        idle: Function called while idle, or None
+        idle_interval: Seconds to wait for an item before calling idle
+        max_batch: Maximum items handled in one call
+    '''
+    def __init__(self, name, in_queue, handle, idle=None, idle_interval=0.05, max_batch=1):
+        super().__init__(name=name, daemon=True)
+        self.in_queue = in_queue
+        self.handle = handle
+        self.idle = idle
+        self.idle_interval = idle_interval
+        self.max_batch = max_batch
+
+        # Counters
+        self.processed = 0
+        self.errors = 0
+        self.busy_seconds = 0.0
+        self.max_seconds = 0.0
+        self.wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+
+    def run(self):
+        queue_wait = QUEUE_WAIT.labels(self.name)
+        while True:
+            try:
+                waited, item = self.in_queue.get(self.idle_interval)
+            except queue.Empty:
+                self.call(self.idle)
+                continue
+            batch = [(waited, item)]
+            if self.max_batch > 1:
+                batch += self.in_queue.get_many(self.max_batch - 1)
+            stop = any(x is STOP for _, x in batch)
+            items = [x for _, x in batch if x is not STOP]
+
+            for waited, _ in batch:
+                queue_wait.observe(waited)
+            if items:
+                start = time.monotonic()
+                self.call(self.handle, items if self.max_batch > 1 else items[0])
+                elapsed = time.monotonic() - start
+                self.processed += len(items)
+                self.busy_seconds += elapsed
+                self.max_seconds = max(self.max_seconds, elapsed)
+                self.wait_seconds += sum(x for x, _ in batch)
+                self.max_wait_seconds = max(self.max_wait_seconds, max(x for x, _ in batch))
+            if stop:
+                break
+
+    def call(self, function, *args):
+        '''Calls function, logging rather than raising errors'''
+        if function is None:
+            return
+        try:
+            function(*args)
+        except Exception as e:
+            self.errors += 1
+            logger.exception("Error in %s stage: %r", self.name, e)
+
+    def stats(self):
+        '''
+        Gets counters and handling and queue waiting times in ms
+        mean_ms is per item, max_ms per call
+        '''
+        n = max(self.processed, 1)
+        return {
+            "processed": self.processed,
+            "errors": self.errors,
+            "mean_ms": round(1000 * self.busy_seconds / n, 3),
+            "max_ms": round(1000 * self.max_seconds, 3),
+            "mean_wait_ms": round(1000 * self.wait_seconds / n, 3),
+            "max_wait_ms": round(1000 * self.max_wait_seconds, 3),
+        }
+
+
+class Pipeline:
+    '''
+    Preprocessing and egress stages of data-preprocessor, each on its own
+    thread
+
+    Attributes:
+        process: Function of an ingested item returning a list of egress items
+        publish: Function called with a list of egress items, all egress
+            items queued while publishing are published in the next call
+        poll: Function returning egress items which are ready while no
+            items are ingested (e.g. results of worker processes), or None
+        idle: Function called by the egress stage while idle (e.g. to
+            retry the broker), or None
+        max_publish_batch: Maximum items in one call of publish
+        ingest_size: Maximum items waiting to be processed
+        egress_size: Maximum items waiting to be published
+        policy: Backpressure policy of the ingest queue, see POLICIES
+            The egress queue always blocks so aggregates are never dropped
+    '''
+    def __init__(self, process, publish, poll=None, idle=None, max_publish_batch=100,
+                 ingest_size=10000, egress_size=10000, policy="block"):
+        self.process = process
+        self.poll = poll
+        self.ingest = BoundedQueue("ingest_queue", ingest_size, policy)
+        self.egress = BoundedQueue("egress_queue", egress_size, "block")
+        self.stages = [
+            Stage("preprocess", self.ingest, self._preprocess, idle=self._poll),
+            Stage("egress", self.egress, publish, idle=idle, max_batch=max_publish_batch),
+        ]
+
+    def start(self):
+        for stage in self.stages:
+            stage.start()
+
+    def put(self, item, control=False):
+        '''
+        Queues ingested item, called from the MQTT network thread
+
+        Returns: False if an item was dropped by the backpressure policy
+        '''
+        return self.ingest.put(item, control)
+
+    def _preprocess(self, item):
+        for egress_item in self.process(item):
+            self.egress.put(egress_item, control=True)
+
+    def _poll(self):
+        if self.poll is None:
+            return
+        for egress_item in self.poll():
+            self.egress.put(egress_item, control=True)
+
+    def stop(self):
+        '''Stops stages once every queued item is handled'''
+        self.ingest.put(STOP, control=True)
+        self.stages[0].join()
+        self.egress.put(STOP, control=True)
+        self.stages[1].join()
+
+    def stats(self):
+        '''Gets queue depths and stage latencies'''
+        stats = {x.name: x.stats() for x in (self.ingest, self.egress)}
+        for stage in self.stages:
+            stats[stage.name] = stage.stats()
+        return stats
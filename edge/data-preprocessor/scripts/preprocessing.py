@@ -1,100 +1,373 @@
-from datetime import datetime as dt
+from aggregates import AggregateState
+import windowing
+import outliers
+import codec
+
+# Smallest frame checked for outliers with numpy, smaller frames are
+# cheaper to check one value at a time
+MIN_VECTOR_BATCH = 16
+
+DAY = 24*60*60
+
+# Counters of each Preprocessor reported as they change, see KeyedPreprocessor.take_counts
+COUNTS = ("outliers", "late_dropped", "forced_closes")
 
 class Preprocessor():
     '''
-    Class to perform stream-preprocessing calculations for 
+    Class to perform stream-preprocessing calculations for
     incoming data from data-injector
+    Values are collected into windows by their own timestamp (event time),
+    see windowing.WindowSpec
+    A watermark trails the newest timestamp seen by :allowed_lateness: seconds
+    and a window is closed once the watermark passes its end, so values may
+    arrive out of order by up to :allowed_lateness: without being lost
     '''
-    def __init__(self):
-        '''Initialises variables'''
-        self.DAY_LOWER_BOUND = None
-        self.DAY_UPPER_BOUND = None
-        self.DAY_VALUES = []
+    def __init__(self, aggregates=("mean",), allowed_lateness=0,
+                 max_open_windows=8, max_future_skew=DAY,
+                 window=windowing.tumbling(DAY), outlier_detector="static:50",
+                 keep_rejected=False, structured=False):
+        '''
+        Initialises variables
+
+        Attributes:
+            aggregates: Names of aggregates to calculate for each window,
+                see aggregates.AGGREGATES
+            allowed_lateness: Seconds a value may arrive behind the newest
+                value and still be added to its window
+            max_open_windows: Maximum number of windows kept open, the oldest
+                window is closed early when exceeded
+            max_future_skew: Seconds a value may be ahead of the newest value
+                before it needs confirming by a second value to move the
+                watermark, None to always move the watermark. The first
+                value always needs confirming, as there is no newest value
+                to compare it with
+            window: windowing.WindowSpec, defaults to one day tumbling windows
+            outlier_detector: Outlier detector configuration, see
+                outliers.parse_detector
+            keep_rejected: Keep rejected readings until drain_rejected is
+                called, otherwise they are only counted
+            structured: Return closed windows as (start, list of values)
+                tuples instead of strings, e.g. to send as binary frames
+        '''
+        self.aggregates = aggregates
+        self.allowed_lateness = allowed_lateness
+        self.max_future_skew = max_future_skew
+        self.window = window
+        self.detector = outliers.parse_detector(outlier_detector)
+        self.keep_rejected = keep_rejected
+        self.rejected = []
+        self.structured = structured
+        # Open windows are held as panes
+        self.max_open_panes = max_open_windows * window.panes_per_window
+
+        # Pane start -> running aggregates of pane, values are not kept
+        self.panes = {}
+        # Newest timestamp accepted as on time
+        self.max_timestamp = None
+        # Start of next window to be closed, earlier windows have been closed
+        self.next_window = None
+        # Previous value was ahead by more than max_future_skew
+        self.pending_skew = False
+        # First value, until a second value confirms it
+        self.first_timestamp = None
+
+        # Bounds of pane of last value, saves recalculating for each value
+        self.PANE_LOWER_BOUND = None
+        self.PANE_UPPER_BOUND = None
+
+        # Counters
+        self.late_dropped = 0
+        self.forced_closes = 0
+        self.outliers = 0
 
     def process_value(self, x):
         '''
         Stream-processes values individually
-        Collects values by week and processes them when next week value
-        comes in.
-        If x=finished then process any remaining values
-        ASSUMES MESSAGES ARE IN CHRONOLOGICAL ORDER
+        Adds value to its window and closes every window the watermark has
+        passed.
+        If x=finished then close all open windows
 
         Attributes:
             self: object values
             x: individual message in timestamp:value format
 
-        Returns: 
-            None: if value is just added to DAY_VALUES
-            (int): Previous week average
+        Returns:
+            (list): Aggregates of closed windows in timestamp:value[:value...]
+                format with values in order of self.aggregates, oldest first
         '''
         # When finished process remaining values
-        if x == "finished" and len(self.DAY_VALUES) > 0:
-            return self.batch_preprocess(self.DAY_VALUES)
+        if x == "finished":
+            return self.flush()
 
         # Parse received value
         timestamp, value = x.split(":")
         # Convert from string to float
         value = float(value)
 
+        # Check for outlier
+        if self.detector is not None and self.detector.check(value):
+            self.reject(x)
+            return []
+
         # Convert from string and change to seconds
-        timestamp = int(timestamp) / 1000
+        return self.add_value(int(timestamp) // 1000, value)
 
-        # Check for outlier
-        if value > 50:
-            print(f"OUTLIER: {x}", flush=True)
-            return False
-        
-        # If lower bound/upper bound not initialised
-        if self.DAY_LOWER_BOUND is None or self.DAY_UPPER_BOUND is None:
-            # Set day bounds in unix time
-            self.DAY_LOWER_BOUND = self.get_day_low_bound(timestamp)
-            # Add one day to upper bound to lower bound
-            self.DAY_UPPER_BOUND = self.DAY_LOWER_BOUND + (24*60*60)
-            self.DAY_VALUES = []
-
-        # If value is within day bounds
-        if self.DAY_LOWER_BOUND <= timestamp and timestamp < self.DAY_UPPER_BOUND:
-            # Add value todays list
-            self.DAY_VALUES.append(value)
-            return None 
+    def process_batch(self, readings):
+        '''
+        Stream-processes a frame of readings in order
+        Outliers in large frames are found with one vectorised check
+
+        Attributes:
+            readings: list of messages in timestamp:value format
+
+        Returns:
+            (list): Aggregates of closed windows, see process_value
+        '''
+        if self.detector is None or len(readings) < MIN_VECTOR_BATCH:
+            closed = []
+            for x in readings:
+                closed += self.process_value(x)
+            return closed
+
+        pairs = [x.split(":") for x in readings]
+        return self.process_arrays([int(timestamp) for timestamp, _ in pairs],
+                                   [float(value) for _, value in pairs])
+
+    def process_arrays(self, timestamps, values):
+        '''
+        Stream-processes columns of readings in order, e.g. from a binary frame
+        The columns may be memoryviews, they are read without copying
+
+        Attributes:
+            timestamps: Sequence of integer timestamps in ms
+            values: Sequence of float values
+
+        Returns:
+            (list): Aggregates of closed windows, see process_value
+        '''
+        if self.detector is None:
+            rejected = [False] * len(values)
+        elif len(values) < MIN_VECTOR_BATCH:
+            rejected = [self.detector.check(value) for value in values]
         else:
-            # If timestamp is after current day
-            if timestamp >= self.DAY_UPPER_BOUND:
-                # A value from a new day has arrived
-                # Process data from previous day and return with start timestamp
-                rtn = f"{int(self.DAY_LOWER_BOUND)}:{self.batch_preprocess(self.DAY_VALUES)}"
-
-                # Reset bounds and array around new value
-                self.DAY_LOWER_BOUND = self.get_day_low_bound(timestamp)
-                # Add one day to upper bound to lower bound
-                self.DAY_UPPER_BOUND = self.DAY_LOWER_BOUND + (24*60*60)
-                # Reset day values and include current value
-                self.DAY_VALUES = [value]
-
-                return rtn
-
-            # NOTE
-            # If value is before the current day it is ignored
-            # Values are assumed to be in chronological order
-    
-
-    def get_day_low_bound(self, unix_time):
-        '''Get UNIX midnight timestamp of unix_time value'''
-        # Get year/month/day of utc time 
-        utc_time = dt.fromtimestamp(unix_time).replace(
-            hour=0,\
-            minute=0,\
-            second=0
-            )
-        
-        # Convert back to unix time
-        return utc_time.timestamp()
-        
-    def batch_preprocess(self, x):
-        '''Gets average value of list'''
-        return sum(x)/len(x)
-    
-
-
-    
+            rejected = self.detector.check_batch(values).tolist()
+
+        closed = []
+        for timestamp, value, outlier in zip(timestamps, values, rejected):
+            if outlier:
+                self.reject(f"{timestamp}:{value}")
+            else:
+                closed += self.add_value(timestamp // 1000, value)
+        return closed
+
+    def reject(self, x):
+        '''Counts rejected reading and keeps it if keep_rejected is set'''
+        self.outliers += 1
+        if self.keep_rejected:
+            self.rejected.append(x)
+
+    def drain_rejected(self):
+        '''Gets and clears rejected readings kept since the last call'''
+        rejected, self.rejected = self.rejected, []
+        return rejected
+
+    def add_value(self, timestamp, value):
+        '''
+        Adds value with integer timestamp in seconds to its window
+
+        Returns: list of closed window aggregates, oldest first
+        '''
+        # Get pane bounds in unix time
+        if self.PANE_LOWER_BOUND is None or\
+                not (self.PANE_LOWER_BOUND <= timestamp < self.PANE_UPPER_BOUND):
+            self.PANE_LOWER_BOUND = self.window.pane_start(timestamp)
+            self.PANE_UPPER_BOUND = self.PANE_LOWER_BOUND + self.window.hop
+        pane_start = self.PANE_LOWER_BOUND
+
+        # Drop values whose windows have all been closed
+        if self.next_window is not None and pane_start < self.next_window:
+            self.late_dropped += 1
+            return []
+
+        # Add value to its pane
+        pane = self.panes.get(pane_start)
+        if pane is None:
+            pane = self.panes[pane_start] = AggregateState(self.aggregates)
+        pane.add(value)
+
+        self.advance(timestamp)
+        if self.next_window is None and self.max_timestamp is not None:
+            # Leave windows open for earlier values arriving late
+            earliest = self.window.pane_start(self.max_timestamp - self.allowed_lateness)
+            self.next_window = self.window.first_window(min(earliest, min(self.panes)))
+        closed = self.close_windows(self.watermark)
+
+        # Close oldest windows early if too many are open
+        while len(self.panes) > self.max_open_panes:
+            self.forced_closes += 1
+            closed += self.close_windows(min(self.panes) + self.window.size)
+        return closed
+
+    def advance(self, timestamp):
+        '''
+        Moves the newest timestamp forward
+        A single value far ahead of the others (e.g. a wrong clock) does not
+        move it, two values in a row do. The first value is held until the
+        second, the earlier of the two is taken as the newest timestamp and
+        the later one is checked against it
+        '''
+        if self.max_timestamp is None:
+            if self.max_future_skew is not None and self.first_timestamp is None:
+                self.first_timestamp = timestamp
+                return
+            if self.first_timestamp is not None:
+                first, self.first_timestamp = self.first_timestamp, None
+                timestamp, self.max_timestamp = max(first, timestamp), min(first, timestamp)
+            else:
+                self.max_timestamp = timestamp
+        if timestamp > self.max_timestamp:
+            if self.max_future_skew is not None and\
+                    timestamp - self.max_timestamp > self.max_future_skew and\
+                    not self.pending_skew:
+                self.pending_skew = True
+                return
+            self.max_timestamp = timestamp
+        self.pending_skew = False
+
+    @property
+    def watermark(self):
+        '''Timestamp before which no more values are expected'''
+        if self.max_timestamp is None:
+            return None
+        return self.max_timestamp - self.allowed_lateness
+
+    def close_windows(self, watermark):
+        '''
+        Closes windows which have ended before the watermark
+        Panes are removed once the last window containing them is closed
+
+        Returns: list of closed window aggregates, oldest first
+        '''
+        closed = []
+        if watermark is None:
+            return closed
+        if self.next_window is None and self.panes:
+            # Nothing closed yet, e.g. flushed before a second value
+            self.next_window = self.window.first_window(min(self.panes))
+        size = self.window.size
+        while self.panes and self.next_window + size <= watermark:
+            # Skip over windows with no values
+            self.next_window = max(self.next_window,
+                                   self.window.first_window(min(self.panes)))
+            if self.next_window + size > watermark:
+                break
+            closed.append(self.close_window(self.next_window))
+        return closed
+
+    def close_window(self, start):
+        '''
+        Merges panes of window and formats its aggregates
+        The window's first pane is no longer needed by later windows
+        '''
+        state = AggregateState(self.aggregates)
+        for pane_start in self.window.panes(start):
+            pane = self.panes.get(pane_start)
+            if pane is not None:
+                state.merge(pane)
+        self.panes.pop(start, None)
+        self.next_window = start + self.window.hop
+        return self.format_window(start, state)
+
+    def flush(self):
+        '''Closes all open windows, oldest first'''
+        if not self.panes:
+            return []
+        return self.close_windows(max(self.panes) + self.window.size)
+
+    def stats(self):
+        '''Gets counters of dropped values and open panes'''
+        return {
+            "open_panes": len(self.panes),
+            "late_dropped": self.late_dropped,
+            "forced_closes": self.forced_closes,
+            "outliers": self.outliers,
+        }
+
+    def format_window(self, start, window):
+        '''
+        Formats aggregates of window as timestamp:value[:value...], or as
+        (timestamp, list of values) if structured is set
+        '''
+        if self.structured:
+            return start, window.result()
+        values = ":".join(str(x) for x in window.result())
+        return f"{start}:{values}"
+
+
+class KeyedPreprocessor():
+    '''
+    Keeps a separate Preprocessor for each series key (e.g. sensor ID) so
+    readings from different series never share window state
+    Preprocessors are created on the first reading of a key with
+    :preprocessor_kwargs:
+    '''
+    def __init__(self, **preprocessor_kwargs):
+        self.preprocessor_kwargs = preprocessor_kwargs
+        self.preprocessors = {}
+        # Growth of each of COUNTS since take_counts was last called
+        self.counts = dict.fromkeys(COUNTS, 0)
+
+    def get(self, key):
+        '''Gets Preprocessor of key, creating it if needed'''
+        preprocessor = self.preprocessors.get(key)
+        if preprocessor is None:
+            preprocessor = self.preprocessors[key] = Preprocessor(**self.preprocessor_kwargs)
+        return preprocessor
+
+    def process(self, key, readings):
+        '''
+        Processes readings of one key in order
+
+        Attributes:
+            key: Series key
+            readings: list of messages in timestamp:value format, or a
+                binary frame, see codec
+
+        Returns: tuple of
+            list of closed window aggregates of key
+            list of readings rejected as outliers, if keep_rejected is set
+        '''
+        preprocessor = self.get(key)
+        before = [getattr(preprocessor, x) for x in COUNTS]
+        if type(readings) == bytes:
+            frame = codec.decode(readings)
+            results = preprocessor.process_arrays(frame.timestamps, frame.values)
+        else:
+            results = preprocessor.process_batch(readings)
+        for name, value in zip(COUNTS, before):
+            self.counts[name] += getattr(preprocessor, name) - value
+        return results, preprocessor.drain_rejected()
+
+    def take_counts(self):
+        '''
+        Gets and resets the growth of each of COUNTS, e.g. to report counts
+        of a worker process to the parent
+        '''
+        counts, self.counts = self.counts, dict.fromkeys(COUNTS, 0)
+        return counts
+
+    def flush(self):
+        '''
+        Closes all open windows of every key
+
+        Returns: list of (key, list of closed window aggregates)
+        '''
+        return [(key, preprocessor.flush()) for key, preprocessor in self.preprocessors.items()]
 
+    def stats(self):
+        '''Gets counters summed over every key'''
+        total = {"keys": len(self.preprocessors)}
+        for preprocessor in self.preprocessors.values():
+            for name, value in preprocessor.stats().items():
+                total[name] = total.get(name, 0) + value
+        return total
@@ -1,52 +1,65 @@
 import json
+import struct
+import weakref
 from paho.mqtt import client as mqtt_client
 import time
 import pika
+import codec
+import compression
+import connections
+import log
 
-def connect_to_rabbitmq(ip, port=5672, attempts=50, socket_timeout=60):
+logger = log.get_logger(__name__)
+
+# Errors of a lost or unusable connection to the broker
+BROKER_ERRORS = (pika.exceptions.AMQPError, OSError)
+
+# Length of message metadata at the start of a spool record
+RECORD_META = struct.Struct("<I")
+
+# Channel -> names of queues already declared on it
+DECLARED_QUEUES = weakref.WeakKeyDictionary()
+
+def declare_queue(channel, queue_name):
+    '''
+    Declares queue on channel once
+    Declaring is a blocking round-trip to the broker so it is skipped for
+    queues already declared on the channel
+    '''
+    declared = DECLARED_QUEUES.setdefault(channel, set())
+    if queue_name not in declared:
+        channel.queue_declare(queue=queue_name)
+        declared.add(queue_name)
+
+def connect_to_rabbitmq(ip, port=5672, attempts=None, timeout=250, socket_timeout=60):
     '''
     Connects to RabbitMQ MQTT message broker
     https://www.rabbitmq.com/
-    Connects with pika.BlockingConnection
+    Connects with pika.BlockingConnection, retrying with backoff (see
+    connections)
 
     Attributes:
         ip: IP of message broker
         port: Port of message broker
-        attempts: Number of attempts to connect
+        attempts: Maximum number of attempts, None for no limit
+        timeout: Seconds to keep trying
         socket_timeout: Timeout with for connections to broker
 
-    Returns: pika.BlockingConnection
+    Returns: pika.BlockingConnection channel
 
     Raises:
-        ConnectionError: if all :attempts: fail
+        ConnectionError: if no attempt succeeds
     '''
-    connected = False    
-    # Make connection attempts
-    for i in range(attempts):
-        try:    
-            # Connect to MQTT service
-            connection = pika.BlockingConnection(pika.ConnectionParameters(host=ip,
-                                                                            port=port,
-                                                                            socket_timeout=socket_timeout))
-
-            # If successful
-            print(f"({ip}) Connected to broker", flush=True)
-
-            channel = connection.channel()
-            connected = True
-            break
-        except pika.exceptions.AMQPConnectionError:
-            # Sleep for 5 seconds before trying again
-            print(f"({ip}) Could not connect, trying again in 5 seconds", flush=True)
-            time.sleep(5)
-    
-    # If connection attempts fail
-    if not connected:
-        raise ConnectionError(f"Could not connect to {ip}")
-    return channel
+    def connect():
+        connection = pika.BlockingConnection(pika.ConnectionParameters(host=ip,
+                                                                       port=port,
+                                                                       socket_timeout=socket_timeout))
+        return connection.channel()
+    return connections.retry(connect, f"RabbitMQ broker ({ip})", timeout=timeout, attempts=attempts,
+                             errors=(pika.exceptions.AMQPConnectionError,), probe=(ip, port))
 
 
-def publish_to_rabbitmq(channel, queue_name, msg):
+def publish_to_rabbitmq(channel, queue_name, msg, headers=None):
     '''
     Publishes to RabbitMQ message broker
     This sends a "heartbeat" message to show data-preprocessor that data-processor is active
@@ -56,6 +69,7 @@ def publish_to_rabbitmq(channel, queue_name, msg):
         queue_name: Name of queue to publish to 
         msg: Message payload
             (note) has to be str, int, float, None or bytearray
+        headers: dict of message headers, e.g. {"series": sensor_id}
 
     Returns: None
 
@@ -71,10 +85,313 @@ def publish_to_rabbitmq(channel, queue_name, msg):
             type(msg) == bytearray
 
     msg = json.dumps(msg)
-    channel.queue_declare(queue=queue_name)
+    declare_queue(channel, queue_name)
     channel.basic_publish(exchange='',
                         routing_key=queue_name,
-                        body=msg)
+                        body=msg,
+                        properties=pika.BasicProperties(headers=headers))
+
+
+def encode_message(msg, headers=None):
+    '''
+    Gets body and properties of message
+    bytes messages are binary frames (see codec) and are sent as they are
+    with the codec content type and the compression of compressed frames
+    as content encoding, other messages are sent as JSON
+
+    Returns: tuple of body and pika.BasicProperties
+    '''
+    assert type(msg) == str or\
+            type(msg) == int or\
+            type(msg) == float or\
+            type(msg) == None or\
+            type(msg) == bytearray or\
+            type(msg) == bytes
+
+    if type(msg) == bytes:
+        encoding = compression.encoding_name(msg) if compression.is_compressed(msg) else None
+        return msg, pika.BasicProperties(content_type=codec.CONTENT_TYPE,
+                                         content_encoding=encoding,
+                                         headers=headers)
+    return json.dumps(msg).encode(), pika.BasicProperties(headers=headers)
+
+def pack_record(queue_name, body, properties):
+    '''Packs message into a spool record'''
+    meta = json.dumps({
+        "queue": queue_name,
+        "headers": properties.headers,
+        "content_type": properties.content_type,
+        "content_encoding": properties.content_encoding,
+    }).encode()
+    return RECORD_META.pack(len(meta)) + meta + body
+
+def unpack_record(record):
+    '''Unpacks spool record into queue name, body and properties'''
+    (length,) = RECORD_META.unpack_from(record, 0)
+    meta = json.loads(record[RECORD_META.size:RECORD_META.size + length])
+    properties = pika.BasicProperties(content_type=meta["content_type"],
+                                      content_encoding=meta["content_encoding"],
+                                      headers=meta["headers"])
+    return meta["queue"], record[RECORD_META.size + length:], properties
+
+
+class RabbitPublisher:
+    '''
+    Publishes many messages to RabbitMQ message broker without a broker
+    round-trip per message
+    Queues are declared once, publishes are written to the socket without
+    waiting (pipelined) and with confirm=True the channel is in publisher
+    confirm mode and every :batch_size: messages the confirms of the whole
+    batch are waited for at once. The commit returns once the broker has
+    taken every message in the batch, one round-trip per batch rather than
+    per message. A nack fails the batch like a lost connection.
+    (note) pika's BlockingChannel waits for the confirm of each publish
+    separately, so messages are published on its underlying channel and
+    the confirms are counted here
+
+    Messages of an open batch are only delivered after flush() is called or
+    the batch is full, callers flush once they have published a burst
+
+    With a :spool: the publisher rides through broker outages. When the
+    broker cannot be reached messages, including the uncommitted batch, are
+    appended to the spool instead. Reconnecting is tried with :connect:
+    after delays backing off from tens of milliseconds to :retry_interval:
+    seconds (see connections.Backoff) and never blocks for longer than one
+    connection attempt. Once reconnected the spool is drained in order
+    before new messages are sent, for at most :max_drain_seconds: per flush
+    so ingest is not stalled by a long backlog.
+
+    Attributes:
+        channel: pika.BlockingConnection channel to broker
+        batch_size: Messages per acknowledged batch
+        confirm: Wait for broker to acknowledge each batch
+        spool: spool.Spool to keep messages in while the broker is down,
+            None to raise broker errors
+        connect: Function returning a new channel, see connect_to_rabbitmq
+        retry_interval: Longest delay between reconnection attempts
+        max_drain_seconds: Time spent draining the spool per flush
+    '''
+    def __init__(self, channel, batch_size=100, confirm=True, spool=None, connect=None,
+                 retry_interval=5, max_drain_seconds=1.0):
+        self.channel = None
+        self.batch_size = batch_size
+        self.confirm = confirm
+        self.spool = spool
+        self.connect = connect
+        self.retry_interval = retry_interval
+        self.max_drain_seconds = max_drain_seconds
+        # Messages of uncommitted batch, spooled if the commit fails
+        self.batch = []
+        # Delivery tag of the last publish and tags not yet confirmed
+        self.delivery_tag = 0
+        self.unconfirmed = set()
+        self.nacked = 0
+        self.backoff = connections.Backoff(maximum=retry_interval)
+        self.next_attempt = 0
+        self.published = 0
+        self.batches = 0
+        self.spooled = 0
+        self.outages = 0
+
+        self.open(channel)
+
+    @property
+    def pending(self):
+        '''Messages of uncommitted batch'''
+        return len(self.batch)
+
+    def open(self, channel):
+        '''Starts publishing on channel, in confirm mode if confirm is set'''
+        self.delivery_tag = 0
+        self.unconfirmed = set()
+        self.nacked = 0
+        if self.confirm:
+            selected = []
+            channel._impl.confirm_delivery(self.on_confirm, callback=selected.append)
+            channel._flush_output(lambda: selected)
+        self.channel = channel
+
+    def on_confirm(self, frame):
+        '''Called by pika with each Basic.Ack or Basic.Nack of the broker'''
+        tag = frame.method.delivery_tag
+        if frame.method.multiple:
+            confirmed = {x for x in self.unconfirmed if x <= tag}
+        else:
+            confirmed = {tag} & self.unconfirmed
+        self.unconfirmed -= confirmed
+        if isinstance(frame.method, pika.spec.Basic.Nack):
+            self.nacked += len(confirmed)
+
+    def publish(self, queue_name, msg, headers=None):
+        '''
+        Publishes message, see encode_message
+        Commits the batch once batch_size messages are pending
+        '''
+        assert type(queue_name) == str
+        body, properties = encode_message(msg, headers)
+
+        # Keep order, new messages wait behind spooled messages
+        if self.spool is not None and (self.channel is None or not self.spool.empty()):
+            self.spool.append(pack_record(queue_name, body, properties))
+            self.spooled += 1
+            return
+
+        try:
+            self.send(queue_name, body, properties)
+        except BROKER_ERRORS as e:
+            self.on_broker_down(e)
+            self.spool.append(pack_record(queue_name, body, properties))
+            self.spooled += 1
+            return
+        self.batch.append((queue_name, body, properties))
+        self.published += 1
+        if len(self.batch) >= self.batch_size:
+            self.flush()
+
+    def send(self, queue_name, body, properties):
+        '''Writes message to the channel'''
+        declare_queue(self.channel, queue_name)
+        if not self.confirm:
+            self.channel.basic_publish(exchange='',
+                                       routing_key=queue_name,
+                                       body=body,
+                                       properties=properties)
+            return
+        # Written out by the next wait for the broker, see commit
+        self.channel._impl.basic_publish(exchange='',
+                                         routing_key=queue_name,
+                                         body=body,
+                                         properties=properties)
+        self.delivery_tag += 1
+        self.unconfirmed.add(self.delivery_tag)
+
+    def commit(self):
+        '''
+        Waits for the broker to acknowledge messages sent since the last commit
+
+        Raises:
+            pika.exceptions.NackError: if the broker rejected any message
+            pika.exceptions.AMQPChannelError: if the channel closed first
+        '''
+        if self.confirm:
+            self.channel._flush_output(lambda: not self.unconfirmed)
+            if self.unconfirmed:
+                raise pika.exceptions.AMQPChannelError(
+                    f"Channel closed with {len(self.unconfirmed)} messages unconfirmed")
+            if self.nacked:
+                self.nacked = 0
+                raise pika.exceptions.NackError([])
+        self.batches += 1
+
+    def flush(self, drain_all=False):
+        '''
+        Commits pending messages and waits for the broker to acknowledge them
+        With a spool, reconnects if the broker is down and drains the spool,
+        for at most max_drain_seconds unless :drain_all: is set
+        '''
+        if self.batch:
+            try:
+                self.commit()
+                self.batch = []
+            except BROKER_ERRORS as e:
+                self.on_broker_down(e)
+
+        if self.spool is None or self.spool.empty():
+            return
+        self.spool.expire()
+        if self.channel is None:
+            self.reconnect()
+        if self.channel is not None:
+            self.drain(None if drain_all else self.max_drain_seconds)
+
+    def poll(self):
+        '''
+        Called while no messages are published
+        Commits any open batch, drains the spool or retries the broker, and
+        lets pika answer broker heartbeats
+        '''
+        self.flush()
+        if self.channel is None:
+            return
+        try:
+            self.channel.connection.process_data_events(time_limit=0)
+        except BROKER_ERRORS as e:
+            self.on_broker_down(e)
+
+    def on_broker_down(self, error):
+        '''
+        Moves the uncommitted batch to the spool
+        Messages of the batch may not have reached the queue when the
+        channel is lost, so the whole batch is sent again
+
+        Raises:
+            error: if there is no spool
+        '''
+        if self.spool is None:
+            raise error
+        logger.warning("RabbitMQ unavailable, spooling messages: %r", error)
+        self.outages += 1
+        try:
+            self.channel.connection.close()
+        except Exception:
+            # Already closed or broken, the socket is released either way
+            pass
+        self.channel = None
+        self.backoff.reset()
+        self.next_attempt = time.monotonic() + self.backoff.next()
+        for queue_name, body, properties in self.batch:
+            self.spool.append(pack_record(queue_name, body, properties))
+            self.spooled += 1
+            self.published -= 1
+        self.batch = []
+        self.spool.sync()
+
+    def reconnect(self):
+        '''Tries to open a new channel if the backoff delay has passed'''
+        if self.connect is None or time.monotonic() < self.next_attempt:
+            return
+        try:
+            self.open(self.connect())
+            logger.info("Reconnected to RabbitMQ, draining spool",
+                        extra={"fields": {"spool_pending_bytes": self.spool.pending()}})
+        except (ConnectionError,) + BROKER_ERRORS as e:
+            logger.warning("Could not reconnect to RabbitMQ: %r", e)
+            self.channel = None
+            self.next_attempt = time.monotonic() + self.backoff.next()
+
+    def drain(self, max_seconds=None):
+        '''
+        Sends spooled messages in order, one acknowledged batch at a time
+        The spool is only moved on once a batch is committed, a batch which
+        fails is sent again after reconnecting
+        '''
+        deadline = None if max_seconds is None else time.monotonic() + max_seconds
+        while not self.spool.empty() and (deadline is None or time.monotonic() < deadline):
+            records = self.spool.read(self.batch_size)
+            if not records:
+                break
+            try:
+                for record in records:
+                    self.send(*unpack_record(record))
+                self.commit()
+            except BROKER_ERRORS as e:
+                self.spool.rewind()
+                self.on_broker_down(e)
+                return
+            self.spool.commit()
+            self.published += len(records)
+
+    def stats(self):
+        '''Gets publish counters and spool usage'''
+        stats = {
+            "published": self.published,
+            "batches": self.batches,
+            "spooled": self.spooled,
+            "outages": self.outages,
+        }
+        if self.spool is not None:
+            stats.update(self.spool.stats())
+        return stats
     
 
 ## SUBSCRIBE TO RABBITMQ TO HEAR HEARTBEAT MESSAGE
@@ -89,7 +406,7 @@ def rabbitmq_subscribe_to_queue(channel, queue):
         Callback object to access received messages      
     '''
     # Initialise queue
-    channel.queue_declare(queue=queue)
+    declare_queue(channel, queue)
 
     # Declare callback obj to pass data
     heartbeat_cback = HeartbeatCallback(channel)
@@ -120,6 +437,6 @@ class HeartbeatCallback:
         data-processor is received
         '''
         if json.loads(body) == "ack":
-            print("Recieved heartbeat message from data-processor", flush=True)
+            logger.info("Recieved heartbeat message from data-processor")
             # Cancel subscribe to queue and unblock thread
             self.channel.basic_cancel(self.consumer_tag)
\ No newline at end of file
@@ -0,0 +1,171 @@
+import zlib
+import queue
+import multiprocessing
+import preprocessing
+import metrics
+
+# Marker sent to shards to close all windows
+FLUSH = "flush"
+
+# Counted in the parent from the counts workers send with their results,
+# metrics of worker processes are not collected
+COUNTERS = {
+    "outliers": metrics.counter("preprocessor_rejected_total", "Readings rejected as outliers"),
+    "late_dropped": metrics.counter("preprocessor_late_dropped_total",
+                                    "Readings dropped as their windows were already closed"),
+    "forced_closes": metrics.counter("preprocessor_forced_closes_total",
+                                     "Windows closed early as too many were open"),
+}
+
+def count(counts):
+    '''Adds counts of preprocessing, see KeyedPreprocessor.take_counts'''
+    for name, value in counts.items():
+        if value:
+            COUNTERS[name].inc(value)
+
+def shard_of(key, shards):
+    '''
+    Gets shard of key
+    Uses crc32 since hash() of str differs between processes
+    '''
+    return zlib.crc32(key.encode()) % shards
+
+def shard_worker(in_queue, out_queue, preprocessor_kwargs):
+    '''
+    Runs in each worker process
+    Processes (key, readings) items in order and sends closed windows,
+    rejected readings and counts back as
+    ("results", ([(key, results, rejected)], counts)),
+    replies to FLUSH with ("flushed", ([(key, results, [])...], stats)),
+    stops on None
+    '''
+    keyed = preprocessing.KeyedPreprocessor(**preprocessor_kwargs)
+    while True:
+        item = in_queue.get()
+        if item is None:
+            break
+        if item == FLUSH:
+            flushed = [(key, results, []) for key, results in keyed.flush()]
+            out_queue.put(("flushed", (flushed, keyed.stats())))
+            continue
+
+        key, readings = item
+        results, rejected = keyed.process(key, readings)
+        counts = keyed.take_counts()
+        if results or rejected or any(counts.values()):
+            out_queue.put(("results", ([(key, results, rejected)], counts)))
+
+
+class ShardedPreprocessor:
+    '''
+    Spreads keyed preprocessing over a pool of worker processes
+    Each key is always sent to the same worker so readings of a key are
+    processed in the order they were submitted, and results of a key are
+    returned in order
+
+    With workers=0 readings are processed in the calling process
+
+    Attributes:
+        workers: Number of worker processes
+        preprocessor_kwargs: Arguments of each key's Preprocessor
+    '''
+    def __init__(self, workers, **preprocessor_kwargs):
+        self.workers = workers
+        self.keyed = None
+        self.last_stats = {}
+
+        if workers <= 0:
+            self.keyed = preprocessing.KeyedPreprocessor(**preprocessor_kwargs)
+            return
+
+        self.out_queue = multiprocessing.Queue()
+        self.in_queues = []
+        self.processes = []
+        for _ in range(workers):
+            in_queue = multiprocessing.Queue()
+            process = multiprocessing.Process(target=shard_worker,
+                                              args=(in_queue, self.out_queue, preprocessor_kwargs),
+                                              daemon=True)
+            process.start()
+            self.in_queues.append(in_queue)
+            self.processes.append(process)
+
+    def submit(self, key, readings):
+        '''
+        Queues readings of key for processing
+        In-process mode returns results straight away
+
+        Returns: list of (key, list of closed window aggregates,
+            list of rejected readings)
+        '''
+        if self.keyed is not None:
+            results, rejected = self.keyed.process(key, readings)
+            count(self.keyed.take_counts())
+            return [(key, results, rejected)] if results or rejected else []
+
+        self.in_queues[shard_of(key, self.workers)].put((key, readings))
+        return self.poll()
+
+    def poll(self):
+        '''
+        Gets results which workers have finished, does not block
+
+        Returns: list of (key, list of closed window aggregates,
+            list of rejected readings)
+        '''
+        if self.keyed is not None:
+            return []
+
+        results = []
+        while True:
+            try:
+                kind, payload = self.out_queue.get_nowait()
+            except queue.Empty:
+                return results
+            # Flush replies only arrive while flush() is waiting
+            payload, counts = payload
+            count(counts)
+            results += [x for x in payload if x[1] or x[2]]
+
+    def flush(self):
+        '''
+        Closes all open windows in every worker
+        Blocks until every worker has flushed
+
+        Returns: list of (key, list of closed window aggregates,
+            list of rejected readings), including results finished before
+            the flush
+        '''
+        if self.keyed is not None:
+            results = [(key, x, []) for key, x in self.keyed.flush() if x]
+            self.last_stats = self.keyed.stats()
+            return results
+
+        for in_queue in self.in_queues:
+            in_queue.put(FLUSH)
+
+        results = []
+        stats = {}
+        flushed = 0
+        while flushed < self.workers:
+            kind, payload = self.out_queue.get()
+            if kind == "flushed":
+                flushed += 1
+                payload, shard_stats = payload
+                for name, value in shard_stats.items():
+                    stats[name] = stats.get(name, 0) + value
+            else:
+                payload, counts = payload
+                count(counts)
+            results += [x for x in payload if x[1] or x[2]]
+        self.last_stats = stats
+        return results
+
+    def close(self):
+        '''Stops worker processes'''
+        if self.keyed is not None:
+            return
+        for in_queue in self.in_queues:
+            in_queue.put(None)
+        for process in self.processes:
+            process.join()
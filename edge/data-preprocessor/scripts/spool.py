@@ -0,0 +1,293 @@
+'''
+Durable store-and-forward spool for messages which cannot be sent yet
+
+Messages are appended to memory-mapped segment files and read back in the
+order they were written. The read position is only moved on by commit(),
+once the messages have been delivered, and is saved to an offsets file
+which is replaced atomically so a crash never loses or skips a message.
+Messages read but not committed before a crash are read again.
+
+Directory layout:
+    <segment>.seg   segment files named by their zero-padded index
+    offsets         committed read position, "<segment> <byte offset>"
+
+Record layout, little-endian:
+    I length, I crc32 of payload, payload
+A length of 0 marks the end of written records in a segment, records with
+a bad crc32 (e.g. torn by a crash) end the segment too
+'''
+import os
+import mmap
+import time
+import zlib
+import struct
+
+RECORD = struct.Struct("<II")
+OFFSETS = "offsets"
+SUFFIX = ".seg"
+
+
+class Segment:
+    '''
+    Segment file preallocated to :size: bytes and mapped into memory
+    Appends are copies into the mapping, the OS writes them back to disk
+    '''
+    def __init__(self, path, index, size):
+        self.path = path
+        self.index = index
+        exists = os.path.exists(path)
+        self.file = open(path, "r+b" if exists else "w+b")
+        if not exists or os.path.getsize(path) < size:
+            self.file.truncate(size)
+        self.size = os.path.getsize(path)
+        self.map = mmap.mmap(self.file.fileno(), self.size)
+        # End of valid records
+        self.end = self.scan(0)[1]
+
+    def scan(self, offset, limit=None):
+        '''
+        Reads valid records from offset
+
+        Returns: tuple of list of (end offset, payload) and offset after the
+            last valid record
+        '''
+        records = []
+        while offset + RECORD.size <= self.size and (limit is None or len(records) < limit):
+            length, crc = RECORD.unpack_from(self.map, offset)
+            end = offset + RECORD.size + length
+            if length == 0 or end > self.size:
+                break
+            payload = self.map[offset + RECORD.size:end]
+            if zlib.crc32(payload) != crc:
+                break
+            records.append((end, payload))
+            offset = end
+        return records, offset
+
+    def append(self, payload):
+        '''
+        Appends record
+
+        Returns: False if the record does not fit in the segment
+        '''
+        end = self.end + RECORD.size + len(payload)
+        if end > self.size:
+            return False
+        self.map[self.end + RECORD.size:end] = payload
+        # Header last, a torn write is never read as a record
+        RECORD.pack_into(self.map, self.end, len(payload), zlib.crc32(payload))
+        self.end = end
+        return True
+
+    def sync(self):
+        '''Writes appended records to disk'''
+        self.map.flush()
+
+    def close(self):
+        self.map.close()
+        self.file.close()
+
+
+class Spool:
+    '''
+    Append-only spool of byte strings split over segment files
+    Disk use is bounded by :max_bytes:, when a new segment would exceed it
+    the oldest segment is dropped whether it has been read or not. Segments
+    last written more than :retention: seconds ago are dropped too.
+
+    Attributes:
+        directory: Directory of segment files, created if needed
+        segment_bytes: Size of each segment file, records larger than this
+            are rejected
+        max_bytes: Maximum size of all segment files
+        retention: Seconds a segment is kept after it was last written,
+            None to keep segments until they are read
+        sync_every: Appends between writing segments to disk, 0 to leave it
+            to the OS (survives a crash of the process but not of the host)
+    '''
+    def __init__(self, directory, segment_bytes=16*1024*1024, max_bytes=1024*1024*1024,
+                 retention=None, sync_every=0):
+        assert max_bytes >= segment_bytes
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.max_bytes = max_bytes
+        self.retention = retention
+        self.sync_every = sync_every
+        os.makedirs(directory, exist_ok=True)
+
+        # Index -> Segment, oldest first
+        self.segments = {}
+        for name in sorted(os.listdir(directory)):
+            if name.endswith(SUFFIX):
+                index = int(name[:-len(SUFFIX)])
+                self.segments[index] = Segment(self._path(index), index, segment_bytes)
+        # Time each segment was last written
+        self.written_at = {index: os.path.getmtime(self._path(index)) for index in self.segments}
+
+        # Committed read position and position of next read
+        self.read_segment, self.read_offset = self._load_offsets()
+        self.committed = (self.read_segment, self.read_offset)
+        self.unsynced = 0
+        # Bytes not yet committed, None when it needs counting again
+        self.pending_bytes = None
+
+        # Counters
+        self.appended = 0
+        self.dropped_segments = 0
+
+    def _path(self, index):
+        return os.path.join(self.directory, f"{index:012d}{SUFFIX}")
+
+    def _load_offsets(self):
+        '''Reads committed read position, defaults to the oldest segment'''
+        try:
+            with open(os.path.join(self.directory, OFFSETS)) as f:
+                segment, offset = (int(x) for x in f.read().split())
+        except (OSError, ValueError):
+            segment, offset = min(self.segments, default=0), 0
+        # Segments before the position may have been dropped since
+        if self.segments and segment < min(self.segments):
+            segment, offset = min(self.segments), 0
+        return segment, offset
+
+    def _save_offsets(self):
+        '''Saves committed read position, replaced atomically'''
+        path = os.path.join(self.directory, OFFSETS)
+        tmp = path + ".tmp"
+        with open(tmp, "w") as f:
+            f.write(f"{self.committed[0]} {self.committed[1]}")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+
+    def append(self, payload):
+        '''
+        Appends payload to the newest segment, starting a new segment if full
+
+        Raises:
+            ValueError: if payload is larger than a segment
+        '''
+        if RECORD.size + len(payload) > self.segment_bytes:
+            raise ValueError(f"Record of {len(payload)} bytes does not fit in a segment")
+        segment = self.segments[max(self.segments)] if self.segments else None
+        if segment is None or not segment.append(payload):
+            segment = self._new_segment()
+            segment.append(payload)
+        self.written_at[segment.index] = time.time()
+        self.appended += 1
+        if self.pending_bytes is not None:
+            self.pending_bytes += RECORD.size + len(payload)
+
+        self.unsynced += 1
+        if self.sync_every and self.unsynced >= self.sync_every:
+            self.sync()
+
+    def _new_segment(self):
+        '''Starts a new segment, dropping old segments to stay within bounds'''
+        index = max(self.segments) + 1 if self.segments else self.read_segment
+        if self.segments:
+            self.segments[max(self.segments)].sync()
+        while self.segments and (len(self.segments) + 1) * self.segment_bytes > self.max_bytes:
+            self._drop(min(self.segments))
+        segment = self.segments[index] = Segment(self._path(index), index, self.segment_bytes)
+        return segment
+
+    def _drop(self, index):
+        '''Deletes segment, moving the read position past it if needed'''
+        segment = self.segments.pop(index)
+        self.written_at.pop(index, None)
+        segment.close()
+        os.remove(segment.path)
+        self.pending_bytes = None
+        if self.read_segment <= index:
+            self.dropped_segments += 1
+            self.read_segment, self.read_offset = index + 1, 0
+        if self.committed[0] <= index:
+            self.committed = (index + 1, 0)
+            self._save_offsets()
+
+    def expire(self, now=None):
+        '''Drops segments older than the retention period'''
+        if self.retention is None:
+            return
+        now = time.time() if now is None else now
+        for index in list(self.segments):
+            if index != max(self.segments) and now - self.written_at[index] > self.retention:
+                self._drop(index)
+
+    def read(self, limit=100):
+        '''
+        Reads up to :limit: records after the last read, oldest first
+
+        Returns: list of payloads, call commit() once they are delivered
+        '''
+        records = []
+        while len(records) < limit:
+            segment = self.segments.get(self.read_segment)
+            if segment is None:
+                break
+            found, _ = segment.scan(self.read_offset, limit - len(records))
+            records += [bytes(payload) for _, payload in found]
+            if found:
+                self.read_offset = found[-1][0]
+            # Move to the next segment once this one is full and read
+            if self.read_offset >= segment.end and self.read_segment < max(self.segments):
+                self.read_segment, self.read_offset = self.read_segment + 1, 0
+            elif not found:
+                break
+        return records
+
+    def commit(self):
+        '''
+        Marks records returned by read() as delivered
+        Read segments are deleted
+        '''
+        self.committed = (self.read_segment, self.read_offset)
+        self.pending_bytes = None
+        self._save_offsets()
+        for index in list(self.segments):
+            if index < self.read_segment:
+                self._drop(index)
+
+    def rewind(self):
+        '''Moves the read position back to the last commit, e.g. after a failed delivery'''
+        self.read_segment, self.read_offset = self.committed
+
+    def sync(self):
+        '''Writes the newest segment to disk'''
+        if self.segments:
+            self.segments[max(self.segments)].sync()
+        self.unsynced = 0
+
+    def pending(self):
+        '''
+        Number of bytes not yet committed, 0 when the spool is drained
+        Counted over the segments after a commit or a drop and kept up to
+        date by appends, so checking it per message is cheap
+        '''
+        if self.pending_bytes is None:
+            total = 0
+            for index, segment in self.segments.items():
+                if index > self.committed[0]:
+                    total += segment.end
+                elif index == self.committed[0]:
+                    total += segment.end - self.committed[1]
+            self.pending_bytes = total
+        return self.pending_bytes
+
+    def empty(self):
+        '''Checks every record has been committed'''
+        return self.pending() == 0
+
+    def stats(self):
+        return {
+            "spool_segments": len(self.segments),
+            "spool_pending_bytes": self.pending(),
+            "spool_appended": self.appended,
+            "spool_dropped_segments": self.dropped_segments,
+        }
+
+    def close(self):
+        self.sync()
+        for segment in self.segments.values():
+            segment.close()
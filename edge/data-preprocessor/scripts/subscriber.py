@@ -1,28 +1,54 @@
 import json
 from paho.mqtt import client as mqtt_client
 import time
-import preprocessing
+import sharding
 import publisher
+import codec
+import compression
+import connections
+import log
+import metrics
 
-counter = 0
+logger = log.get_logger(__name__)
+
+MESSAGES = metrics.counter("preprocessor_messages_total", "MQTT messages received, by format", ["format"])
+READINGS = metrics.counter("preprocessor_readings_total", "Readings received")
+PARSE_SECONDS = metrics.histogram("preprocessor_parse_seconds", "Time to parse an MQTT message")
+RECEIVE_LATENCY = metrics.histogram("preprocessor_receive_latency_seconds",
+                                    "Time from data-injector encoding a frame to receiving it")
+PROCESS_SECONDS = metrics.histogram("preprocessor_process_seconds",
+                                    "Time to preprocess a message (window and outlier detection)")
+WINDOWS = metrics.counter("preprocessor_windows_closed_total", "Windows closed and aggregated")
+PUBLISH_SECONDS = metrics.histogram("preprocessor_publish_seconds",
+                                    "Time to publish a batch of aggregates to RabbitMQ, commit included")
 
 ## Connect to data-injector
-def connect_to_mqtt(ip, port=1883, attempts=20):
+def connect_to_mqtt(ip, port=1883, attempts=None, timeout=100, shards=None, outlier_topic=None,
+                    wire_format="json", fields=("mean",), compress="auto"):
     '''
     Connects to EMQX MQTT message broker
     https://www.emqx.io/
+    Retries with backoff (see connections), once connected the client
+    reconnects by itself whenever the connection is lost
 
     Attributes:
         ip: IP of message broker
         port: Port of message broker
-        attempts: Number of attempts to connect
+        attempts: Maximum number of attempts, None for no limit
+        timeout: Seconds to keep trying
+        shards: sharding.ShardedPreprocessor to process readings, defaults
+            to processing in this process with default settings
+        outlier_topic: MQTT topic prefix to publish rejected readings to
+        wire_format: Format to forward aggregates in, see Callback
+        fields: Names of aggregates in each window
+        compress: Compression of binary frames, see Callback
 
     Returns: tuple of: 
         EMQX Client blocking connection
         Callback object to access messages (see below)
 
     Raises:
-        ConnectionError: if all :attempts: fail
+        ConnectionError: if no attempt succeeds
     '''
     # Create a mqtt client object
     client = mqtt_client.Client()
@@ -30,32 +56,17 @@ def connect_to_mqtt(ip, port=1883, attempts=20):
     client.message_callback_add("check", on_message_ack) # call different callback with ack requests
     
     # Callback through callback object
-    cback = Callback()
+    if shards is None:
+        shards = sharding.ShardedPreprocessor(0)
+    cback = Callback(shards, outlier_topic, wire_format, fields, compress)
     client.on_message = cback.on_message
+    client.on_connect = on_connect
     client.on_disconnect = on_disconnect
+    client.reconnect_delay_set(connections.MIN_DELAY, connections.MAX_DELAY)
 
-    connected = False    
-    # Make connection attempts
-    for i in range(attempts):
-        try:    
-            # Connect to MQTT service
-            client.connect(ip, port)
-            # If successful
-            print(f"({ip}) Connected to broker", flush=True)
-            connected = True
-            break
-
-        except ConnectionError:
-            # if Connection failed
-            # Sleep for 5 seconds before trying again
-            print(f"({ip}) Could not connect, trying again in 5 seconds", flush=True)
-            time.sleep(5)
-    
-    # If connection attempts fail
-    if not connected:
-        raise ConnectionError(f"Could not connect to {ip}")
-    else:
-        return client, cback
+    connections.retry(lambda: client.connect(ip, port), f"MQTT broker ({ip})",
+                      timeout=timeout, attempts=attempts, probe=(ip, port))
+    return client, cback
 
 
 ## Subscibe to hear content from data-injector
@@ -63,15 +74,19 @@ def subscribe(client, topic):
     '''
     Subscribes to topic on EQMX broker
     NOTE: will loop forever on thread to listen for messages
+    Topics are subscribed to again on every reconnect, the broker forgets
+    the subscriptions of a clean session
     Attributes:
         client: blocking connection to 
-        queue: Topic to subscribe to
+        queue: Topic or list of topics to subscribe to
     '''
-    # ensure topic is a string
-    assert type(topic) == str
+    # ensure topic is a string or list of strings
+    topics = topic if type(topic) == list else [topic]
+    assert all(type(x) == str for x in topics)
 
-    # Subscribe to topic and wait for message
-    client.subscribe(topic)
+    # Subscribe to topics and wait for message
+    client.user_data_set({"topics": topics})
+    client.subscribe([(x, 0) for x in topics])
     client.loop_forever()
 
         
@@ -106,9 +121,23 @@ def publish_to_mqtt(client, topic, msg, retain=False):
     msg = json.dumps(msg)
     client.publish(topic, msg, retain=retain)
 
-def on_disconnect(client, userdata, msg):
-    '''Callback for when data-preprocessor is disconnected from broker'''
-    raise ConnectionAbortedError("Connection failed")
+def on_connect(client, userdata, flags, rc):
+    '''Callback for when a connection is established, resubscribes after a reconnect'''
+    if rc != 0:
+        logger.warning("MQTT broker refused connection: %s", mqtt_client.connack_string(rc))
+        return
+    topics = (userdata or {}).get("topics")
+    if topics:
+        logger.info("MQTT session established, subscribing to %s", topics)
+        client.subscribe([(x, 0) for x in topics])
+
+def on_disconnect(client, userdata, rc):
+    '''
+    Callback for when data-preprocessor is disconnected from broker
+    paho's loop reconnects by itself with backoff
+    '''
+    if rc != 0:
+        logger.warning("Lost connection to MQTT broker, reconnecting: %s", mqtt_client.error_string(rc))
 
 
 ## MESSAGE CALLBACKS ##
@@ -123,47 +152,222 @@ def on_message_ack(client, userdata, msg):
 
     # Check if message is a ready message
     if str_msg == "ack_req":
-        print("Recieved ACK_REQUEST from publisher", flush=True)
+        logger.info("Recieved ACK_REQUEST from publisher")
         publish_to_mqtt(client, "response", "ack", retain=True)
-        print("Sent ACK to publisher", flush=True)
+        logger.info("Sent ACK to publisher")
     else:
-        print(f"{str_msg} is not ack_req", flush=True)
+        logger.warning("%s is not ack_req", str_msg)
 
 ## Call back object for recieving a message from data-processor
-class Callback(preprocessing.Preprocessor):
+class Callback:
     """
     Callback class to access received messages from data-processor
     When message is received, on_message is called
-    Inherits Preprocessor class for stream calculations
+    Readings are keyed by series (the sensor ID of CSC8112/<sensor_id>
+    topics) and processed by a preprocessing shard of that series
+    Readings may arrive as binary frames (see codec) or JSON, binary frames
+    are passed to the shard without decoding their columns
     """
-    def __init__(self):
-        ''' Initialises Preprocessing and class variables'''
-        # Inherit preprocesssor init
-        super().__init__()
-        self.rabbit_channel = None
-    
+    def __init__(self, shards, outlier_topic=None, wire_format="json", fields=("mean",),
+                 compress="auto"):
+        '''
+        Initialises class variables
+
+        Attributes:
+            shards: sharding.ShardedPreprocessor to process readings
+            outlier_topic: MQTT topic to publish rejected readings to as
+                <outlier_topic>/<series>, None to only count them
+            wire_format: "binary" to forward the aggregates of a message as one
+                binary frame, "json" to forward each window as a
+                timestamp:value[:value...] string. Binary needs shards to
+                return structured results
+            fields: Names of aggregates in each window
+            compress: Compression of binary frames sent to data-processor,
+                "gorilla", "zlib", "auto" for whichever is smaller or "none"
+        '''
+        self.shards = shards
+        self.outlier_topic = outlier_topic
+        self.wire_format = wire_format
+        self.fields = tuple(fields)
+        self.compress = COMPRESSION[compress]
+        # publisher.RabbitPublisher to send aggregates with
+        self.rabbit_publisher = None
+        self.mqtt_client = None
+        # pipeline.Pipeline to process and publish on, None to do both on
+        # the MQTT network thread
+        self.pipeline = None
+        # Series -> sent_at of its newest processed frame, carried on to
+        # data-processor to measure end-to-end latency
+        self.sent_at = {}
+
     # When client recieves message
     def on_message(self, client, userdata, msg):
         '''
         Function which is called when messages is received.
-        Calculates week average and publishes it to RabbitMQ message broker
-        on CSC8112 queue.
+        Calculates window aggregates and publishes them to RabbitMQ message
+        broker on CSC8112 queue.
+        With a pipeline the message is only queued, it is processed and
+        published on the pipeline's threads
         '''
+        self.mqtt_client = client
+        key = series_key(msg.topic)
+        start = time.perf_counter()
+
+        # Binary frames are decoded by the shard, only the header is read here
+        if codec.is_binary(msg.payload):
+            _, series, sent_at, fields, count, offset = codec.decode_header(msg.payload)
+            # Checked here as a bad frame would stop the shard's worker
+            if len(msg.payload) != offset + 8 * count * (1 + len(fields)):
+                raise ValueError("Frame length does not match header")
+            key = series or key
+            PARSE_SECONDS.observe(time.perf_counter() - start)
+            MESSAGES.labels("binary").inc()
+            READINGS.inc(count)
+            RECEIVE_LATENCY.observe(metrics.since(sent_at))
+            logger.debug("Frame recieved from data-injector on %s: %d readings", msg.topic, count)
+            self.dispatch(("readings", key, bytes(msg.payload)))
+            return
+
         # Parse payload
-        str_msg = str(json.loads(msg.payload))
-        print(f"Message recieved from data-injector: {str_msg}", flush=True)
-
-        # Process value
-        avg_value = self.process_value(str_msg)
-        try:
-            if str_msg == "finished":
-                publisher.publish_to_rabbitmq(self.rabbit_channel, "CSC8112", str_msg)
-                return
-        except:
-            raise ValueError()
+        payload = json.loads(msg.payload)
+        PARSE_SECONDS.observe(time.perf_counter() - start)
+        MESSAGES.labels("json").inc()
 
-        
-        if not avg_value is False and not avg_value is None:
-            # Send value to RabbitMQ server
-            print(f"Weekly average value: {avg_value}", flush=True)
-            publisher.publish_to_rabbitmq(self.rabbit_channel, "CSC8112", avg_value)
+        # Unpack batched frames from data-injector, single readings are
+        # still accepted as they are
+        if type(payload) == list:
+            logger.debug("Frame recieved from data-injector on %s: %d readings", msg.topic, len(payload))
+            readings = [str(x) for x in payload]
+        else:
+            readings = [str(payload)]
+            logger.debug("Message recieved from data-injector on %s: %s", msg.topic, readings[0])
+
+        READINGS.inc(len(readings))
+        if "finished" in readings:
+            # Process readings sent before finished token
+            readings = readings[:readings.index("finished")]
+            if readings:
+                self.dispatch(("readings", key, readings))
+            self.dispatch(("finished",), control=True)
+        else:
+            self.dispatch(("readings", key, readings))
+
+    def dispatch(self, item, control=False):
+        '''
+        Queues item on the pipeline, or processes and publishes it straight
+        away without one
+
+        Attributes:
+            item: ("readings", key, readings) or ("finished",)
+            control: Never drop the item, see pipeline.BoundedQueue
+        '''
+        if self.pipeline is not None:
+            self.pipeline.put(item, control)
+            return
+        self.publish(self.process(item))
+
+    def process(self, item):
+        '''
+        Preprocesses ingested item
+
+        Returns: list of ("results", results) or ("finished", results) items
+            to publish, see publish_results
+        '''
+        if item[0] == "finished":
+            results = self.shards.flush()
+            logger.info("Recieved finished token", extra={"fields": self.shards.last_stats})
+            return [("finished", results)]
+        _, key, readings = item
+        if type(readings) == bytes:
+            self.sent_at[key] = codec.decode_header(readings)[2]
+        start = time.perf_counter()
+        results = self.shards.submit(key, readings)
+        PROCESS_SECONDS.observe(time.perf_counter() - start)
+        return [("results", results)] if results else []
+
+    def poll(self):
+        '''Gets results finished by preprocessing workers since the last call'''
+        results = self.shards.poll()
+        return [("results", results)] if results else []
+
+    def publish(self, items):
+        '''
+        Publishes list of preprocessed items, see process
+        The aggregates of every item are delivered as one batch
+        '''
+        start = time.perf_counter()
+        for kind, results in items:
+            self.publish_results(results, flush=False)
+            if kind == "finished":
+                self.on_finished()
+        self.rabbit_publisher.flush()
+        PUBLISH_SECONDS.observe(time.perf_counter() - start)
+
+    def on_finished(self):
+        '''
+        Publishes the finished token once the aggregates of every closed
+        window have been published
+        '''
+        self.rabbit_publisher.publish("CSC8112", "finished")
+        # Deliver everything spooled during outages before finishing
+        self.rabbit_publisher.flush(drain_all=True)
+        logger.info("Publisher stats", extra={"fields": self.rabbit_publisher.stats()})
+        if self.pipeline is not None:
+            logger.info("Pipeline stats", extra={"fields": self.pipeline.stats()})
+
+    def publish_results(self, results, flush=True):
+        '''
+        Publishes window aggregates to RabbitMQ message broker on CSC8112 queue
+        The series of each message is sent in its "series" header
+        Rejected readings are sent to the outlier topic if one is set
+
+        Attributes:
+            results: list of (key, list of window aggregates,
+                list of rejected readings)
+            flush: Deliver the aggregates before returning
+        '''
+        for key, avg_values, rejected in results:
+            WINDOWS.inc(len(avg_values))
+            if rejected and self.outlier_topic is not None:
+                self.mqtt_client.publish(f"{self.outlier_topic}/{key}", json.dumps(rejected))
+            if self.wire_format == "binary":
+                if avg_values:
+                    self.publish_frame(key, avg_values)
+                continue
+            for avg_value in avg_values:
+                # Send value to RabbitMQ server
+                logger.debug("Window aggregates of %s: %s", key, avg_value)
+                self.rabbit_publisher.publish("CSC8112", avg_value, headers={"series": key})
+        # Deliver aggregates of this message as one batch
+        if flush:
+            self.rabbit_publisher.flush()
+
+    def publish_frame(self, key, windows):
+        '''
+        Publishes windows of one series as a binary frame
+
+        Attributes:
+            key: Series key
+            windows: list of (start, list of aggregate values)
+        '''
+        starts = [start for start, _ in windows]
+        columns = list(zip(*(values for _, values in windows)))
+        logger.debug("Window aggregates of %s: %d windows from %d", key, len(windows), starts[0])
+        # Carries the source timestamp of the readings, see metrics
+        frame = codec.encode_aggregates(key, self.fields, starts, columns, sent_at=self.sent_at.get(key))
+        if self.compress is not False:
+            frame = compression.compress(frame, self.compress)
+        self.rabbit_publisher.publish("CSC8112", frame, headers={"series": key})
+
+# Compression setting -> encoding passed to compression.compress, False for
+# uncompressed frames
+COMPRESSION = {
+    "auto": None,
+    "gorilla": compression.ENCODING_GORILLA,
+    "zlib": compression.ENCODING_ZLIB,
+    "none": False,
+}
+
+def series_key(topic):
+    '''Gets series key of topic, CSC8112/<sensor_id> -> <sensor_id>'''
+    return topic.split("/", 1)[1] if "/" in topic else topic
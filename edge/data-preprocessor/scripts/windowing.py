@@ -0,0 +1,145 @@
+import re
+import time
+from functools import lru_cache
+
+# Seconds in each duration unit
+UNITS = {"s": 1, "m": 60, "h": 60*60, "d": 24*60*60}
+
+# Step of sliding windows when none is given
+SLIDING_STEP = 60
+
+def parse_duration(x):
+    '''
+    Parses duration such as 30s, 15m, 1h or 1d into seconds
+
+    Raises:
+        ValueError: if :x: is not a number followed by s, m, h or d
+    '''
+    match = re.fullmatch(r"\s*(\d+)\s*([smhd])\s*", x)
+    if match is None:
+        raise ValueError(f"Invalid duration {x}, expected e.g. 30s, 15m, 1h or 1d")
+    return int(match.group(1)) * UNITS[match.group(2)]
+
+@lru_cache(maxsize=4096)
+def local_offset(hour):
+    '''
+    Gets UTC offset in seconds of local timezone during hour since epoch
+    Cached since offsets only change on DST transitions
+    '''
+    return time.localtime(hour * 3600).tm_gmtoff
+
+
+class WindowSpec:
+    '''
+    Assigns timestamps to windows with integer arithmetic
+    Windows are :size: seconds long and start every :hop: seconds, aligned to
+    midnight of the configured timezone.
+        tumbling: hop == size, each timestamp is in one window
+        hopping: hop < size, each timestamp is in size/hop windows
+        sliding: hopping windows with a small hop, results are updated
+            every hop seconds
+
+    Overlapping windows are built from panes, non-overlapping blocks of hop
+    seconds. Each value is added to only one pane and a window's result is
+    the merge of its panes.
+
+    Attributes:
+        size: Window length in seconds
+        hop: Seconds between window starts, defaults to size (tumbling)
+        tz: "UTC", "local" for the host timezone, or a fixed UTC offset in
+            seconds. UTC gives the same windows on every host
+    '''
+    def __init__(self, size, hop=None, tz="UTC"):
+        hop = size if hop is None else hop
+        if size <= 0 or hop <= 0 or size % hop != 0:
+            raise ValueError(f"Window size {size}s must be a positive multiple of hop {hop}s")
+
+        self.size = size
+        self.hop = hop
+        self.panes_per_window = size // hop
+        self.tz = tz
+        self._local = tz == "local"
+        self._offset = 0 if tz in ("UTC", "local") else int(tz)
+
+    @property
+    def kind(self):
+        return "tumbling" if self.hop == self.size else "hopping"
+
+    def offset(self, ts):
+        '''UTC offset in seconds at timestamp'''
+        if self._local:
+            return local_offset(ts // 3600)
+        return self._offset
+
+    def pane_start(self, ts):
+        '''Gets start of pane containing integer timestamp ts'''
+        offset = self.offset(ts)
+        return (ts + offset) // self.hop * self.hop - offset
+
+    def first_window(self, pane):
+        '''Gets start of first window containing pane'''
+        return pane - self.size + self.hop
+
+    def panes(self, window):
+        '''Gets starts of panes in window'''
+        return range(window, window + self.size, self.hop)
+
+    def __repr__(self):
+        return f"WindowSpec({self.kind}, size={self.size}s, hop={self.hop}s, tz={self.tz})"
+
+
+def tumbling(size, tz="UTC"):
+    '''Non-overlapping windows of :size: seconds'''
+    return WindowSpec(size, size, tz)
+
+def hopping(size, hop, tz="UTC"):
+    '''Windows of :size: seconds starting every :hop: seconds'''
+    return WindowSpec(size, hop, tz)
+
+def sliding(size, step=SLIDING_STEP, tz="UTC"):
+    '''Windows of :size: seconds whose result is updated every :step: seconds'''
+    return WindowSpec(size, step, tz)
+
+def parse_window(spec, tz="UTC"):
+    '''
+    Parses window configuration
+
+        1d or tumbling:1d       one day tumbling windows
+        hopping:1d/1h           one day windows starting every hour
+        1d/1h                   same as hopping:1d/1h
+        sliding:1h              one hour windows updated every minute
+        sliding:1h/10s          one hour windows updated every 10 seconds
+
+    Attributes:
+        spec: Window configuration string
+        tz: "UTC", "local" or fixed UTC offset, see WindowSpec
+
+    Returns: WindowSpec
+
+    Raises:
+        ValueError: if :spec: is invalid
+    '''
+    kind, _, durations = spec.rpartition(":")
+    kind = kind.strip() or "tumbling"
+    size, _, hop = durations.partition("/")
+    size = parse_duration(size)
+    hop = parse_duration(hop) if hop else None
+
+    if kind == "tumbling":
+        if hop is not None and hop != size:
+            kind = "hopping"
+        else:
+            return tumbling(size, tz)
+    if kind == "hopping":
+        if hop is None:
+            raise ValueError(f"Hopping window {spec} needs a hop, e.g. hopping:1d/1h")
+        return hopping(size, hop, tz)
+    if kind == "sliding":
+        return sliding(size, SLIDING_STEP if hop is None else hop, tz)
+    raise ValueError(f"Unknown window kind {kind}, expected tumbling, hopping or sliding")
+
+def parse_tz(tz):
+    '''Parses timezone as UTC, local or a UTC offset in seconds'''
+    if tz in ("UTC", "local"):
+        return tz
+    return int(tz)
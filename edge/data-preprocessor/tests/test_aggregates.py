@@ -0,0 +1,68 @@
+import random
+import statistics
+import pytest
+from aggregates import AggregateState, QuantileSketch, parse_aggregates
+
+NAMES = ("count", "mean", "min", "max", "variance", "p50", "p95")
+
+
+def exact(values):
+    ordered = sorted(values)
+    return [len(values), statistics.mean(values), min(values), max(values),
+            statistics.variance(values),
+            ordered[round(0.50 * (len(values) - 1))], ordered[round(0.95 * (len(values) - 1))]]
+
+def state_of(values, names=NAMES):
+    state = AggregateState(names)
+    for x in values:
+        state.add(x)
+    return state
+
+
+def test_aggregates_match_exact_values():
+    rng = random.Random(1)
+    values = [rng.uniform(0, 50) for _ in range(5000)]
+    count, mean, low, high, variance, p50, p95 = state_of(values).result()
+    expected = exact(values)
+    assert count == expected[0]
+    assert (low, high) == (expected[2], expected[3])
+    assert mean == pytest.approx(expected[1])
+    assert variance == pytest.approx(expected[4])
+    assert p50 == pytest.approx(expected[5], rel=0.01)
+    assert p95 == pytest.approx(expected[6], rel=0.01)
+
+def test_merged_states_equal_one_state():
+    rng = random.Random(2)
+    values = [rng.gauss(10, 3) for _ in range(2000)]
+    merged = state_of(values[:700])
+    merged.merge(state_of(values[700:]))
+    whole = state_of(values).result()
+    for x, y in zip(merged.result(), whole):
+        assert x == pytest.approx(y)
+
+def test_empty_window_has_no_values():
+    assert AggregateState(("mean", "min", "variance", "p50")).result() == [None, None, None, None]
+
+def test_variance_needs_two_values():
+    assert state_of([3.0], ("variance",)).result() == [None]
+
+def test_sketch_handles_negative_and_zero_values():
+    sketch = QuantileSketch()
+    for x in [-10.0, -1.0, 0.0, 0.0, 1.0, 10.0]:
+        sketch.add(x)
+    assert sketch.quantile(0) == pytest.approx(-10.0, rel=0.01)
+    assert sketch.quantile(0.5) == 0.0
+    assert sketch.quantile(1) == pytest.approx(10.0, rel=0.01)
+
+def test_sketch_memory_is_bounded():
+    sketch = QuantileSketch(max_buckets=64)
+    for i in range(1, 100000, 7):
+        sketch.add(float(i))
+    assert len(sketch.positive) <= 64
+    # Collapsing only loses accuracy of low quantiles
+    assert sketch.quantile(1) == pytest.approx(99996, rel=0.01)
+
+def test_parse_aggregates():
+    assert parse_aggregates("mean, max,p95") == ("mean", "max", "p95")
+    with pytest.raises(ValueError):
+        parse_aggregates("mean,median")
@@ -0,0 +1,49 @@
+import math
+import pytest
+import codec
+
+
+def test_readings_round_trip():
+    payload = codec.encode_readings("sensor", [1000, 2000, 3000], [1.5, 2.5, -3.0], sent_at=42)
+    assert codec.is_binary(payload)
+    frame = codec.decode(payload)
+    assert frame.kind == codec.KIND_READINGS
+    assert (frame.series, frame.sent_at, frame.fields) == ("sensor", 42, ("value",))
+    assert list(frame.timestamps) == [1000, 2000, 3000]
+    assert list(frame.values) == [1.5, 2.5, -3.0]
+    assert frame.to_strings() == ["1000:1.5", "2000:2.5", "3000:-3.0"]
+
+def test_aggregates_round_trip_with_missing_values():
+    payload = codec.encode_aggregates("sensor", ("mean", "max"), [0, 3600],
+                                      [[1.0, None], [2.0, 4.0]], sent_at=7)
+    frame = codec.decode(payload)
+    assert frame.kind == codec.KIND_AGGREGATES
+    assert frame.fields == ("mean", "max")
+    assert list(frame.timestamps) == [0, 3600]
+    assert math.isnan(frame.columns[0][1])
+    assert frame.to_strings() == ["0:1.0:2.0", "3600:None:4.0"]
+
+def test_columns_are_aligned():
+    for series in ("", "a", "sensor-with-a-longer-name"):
+        payload = codec.encode_readings(series, [1], [1.0])
+        offset = codec.decode_header(payload)[5]
+        assert offset % 8 == 0
+        assert codec.decode(payload).series == series
+
+def test_header_is_read_without_columns():
+    payload = codec.encode_aggregates("sensor", ("mean",), [0, 1, 2], [[1.0, 2.0, 3.0]], sent_at=9)
+    kind, series, sent_at, fields, count, offset = codec.decode_header(payload)
+    assert (kind, series, sent_at, fields, count) == (codec.KIND_AGGREGATES, "sensor", 9, ("mean",), 3)
+    assert len(payload) == offset + 8 * count * (1 + len(fields))
+
+def test_truncated_frame_is_rejected():
+    payload = codec.encode_readings("sensor", [1000, 2000], [1.0, 2.0])
+    with pytest.raises(ValueError):
+        codec.decode(payload[:-8])
+    with pytest.raises(ValueError):
+        codec.decode(payload[:10])
+
+def test_json_payloads_are_not_binary():
+    assert not codec.is_binary(b'["1000:1.0"]')
+    assert codec.decode_json(b'["1000:1.0", "finished"]') == ["1000:1.0", "finished"]
+    assert codec.decode_json(b'"1000:1.0"') == ["1000:1.0"]
@@ -0,0 +1,51 @@
+import math
+import random
+import pytest
+import codec
+import compression
+
+
+def series(count, seed=0):
+    rng = random.Random(seed)
+    timestamps = [1_600_000_000_000 + i * 60_000 + rng.choice((0, 0, 0, 1000, -1000)) for i in range(count)]
+    values = [round(10 + rng.gauss(0, 2), 1) for _ in range(count)]
+    return timestamps, values
+
+@pytest.mark.parametrize("encoding", [compression.ENCODING_GORILLA, compression.ENCODING_ZLIB, None])
+def test_readings_round_trip(encoding):
+    frame = codec.encode_readings("sensor", *series(500), sent_at=5)
+    payload = compression.compress(frame, encoding)
+    assert compression.is_compressed(payload)
+    assert not codec.is_binary(payload)
+    assert compression.decompress(payload) == frame
+    if encoding is not None:
+        assert compression.encoding_name(payload) == compression.ENCODINGS[encoding]
+
+@pytest.mark.parametrize("encoding", [compression.ENCODING_GORILLA, compression.ENCODING_ZLIB])
+def test_aggregates_round_trip_with_special_values(encoding):
+    starts = [0, 3600, 7200, 7200 + 2**40, 7200]
+    columns = [[1.5, None, -0.0, math.inf, 1e-300], [2.0, 2.0, 2.0, -math.inf, 3.0]]
+    frame = codec.encode_aggregates("sensor", ("mean", "max"), starts, columns, sent_at=5)
+    assert compression.decompress(compression.compress(frame, encoding)) == frame
+
+def test_empty_and_single_value_frames():
+    for timestamps, values in [([], []), ([1000], [1.0])]:
+        frame = codec.encode_readings("sensor", timestamps, values)
+        for encoding in (compression.ENCODING_GORILLA, compression.ENCODING_ZLIB):
+            assert compression.decompress(compression.compress(frame, encoding)) == frame
+
+def test_header_is_kept():
+    frame = codec.encode_readings("sensor", *series(10), sent_at=5)
+    payload = compression.compress(frame)
+    header = frame[:codec.decode_header(frame)[-1]]
+    assert header in payload
+
+def test_auto_is_no_larger_than_either():
+    frame = codec.encode_readings("sensor", *series(1000, seed=3))
+    sizes = [len(compression.compress(frame, x)) for x in compression.ENCODINGS]
+    assert len(compression.compress(frame)) == min(sizes)
+    assert min(sizes) < len(frame)
+
+def test_uncompressed_payload_is_rejected():
+    with pytest.raises(ValueError):
+        compression.decompress(codec.encode_readings("sensor", [1], [1.0]))
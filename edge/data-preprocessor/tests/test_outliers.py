@@ -0,0 +1,45 @@
+import random
+import pytest
+from outliers import StaticBound, RollingZScore, HampelFilter, parse_detector
+
+
+def noisy(count, seed=0):
+    rng = random.Random(seed)
+    values = [20 + rng.gauss(0, 1) for _ in range(count)]
+    for i in range(50, count, 97):
+        values[i] = 80.0
+    return values
+
+def test_static_bound():
+    detector = StaticBound(0, 50)
+    assert [detector.check(x) for x in (-1, 0, 25, 50, 51)] == [True, False, False, False, True]
+    assert detector.check_batch([-1, 25, 51]).tolist() == [True, False, True]
+
+@pytest.mark.parametrize("make", [lambda: RollingZScore(96, 3), lambda: HampelFilter(25, 3)])
+def test_batch_check_matches_single_checks(make):
+    values = noisy(1000)
+    single, batched = make(), make()
+    expected = [single.check(x) for x in values]
+    # Frames of different sizes, as they arrive from the injector
+    result = []
+    for start, end in [(0, 10), (10, 300), (300, 301), (301, 1000)]:
+        result += batched.check_batch(values[start:end]).tolist()
+    assert result == expected
+    assert any(expected)
+
+@pytest.mark.parametrize("make", [RollingZScore, HampelFilter])
+def test_spikes_are_rejected_after_warm_up(make):
+    detector = make(window=25, threshold=3)
+    values = noisy(500)
+    flags = [detector.check(x) for x in values]
+    assert all(flags[i] for i in range(50, 500, 97))
+    assert not any(flags[:25])
+
+def test_parse_detector():
+    assert parse_detector("none") is None
+    assert isinstance(parse_detector("static:50"), StaticBound)
+    zscore = parse_detector("zscore:48:2.5")
+    assert (type(zscore), zscore.window, zscore.threshold) == (RollingZScore, 48, 2.5)
+    assert isinstance(parse_detector("hampel:25:3"), HampelFilter)
+    with pytest.raises(ValueError):
+        parse_detector("iqr:3")
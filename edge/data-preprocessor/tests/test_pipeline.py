@@ -0,0 +1,75 @@
+import threading
+import time
+import pytest
+from pipeline import BoundedQueue, Pipeline
+
+
+def drain(bounded):
+    return [bounded.get(0)[1] for _ in range(len(bounded))]
+
+
+def test_drop_newest_keeps_queued_items():
+    bounded = BoundedQueue("q", 2, "drop_newest")
+    assert bounded.put("a") and bounded.put("b")
+    assert not bounded.put("c")
+    assert drain(bounded) == ["a", "b"]
+    assert bounded.stats()["dropped"] == 1
+
+def test_drop_oldest_passes_over_control_items():
+    bounded = BoundedQueue("q", 3, "drop_oldest")
+    bounded.put(("finished",), control=True)
+    bounded.put("a")
+    bounded.put("b")
+    assert not bounded.put("c")
+    assert drain(bounded) == [("finished",), "b", "c"]
+
+def test_control_items_are_never_dropped():
+    bounded = BoundedQueue("q", 1, "drop_newest")
+    bounded.put("a")
+    threading.Timer(0.05, bounded.get).start()
+    assert bounded.put(("finished",), control=True)
+    assert drain(bounded) == [("finished",)]
+
+def test_block_waits_for_space():
+    bounded = BoundedQueue("q", 1, "block")
+    bounded.put("a")
+    threading.Timer(0.05, bounded.get).start()
+    start = time.monotonic()
+    assert bounded.put("b")
+    assert time.monotonic() - start >= 0.04
+    assert drain(bounded) == ["b"]
+
+def test_unknown_policy_is_rejected():
+    with pytest.raises(ValueError):
+        BoundedQueue("q", 1, "drop_random")
+
+def test_get_many_keeps_order():
+    bounded = BoundedQueue("q", 10)
+    for x in range(5):
+        bounded.put(x)
+    assert [x for _, x in bounded.get_many(3)] == [0, 1, 2]
+    assert len(bounded) == 2
+
+def test_pipeline_publishes_every_item_in_order():
+    published = []
+    pipeline = Pipeline(lambda x: [x * 10], published.extend, max_publish_batch=4)
+    pipeline.start()
+    for x in range(50):
+        pipeline.put(x)
+    pipeline.stop()
+    assert published == [x * 10 for x in range(50)]
+    assert pipeline.stats()["preprocess"]["processed"] == 50
+
+def test_stage_errors_are_counted_not_raised():
+    published = []
+    def process(x):
+        if x == 1:
+            raise ValueError("bad item")
+        return [x]
+    pipeline = Pipeline(process, published.extend)
+    pipeline.start()
+    for x in range(3):
+        pipeline.put(x)
+    pipeline.stop()
+    assert published == [0, 2]
+    assert pipeline.stats()["preprocess"]["errors"] == 1
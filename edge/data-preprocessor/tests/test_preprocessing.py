@@ -0,0 +1,78 @@
+from preprocessing import Preprocessor
+
+DAY = 24*60*60
+# Noon of a day, so readings stay in their day whatever the timezone
+NOON = (1_600_000_000 // DAY) * DAY + DAY // 2
+
+
+def reading(day, value=1.0, seconds=0):
+    '''Formats reading at noon of day as the injector sends it'''
+    return f"{(NOON + day*DAY + seconds) * 1000}:{value}"
+
+def means(windows):
+    return [float(x.split(":")[1]) for x in windows]
+
+def run(preprocessor, readings):
+    closed = []
+    for x in readings:
+        closed += preprocessor.process_value(x)
+    return closed
+
+
+def test_closes_window_once_watermark_passes():
+    preprocessor = Preprocessor()
+    assert run(preprocessor, [reading(0, 1.0), reading(0, 3.0)]) == []
+    assert means(run(preprocessor, [reading(1, 5.0)])) == [2.0]
+    assert means(preprocessor.process_value("finished")) == [5.0]
+
+def test_late_value_within_allowed_lateness_is_kept():
+    preprocessor = Preprocessor(allowed_lateness=DAY)
+    closed = run(preprocessor, [reading(0, 1.0), reading(1, 2.0), reading(0, 3.0, seconds=60)])
+    assert closed == []
+    assert means(preprocessor.flush()) == [2.0, 2.0]
+    assert preprocessor.stats()["late_dropped"] == 0
+
+def test_value_of_closed_window_is_dropped():
+    preprocessor = Preprocessor()
+    assert means(run(preprocessor, [reading(0, 1.0), reading(1, 2.0), reading(0, 3.0)])) == [1.0]
+    assert preprocessor.stats()["late_dropped"] == 1
+    assert means(preprocessor.flush()) == [2.0]
+
+def test_outliers_are_counted_not_aggregated():
+    preprocessor = Preprocessor()
+    run(preprocessor, [reading(0, 1.0), reading(0, 500.0)])
+    assert means(preprocessor.flush()) == [1.0]
+    assert preprocessor.stats()["outliers"] == 1
+
+def test_oldest_window_is_closed_when_too_many_are_open():
+    preprocessor = Preprocessor(allowed_lateness=10*DAY, max_open_windows=2)
+    closed = run(preprocessor, [reading(0, 1.0), reading(1, 2.0), reading(2, 3.0)])
+    assert means(closed) == [1.0]
+    assert preprocessor.stats()["forced_closes"] == 1
+
+def test_single_value_far_ahead_does_not_move_watermark():
+    preprocessor = Preprocessor()
+    closed = run(preprocessor, [reading(0, 1.0), reading(365, 9.0), reading(0, 2.0, seconds=60)])
+    assert closed == []
+    assert means(run(preprocessor, [reading(1, 3.0)])) == [1.5]
+    assert preprocessor.stats()["late_dropped"] == 0
+
+def test_two_values_far_ahead_move_watermark():
+    preprocessor = Preprocessor()
+    closed = run(preprocessor, [reading(0, 1.0), reading(365, 9.0), reading(365, 7.0)])
+    assert means(closed) == [1.0]
+
+def test_first_value_far_ahead_needs_confirming():
+    # A wrong clock on the very first reading must not close or drop the
+    # correct readings which follow
+    preprocessor = Preprocessor()
+    closed = run(preprocessor, [reading(365, 9.0), reading(0, 1.0), reading(0, 3.0, seconds=60)])
+    assert closed == []
+    assert means(run(preprocessor, [reading(1, 4.0)])) == [2.0]
+    assert preprocessor.stats()["late_dropped"] == 0
+    assert means(preprocessor.flush()) == [4.0, 9.0]
+
+def test_single_value_is_flushed():
+    preprocessor = Preprocessor()
+    assert run(preprocessor, [reading(0, 1.0)]) == []
+    assert means(preprocessor.flush()) == [1.0]
@@ -0,0 +1,136 @@
+import json
+import pika
+import pytest
+import publisher
+from spool import Spool
+
+
+class FakeChannel:
+    '''
+    Stand-in of pika's BlockingChannel, its underlying channel and its
+    connection, messages are delivered once their confirms are waited for
+    '''
+    def __init__(self, nack=False):
+        self._impl = self
+        self.connection = self
+        self.nack = nack
+        self.down = False
+        self.closed = False
+        self.on_confirm = None
+        self.delivery_tag = 0
+        self.unconfirmed = []
+        self.delivered = []
+        self.waits = 0
+
+    def queue_declare(self, queue):
+        if self.down:
+            raise pika.exceptions.AMQPConnectionError("down")
+
+    def confirm_delivery(self, ack_nack_callback, callback=None):
+        self.on_confirm = ack_nack_callback
+        callback(None)
+
+    def basic_publish(self, exchange, routing_key, body, properties=None):
+        if self.down:
+            raise pika.exceptions.AMQPConnectionError("down")
+        self.delivery_tag += 1
+        self.unconfirmed.append(body)
+
+    def _flush_output(self, *waiters):
+        if self.down:
+            raise pika.exceptions.AMQPConnectionError("down")
+        self.waits += 1
+        if self.unconfirmed:
+            method = pika.spec.Basic.Nack if self.nack else pika.spec.Basic.Ack
+            if not self.nack:
+                self.delivered += self.unconfirmed
+            self.unconfirmed = []
+            self.on_confirm(pika.frame.Method(1, method(self.delivery_tag, multiple=True)))
+
+    def process_data_events(self, time_limit=None):
+        pass
+
+    def close(self):
+        self.closed = True
+
+
+def bodies(channel):
+    return [json.loads(x) for x in channel.delivered]
+
+
+def test_batch_is_confirmed_with_one_wait():
+    channel = FakeChannel()
+    rabbit = publisher.RabbitPublisher(channel, batch_size=3)
+    waits = channel.waits
+    for i in range(3):
+        rabbit.publish("CSC8112", f"{i}:1.0")
+    assert bodies(channel) == ["0:1.0", "1:1.0", "2:1.0"]
+    assert channel.waits == waits + 1
+    assert rabbit.pending == 0
+    assert rabbit.stats()["batches"] == 1
+
+def test_messages_wait_for_flush():
+    channel = FakeChannel()
+    rabbit = publisher.RabbitPublisher(channel, batch_size=100)
+    rabbit.publish("CSC8112", "0:1.0")
+    assert channel.delivered == []
+    rabbit.flush()
+    assert bodies(channel) == ["0:1.0"]
+
+def test_single_acks_confirm_their_own_message():
+    rabbit = publisher.RabbitPublisher(FakeChannel(), batch_size=100)
+    rabbit.unconfirmed = {1, 2, 3}
+    rabbit.on_confirm(pika.frame.Method(1, pika.spec.Basic.Ack(2, multiple=False)))
+    assert rabbit.unconfirmed == {1, 3}
+    rabbit.on_confirm(pika.frame.Method(1, pika.spec.Basic.Nack(3, multiple=True)))
+    assert rabbit.unconfirmed == set()
+    assert rabbit.nacked == 2
+
+def test_nack_without_spool_raises():
+    rabbit = publisher.RabbitPublisher(FakeChannel(nack=True), batch_size=100)
+    rabbit.publish("CSC8112", "0:1.0")
+    with pytest.raises(pika.exceptions.NackError):
+        rabbit.flush()
+
+def test_outage_spools_batch_and_drains_in_order(tmp_path):
+    channel = FakeChannel()
+    spare = FakeChannel()
+    rabbit = publisher.RabbitPublisher(channel, batch_size=100, spool=Spool(str(tmp_path)),
+                                       connect=lambda: spare)
+    rabbit.publish("CSC8112", "0:1.0")
+    channel.down = True
+    rabbit.flush()
+    assert channel.closed
+    assert rabbit.channel is None
+    rabbit.publish("CSC8112", "1:1.0")
+    assert rabbit.stats()["outages"] == 1
+
+    # Reconnected once the backoff delay has passed
+    rabbit.next_attempt = 0
+    rabbit.flush(drain_all=True)
+    assert rabbit.channel is spare
+    assert bodies(spare) == ["0:1.0", "1:1.0"]
+    assert rabbit.spool.empty()
+    rabbit.publish("CSC8112", "2:1.0")
+    rabbit.flush()
+    assert bodies(spare) == ["0:1.0", "1:1.0", "2:1.0"]
+
+def test_nacked_batch_is_sent_again(tmp_path):
+    channel = FakeChannel(nack=True)
+    spare = FakeChannel()
+    rabbit = publisher.RabbitPublisher(channel, batch_size=100, spool=Spool(str(tmp_path)),
+                                       connect=lambda: spare)
+    rabbit.publish("CSC8112", "0:1.0")
+    rabbit.flush()
+    assert channel.delivered == []
+    rabbit.next_attempt = 0
+    rabbit.flush(drain_all=True)
+    assert bodies(spare) == ["0:1.0"]
+
+def test_spool_records_keep_message_properties():
+    body, properties = publisher.encode_message(b"WS\x01", {"series": "s"})
+    queue_name, unpacked, restored = publisher.unpack_record(
+        publisher.pack_record("CSC8112", body, properties))
+    assert (queue_name, unpacked) == ("CSC8112", body)
+    assert restored.content_type == properties.content_type
+    assert restored.headers == {"series": "s"}
@@ -0,0 +1,53 @@
+import pytest
+import sharding
+
+DAY = 24*60*60
+
+
+def readings(key_index, days=4):
+    '''Hourly readings of a series over days'''
+    start = 1_600_000_000 // DAY * DAY
+    return [f"{(start + h * 3600) * 1000}:{(key_index + h) % 40}.0" for h in range(days * 24)]
+
+def run(workers):
+    shards = sharding.ShardedPreprocessor(workers)
+    try:
+        results = []
+        for i in range(6):
+            key = f"sensor{i}"
+            values = readings(i)
+            for start in range(0, len(values), 10):
+                results += shards.submit(key, values[start:start + 10])
+        results += shards.poll()
+        results += shards.flush()
+    finally:
+        shards.close()
+    windows = {}
+    for x in results:
+        windows.setdefault(x[0], []).extend(x[1])
+    return windows
+
+def test_shard_of_is_stable():
+    assert sharding.shard_of("sensor1", 4) == sharding.shard_of("sensor1", 4)
+    assert {sharding.shard_of(f"sensor{i}", 4) for i in range(100)} == {0, 1, 2, 3}
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_workers_give_same_windows_as_in_process(workers):
+    expected = run(0)
+    assert len(expected) == 6
+    assert all(len(x) == 4 for x in expected.values())
+    assert run(workers) == expected
+
+@pytest.mark.parametrize("workers", [0, 2])
+def test_worker_counts_reach_parent_counters(workers):
+    before = {name: counter.value for name, counter in sharding.COUNTERS.items()}
+    shards = sharding.ShardedPreprocessor(workers, allowed_lateness=0)
+    try:
+        values = readings(0, days=3)
+        shards.submit("sensor0", values + ["0:99.0", values[0]])
+        shards.flush()
+    finally:
+        shards.close()
+    after = {name: counter.value for name, counter in sharding.COUNTERS.items()}
+    assert after["outliers"] - before["outliers"] == 1
+    assert after["late_dropped"] - before["late_dropped"] == 1
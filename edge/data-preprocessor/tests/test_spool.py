@@ -0,0 +1,82 @@
+import os
+from spool import Spool, RECORD
+
+
+def test_reads_records_in_order(tmp_path):
+    spool = Spool(str(tmp_path))
+    for i in range(5):
+        spool.append(b"message %d" % i)
+    assert spool.read(3) == [b"message 0", b"message 1", b"message 2"]
+    assert spool.read(3) == [b"message 3", b"message 4"]
+    assert spool.read(3) == []
+
+def test_uncommitted_records_are_read_again_after_restart(tmp_path):
+    spool = Spool(str(tmp_path))
+    for i in range(4):
+        spool.append(b"%d" % i)
+    spool.read(2)
+    spool.commit()
+    spool.read(2)
+    spool.close()
+
+    spool = Spool(str(tmp_path))
+    assert spool.read(10) == [b"2", b"3"]
+
+def test_rewind_returns_to_last_commit(tmp_path):
+    spool = Spool(str(tmp_path))
+    for i in range(3):
+        spool.append(b"%d" % i)
+    spool.read(1)
+    spool.commit()
+    assert spool.read(10) == [b"1", b"2"]
+    spool.rewind()
+    assert spool.read(10) == [b"1", b"2"]
+
+def test_torn_record_ends_segment(tmp_path):
+    spool = Spool(str(tmp_path), segment_bytes=1024, max_bytes=4096)
+    spool.append(b"complete")
+    spool.append(b"torn")
+    spool.close()
+    # Corrupt the payload of the second record, as a crash mid-write would
+    path = os.path.join(str(tmp_path), sorted(x for x in os.listdir(str(tmp_path)) if x.endswith(".seg"))[0])
+    with open(path, "r+b") as f:
+        f.seek(2*RECORD.size + len(b"complete"))
+        f.write(b"XXXX")
+
+    spool = Spool(str(tmp_path), segment_bytes=1024, max_bytes=4096)
+    assert spool.read(10) == [b"complete"]
+
+def test_records_continue_over_segments(tmp_path):
+    spool = Spool(str(tmp_path), segment_bytes=64, max_bytes=1024)
+    payloads = [b"%02d" % i * 8 for i in range(10)]
+    for x in payloads:
+        spool.append(x)
+    assert len(spool.segments) > 1
+    assert spool.read(100) == payloads
+    spool.commit()
+    assert spool.empty()
+    assert len(spool.segments) == 1
+
+def test_oldest_segment_is_dropped_when_full(tmp_path):
+    spool = Spool(str(tmp_path), segment_bytes=64, max_bytes=128)
+    for i in range(6):
+        spool.append(b"%d" % i * 20)
+    assert len(spool.segments) == 2
+    assert spool.dropped_segments > 0
+    assert spool.read(100)[-1] == b"5" * 20
+
+def test_pending_follows_appends_and_commits(tmp_path):
+    spool = Spool(str(tmp_path), segment_bytes=64, max_bytes=1024)
+    assert spool.empty()
+    for i in range(6):
+        spool.append(b"%d" % i * 10)
+    assert spool.pending() == 6 * (RECORD.size + 10)
+    spool.read(4)
+    assert spool.pending() == 6 * (RECORD.size + 10)
+    spool.commit()
+    assert spool.pending() == 2 * (RECORD.size + 10)
+    spool.append(b"x" * 10)
+    assert spool.pending() == 3 * (RECORD.size + 10)
+    spool.read(10)
+    spool.commit()
+    assert spool.empty()
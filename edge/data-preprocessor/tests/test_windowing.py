@@ -0,0 +1,65 @@
+import pytest
+import windowing
+from preprocessing import Preprocessor
+from windowing import parse_window, parse_duration, tumbling, hopping
+
+DAY = 24*60*60
+HOUR = 60*60
+
+
+def test_tumbling_windows_start_at_midnight_utc():
+    window = tumbling(DAY)
+    ts = 1_600_000_000
+    start = window.pane_start(ts)
+    assert start % DAY == 0
+    assert start <= ts < start + DAY
+    assert window.first_window(start) == start
+    assert list(window.panes(start)) == [start]
+
+def test_hopping_windows_are_built_from_panes():
+    window = hopping(DAY, HOUR)
+    pane = window.pane_start(5 * DAY + 3 * HOUR + 10)
+    assert pane == 5 * DAY + 3 * HOUR
+    # The pane is in every window starting in the day before it
+    first = window.first_window(pane)
+    assert first == pane - DAY + HOUR
+    assert len(window.panes(first)) == 24
+    assert list(window.panes(first))[-1] == pane
+
+def test_fixed_offset_moves_boundaries():
+    window = tumbling(DAY, tz=HOUR)
+    assert window.pane_start(DAY + 30 * 60) == DAY - HOUR
+    assert window.pane_start(DAY - 30 * 60) == DAY - HOUR
+
+def test_size_must_be_multiple_of_hop():
+    with pytest.raises(ValueError):
+        hopping(DAY, 7 * HOUR)
+
+@pytest.mark.parametrize("spec, kind, size, hop", [
+    ("1d", "tumbling", DAY, DAY),
+    ("tumbling:1h", "tumbling", HOUR, HOUR),
+    ("hopping:1d/1h", "hopping", DAY, HOUR),
+    ("1d/1h", "hopping", DAY, HOUR),
+    ("sliding:1h", "hopping", HOUR, windowing.SLIDING_STEP),
+    ("sliding:1h/10s", "hopping", HOUR, 10),
+])
+def test_parse_window(spec, kind, size, hop):
+    window = parse_window(spec)
+    assert (window.kind, window.size, window.hop) == (kind, size, hop)
+
+@pytest.mark.parametrize("spec", ["", "1w", "hopping:1d", "rolling:1d", "1d/7h"])
+def test_parse_window_rejects_invalid(spec):
+    with pytest.raises(ValueError):
+        parse_window(spec)
+
+def test_parse_duration():
+    assert parse_duration("90s") == 90
+    assert parse_duration(" 15m ") == 15 * 60
+
+def test_preprocessor_merges_panes_of_hopping_windows():
+    preprocessor = Preprocessor(window=hopping(2 * DAY, DAY), allowed_lateness=0)
+    closed = []
+    for day, value in [(10, 1.0), (11, 3.0), (12, 5.0)]:
+        closed += preprocessor.process_value(f"{(day * DAY + HOUR) * 1000}:{value}")
+    closed += preprocessor.flush()
+    assert closed == [f"{9 * DAY}:1.0", f"{10 * DAY}:2.0", f"{11 * DAY}:4.0", f"{12 * DAY}:5.0"]